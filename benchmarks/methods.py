@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time the network and text methods on synthetic data at several scales.
+
+usage:
+    methods.py [--scales <list> --network-methods <list> --text-methods <list> --repeat <n> --data-dir <dir> --output <file>]
+
+Options
+    -h, --help
+    --scales <list>            Comma separated scales to run, from small, medium and large [default: small,medium].
+    --network-methods <list>   Comma separated network methods to time [default: jaccard,jaccard_merge,proportion,cosine,adamic,rarity,rarity_log].
+    --text-methods <list>      Comma separated text methods to time [default: chi2].
+    -r, --repeat <n>           Number of times to run each benchmark; the fastest is reported [default: 3].
+    --data-dir <dir>           Directory to keep the generated data in, so later runs reuse it [default: benchmarks/data].
+    -o, --output <file>        Write the results as json to this file, to compare across commits.
+
+Each result records the best wall time of a benchmark and the peak memory it
+allocated, measured with tracemalloc in a separate run so as not to slow the
+timed runs. The data is generated with fixed seeds, so results are comparable
+across commits and machines.
+"""
+
+from docopt import docopt
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from brandelion.cli import analyze  # noqa: E402
+import synthetic  # noqa: E402
+
+# (brands, exemplars, users) for network methods, and (brands, exemplars, samples) accounts for text methods.
+SCALES = {
+    'small': {'network': (200, 50, 100000), 'text': (50, 50, 50)},
+    'medium': {'network': (2000, 200, 1000000), 'text': (500, 200, 500)},
+    'large': {'network': (10000, 500, 5000000), 'text': (2000, 500, 2000)},
+}
+
+
+def generate(data_dir, scale):
+    """ Write the synthetic files for a scale, unless they exist, and return their paths. """
+    nbrands, nexemplars, users = SCALES[scale]['network']
+    tbrands, texemplars, tsamples = SCALES[scale]['text']
+    paths = dict((kind, os.path.join(data_dir, '%s.%s' % (scale, kind))) for kind in
+                 ['brand_followers.txt', 'exemplar_followers.txt', 'brand_tweets.json',
+                  'exemplar_tweets.json', 'sample_tweets.json'])
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    writers = [
+        ('brand_followers.txt', lambda f: synthetic.write_follower_file(f, nbrands, users, 'brand', seed=1)),
+        ('exemplar_followers.txt', lambda f: synthetic.write_follower_file(f, nexemplars, users, 'exemplar', seed=2)),
+        ('brand_tweets.json', lambda f: synthetic.write_tweet_file(f, tbrands, 'brand', topic=0, seed=3)),
+        ('exemplar_tweets.json', lambda f: synthetic.write_tweet_file(f, texemplars, 'exemplar', topic=0, seed=4)),
+        ('sample_tweets.json', lambda f: synthetic.write_tweet_file(f, tsamples, 'sample', topic=1, seed=5)),
+    ]
+    for kind, write in writers:
+        if not os.path.exists(paths[kind]):
+            print('writing %s' % paths[kind])
+            write(paths[kind] + '.tmp')
+            os.rename(paths[kind] + '.tmp', paths[kind])
+    return paths
+
+
+def measure(fn, repeat):
+    """ Return the best wall time of repeat calls to fn, and the peak memory, in bytes, allocated by one call. """
+    best = float('inf')
+    for _ in range(repeat):
+        analyze._merged_indexes.clear()  # don't let one run reuse the indexes built by the last.
+        analyze._inverted_indexes.clear()
+        start = time.time()
+        fn()
+        best = min(best, time.time() - start)
+    analyze._merged_indexes.clear()
+    analyze._inverted_indexes.clear()
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def network_benchmarks(paths, methods):
+    """ Yield name, records, fn tuples for the network methods. """
+    brands = analyze.read_follower_file(paths['brand_followers.txt'])
+    exemplars = analyze.read_follower_file(paths['exemplar_followers.txt'])
+    brand_list = list(brands.items())
+    yield 'read_follower_file', len(brands), lambda: analyze.read_follower_file(paths['brand_followers.txt'])
+    for method in methods:
+        fn = getattr(analyze, method)
+        yield method, len(brand_list), lambda fn=fn: fn(brand_list, exemplars)
+
+
+def text_benchmarks(paths, methods):
+    """ Yield name, records, fn tuples for vectorizing tweets and for the text methods. """
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    def new_vectorizer():
+        return CountVectorizer(min_df=3, preprocessor=analyze.preprocess, ngram_range=(2, 2), binary=True)
+    vec = new_vectorizer()
+    _, exemplar_vectors = analyze.vectorize(paths['exemplar_tweets.json'], vec, dofit=True)
+    _, sample_vectors = analyze.vectorize(paths['sample_tweets.json'], vec, dofit=False)
+    ntweets = sum(1 for _ in open(paths['exemplar_tweets.json']))
+    yield 'vectorize', ntweets, lambda: analyze.vectorize(paths['exemplar_tweets.json'], new_vectorizer(), dofit=True)
+    for method in methods:
+        fn = getattr(analyze, method)
+        yield method, exemplar_vectors.shape[0] + sample_vectors.shape[0], lambda fn=fn: fn(exemplar_vectors, sample_vectors)
+
+
+def environment():
+    """ Return the commit and library versions the benchmarks ran with. """
+    import numpy
+    import scipy
+    import sklearn
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': numpy.__version__,
+            'scipy': scipy.__version__, 'sklearn': sklearn.__version__, 'machine': platform.machine()}
+
+
+def main():
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+    network_methods = [m for m in args['--network-methods'].split(',') if m]
+    text_methods = [m for m in args['--text-methods'].split(',') if m]
+    results = []
+    for scale in args['--scales'].split(','):
+        if scale not in SCALES:
+            exit('unknown scale %s; choose from %s' % (scale, ', '.join(sorted(SCALES))))
+        paths = generate(args['--data-dir'], scale)
+        for kind, benchmarks in [('network', network_benchmarks(paths, network_methods)),
+                                 ('text', text_benchmarks(paths, text_methods))]:
+            for name, records, fn in benchmarks:
+                seconds, peak = measure(fn, repeat)
+                results.append({'benchmark': name, 'kind': kind, 'scale': scale, 'records': records,
+                                'seconds': round(seconds, 4), 'peak_mb': round(peak / 1e6, 2),
+                                'records_per_second': round(records / seconds, 1) if seconds else None})
+                print('%-8s %-20s %8d records %9.3fs %9.1fMB' % (scale, name, records, seconds, peak / 1e6))
+    if args['--output']:
+        with open(args['--output'], 'wt') as f:
+            json.dump({'environment': environment(), 'repeat': repeat, 'results': results}, f, indent=2)
+        print('results written to %s' % args['--output'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time how long brandelion commands take to start.
+
+usage:
+    startup.py [--repeat <n>]
+
+Options
+    -h, --help
+    -r, --repeat <n>    Number of times to run each command [default: 5].
+"""
+
+from docopt import docopt
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['matplotlib', 'sklearn', 'scipy', 'googleapiclient', 'twutil']
+
+
+def write_follower_file(fname, accounts):
+    with open(fname, 'wt') as f:
+        for i, name in enumerate(accounts):
+            f.write('2015-01-01T00:00:00 %s %s\n' % (name, ' '.join(str(j) for j in range(i, i + 50))))
+
+
+def repo_env():
+    """ Return the environment in which to run brandelion from this checkout. """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+
+def time_command(argv, repeat):
+    """ Return the best wall time, in seconds, over repeat runs of argv. """
+    best = float('inf')
+    env = repo_env()
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.check_call(argv, stdout=subprocess.DEVNULL, cwd=ROOT, env=env)
+        best = min(best, time.time() - start)
+    return best
+
+
+def heavy_imports(module):
+    """ Return the heavy modules that importing module pulls in. """
+    code = 'import sys, %s; print(" ".join(m for m in %r if m in sys.modules))' % (module, HEAVY_MODULES)
+    return subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, env=repo_env()).decode('utf8').split()
+
+
+def main():
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        brands = os.path.join(tmpdir, 'brands.txt')
+        exemplars = os.path.join(tmpdir, 'exemplars.txt')
+        write_follower_file(brands, ['brand%d' % i for i in range(10)])
+        write_follower_file(exemplars, ['exemplar%d' % i for i in range(10)])
+        cli = [sys.executable, '-m', 'brandelion.cli.brandelion']
+        commands = [
+            ('python', [sys.executable, '-c', 'pass']),
+            ('analyze --help', cli + ['analyze', '--help']),
+            ('analyze --network', cli + ['analyze', '--network', '--brand-followers', brands,
+                                         '--exemplar-followers', exemplars,
+                                         '--output', os.path.join(tmpdir, 'scores.txt')]),
+        ]
+        for name, argv in commands:
+            print('%-20s %.3fs' % (name, time_command(argv, repeat)))
+        for module in ['brandelion.cli.analyze', 'brandelion.cli.collect', 'brandelion.cli.diagnose',
+                       'brandelion.cli.partition', 'brandelion.cli.report', 'brandelion.cli.serve']:
+            print('%-28s imports: %s' % (module, ' '.join(heavy_imports(module)) or 'none'))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Write deterministic synthetic follower and tweet files for benchmarks.
+
+usage:
+    synthetic.py followers --output <file> --accounts <n> [--users <n> --prefix <s> --seed <s>]
+    synthetic.py tweets --output <file> --accounts <n> [--prefix <s> --topic <t> --seed <s>]
+
+Options
+    -h, --help
+    -o, --output <file>     File to write.
+    --accounts <n>          Number of accounts to write.
+    --users <n>             Number of distinct users who follow the accounts [default: 1000000].
+    --prefix <s>            Prefix of the accounts' screen names [default: account].
+    --topic <t>             Index of the topic the accounts tweet about [default: 0].
+    --seed <s>              Random seed; the same seed always writes the same file [default: 12345].
+
+Follower counts follow a power law (a few accounts have most followers), and
+followers are drawn from a Zipf distribution over users, so that popular users
+follow many accounts. Tweets have log-normal lengths, about a quarter are
+retweets, and each account mixes its topic's words into common words, so that
+text methods have a signal to find.
+"""
+
+from docopt import docopt
+import io
+import json
+import numpy as np
+
+# Power law exponent of follower counts, and the smallest count.
+FOLLOWER_ALPHA = 2.
+MIN_FOLLOWERS = 50
+# Exponent of the Zipf distribution of follows over users, and of words over the vocabulary.
+ZIPF_EXPONENT = 1.1
+VOCABULARY_SIZE = 20000
+TOPIC_WORDS = 200
+TOPIC_RATE = .2
+RETWEET_RATE = .25
+MENTION_RATE = .3
+URL_RATE = .2
+HASHTAG_RATE = .15
+
+
+def zipf_cdf(n, exponent=ZIPF_EXPONENT):
+    """ Return the cumulative distribution of a Zipf distribution over n items.
+    >>> zipf_cdf(3, 1.).round(3).tolist()
+    [0.545, 0.818, 1.0]
+    """
+    weights = 1. / np.arange(1, n + 1) ** exponent
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def power_law_counts(rng, n, alpha, xmin, xmax):
+    """ Draw n integers from a power law with exponent alpha, between xmin and xmax. """
+    counts = xmin * (1. - rng.random_sample(n)) ** (-1. / (alpha - 1.))
+    return np.minimum(counts, xmax).astype(np.int64)
+
+
+def write_follower_file(fname, accounts, users=1000000, prefix='account', seed=12345):
+    """ Write a follower file of accounts with power law follower counts. """
+    rng = np.random.RandomState(seed)
+    cdf = zipf_cdf(users)
+    # Shuffle user ids, so that popular users aren't just the small ids.
+    user_ids = rng.permutation(users) + 1
+    counts = power_law_counts(rng, accounts, FOLLOWER_ALPHA, MIN_FOLLOWERS, users // 10)
+    with io.open(fname, 'wt', encoding='utf8') as f:
+        for i, count in enumerate(counts):
+            followers = np.unique(np.searchsorted(cdf, rng.random_sample(count)))
+            f.write(u'2015-01-01T00:00:00 %s%d %s\n' % (prefix, i, ' '.join(str(x) for x in user_ids[followers])))
+
+
+def words(rng, cdf, n, topic):
+    """ Return n words: common words from the Zipf distribution cdf, mixed with words about topic. """
+    common = np.searchsorted(cdf, rng.random_sample(n))
+    topical = rng.random_sample(n) < TOPIC_RATE
+    return ['topic%dword%d' % (topic, rng.randint(TOPIC_WORDS)) if t else 'word%d' % w
+            for w, t in zip(common, topical)]
+
+
+def tweet_text(rng, cdf, topic, screen_names):
+    """ Return the text of a tweet, about 14 words long, with hashtags, mentions and urls. """
+    n = int(np.clip(rng.lognormal(2.5, .6), 1, 50))
+    text = words(rng, cdf, n, topic)
+    if rng.random_sample() < HASHTAG_RATE:
+        text.append('#' + words(rng, cdf, 1, topic)[0])
+    if rng.random_sample() < MENTION_RATE:
+        text.insert(0, '@' + screen_names[rng.randint(len(screen_names))])
+    if rng.random_sample() < URL_RATE:
+        text.append('http://t.co/%x' % rng.randint(1 << 30))
+    return ' '.join(text)[:280]
+
+
+def write_tweet_file(fname, accounts, prefix='account', topic=0, seed=12345):
+    """ Write a file of tweet json, one tweet per line, grouped by account.
+    The number of tweets per account follows a power law. """
+    rng = np.random.RandomState(seed)
+    cdf = zipf_cdf(VOCABULARY_SIZE)
+    screen_names = ['%s%d' % (prefix, i) for i in range(accounts)]
+    counts = power_law_counts(rng, accounts, 2.5, 5, 200)
+    with io.open(fname, 'wt', encoding='utf8') as f:
+        for screen_name, count in zip(screen_names, counts):
+            for _ in range(count):
+                tweet = {'user': {'screen_name': screen_name},
+                         'created_at': 'Thu Jan 01 00:00:00 +0000 2015'}
+                if rng.random_sample() < RETWEET_RATE:
+                    original = screen_names[rng.randint(accounts)]
+                    text = tweet_text(rng, cdf, topic, screen_names)
+                    tweet['retweeted_status'] = {'user': {'screen_name': original}, 'text': text}
+                    tweet['text'] = ('RT @%s: %s' % (original, text))[:140]
+                else:
+                    tweet['text'] = tweet_text(rng, cdf, topic, screen_names)
+                f.write(json.dumps(tweet) + u'\n')
+
+
+def main():
+    args = docopt(__doc__)
+    if args['followers']:
+        write_follower_file(args['--output'], int(args['--accounts']), int(args['--users']), args['--prefix'],
+                            int(args['--seed']))
+    else:
+        write_tweet_file(args['--output'], int(args['--accounts']), args['--prefix'], int(args['--topic']),
+                         int(args['--seed']))
+
+
+if __name__ == '__main__':
+    main()
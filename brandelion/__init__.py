@@ -12,18 +12,31 @@ __author__ = 'Aron Culotta'
 __email__ = 'aronwc@gmail.com'
 __version__ = '0.1.8'
 
-config = ConfigParser()
-if 'BRANDELION_CFG' in os.environ:
-    config.read(os.environ['BRANDELION_CFG'])
-else:
-    config.read('~/.brandelion')
-
 #sys.stdout = codecs.getwriter('utf8')(sys.stdout)
 
-# make directories
-path = config.get('data', 'path')
-for subdir in ['collect', 'analyze', 'report']:
-    try:
-        os.makedirs(path + '/' + config.get('data', subdir))
-    except:
-        pass
+_config = None
+
+
+def get_config():
+    """ Return the configuration, read from $BRANDELION_CFG (or ~/.brandelion)
+    the first time it is needed. Nothing is read or created at import time. """
+    global _config
+    if _config is None:
+        config = ConfigParser()
+        config.read(os.path.expanduser(os.environ.get('BRANDELION_CFG', '~/.brandelion')))
+        _config = config
+    return _config
+
+
+def set_config(config):
+    """ Use this ConfigParser instead of reading the config file, e.g., in
+    worker processes that receive their settings from a parent. """
+    global _config
+    _config = config
+
+
+def __getattr__(name):
+    # Keep brandelion.config working, but load it lazily.
+    if name == 'config':
+        return get_config()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
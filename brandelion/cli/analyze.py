@@ -3,17 +3,29 @@
 """Analyze social and linguistic brand data.
 
 usage:
-    brandelion analyze --text --brand-tweets <file> --exemplar-tweets <file> --sample-tweets <file>  --output <file> [--text-method <string>]
-    brandelion analyze --network --brand-followers <file> --exemplar-followers <file> --output <file> [--network-method <string>  --min-followers <n> --max-followers <n>  --sample-exemplars <p> --seed <s>]
+    brandelion analyze --text --brand-tweets <file> --exemplar-tweets <file> --sample-tweets <file>  --output <file> [--text-method <string> (--features <spec>)... --save-model <file> --since <day> --until <day> --rolling <n> --metrics <file> --profile <stage>]
+    brandelion analyze --text --brand-tweets <file> --text-model <file> --output <file> [--since <day> --until <day> --rolling <n> --metrics <file> --profile <stage>]
+    brandelion analyze --text --text-stats <dir> [--exemplar-tweets <file> --sample-tweets <file> --window <days> --brand-tweets <file> --output <file> --save-model <file> --since <day> --until <day> --rolling <n> --metrics <file> --profile <stage>]
+    brandelion analyze --network --brand-followers <file> ((--exemplar-followers <file>)... | --exemplar-manifest <file>) --output <file> [--network-method <string>  --min-followers <n> --max-followers <n>  --sample-exemplars <p> --seed <s> --index-dir <dir> --top-k <k> --bloom <p> --partitions <n> --tmp-dir <dir> --shard <i/n> --backend <name> --max-memory <mb> --metrics <file> --profile <stage>]
+    brandelion analyze --network --precompute --brand-followers <file> ((--exemplar-followers <file>)... | --exemplar-manifest <file>) --index-dir <dir> [--network-method <string>  --min-followers <n> --max-followers <n>  --sample-exemplars <p> --seed <s> --bloom <p> --metrics <file> --profile <stage>]
 
 Options
     -h, --help
     --brand-followers <file>      File containing follower data for brand accounts.
     --brand-tweets <file>         File containing tweets from brand accounts.
-    --exemplar-followers <file>   File containing follower data for exemplar accounts.
+    --exemplar-followers <file>   File containing follower data for exemplar accounts. Repeat to score several categories of exemplars at once.
+    --exemplar-manifest <file>    File listing "<category> <exemplar follower file>" lines, to score all categories at once.
     --exemplar-tweets <file>      File containing tweets from exemplar accounts.
     --sample-tweets <file>        File containing tweets from representative sample of Twitter.
     --text-method <string>        Method to do text analysis [default: chi2]
+    --features <spec>             Fit and score with these features instead of bigrams; repeat to compare several, reading and tokenizing the tweets once. See parse_features for the spec, e.g., tags:ngrams=1,min_df=2,hashtags. Each one's scores go to --output with .<name> before its extension.
+    --save-model <file>           Save the selected ngrams and their scores to this file, to score more brands with --text-model.
+    --text-model <file>           Score brands with a model saved by --save-model, without refitting.
+    --text-stats <dir>            Directory of daily bigram document frequencies of exemplar and sample tweets. New exemplar and sample tweets are added to it, and chi2 is refit from it.
+    --window <days>               With --text-stats, forget days older than this many days before the newest one.
+    --since <day>                 Only score brand tweets created on or after this day (YYYY-MM-DD). Of brand tweets partitioned by brandelion partition, only the partitions in range are read.
+    --until <day>                 Only score brand tweets created on or before this day (YYYY-MM-DD).
+    --rolling <n>                 Instead, write "<brand> <period> <score>" lines scoring each brand over each window of n days (or weeks, for weekly partitions) ending with period.
     --network-method <string>     Method to do text analysis [default: jaccard]
     -o, --output <file>           File to store results
     -t, --text                    Analyze text of tweets.
@@ -22,64 +34,86 @@ Options
     --max-followers <n>           Ignore exemplars that have more than least n followers [default: 1e10]
     --sample-exemplars <p>        Sample p percent of the exemplars, uniformly at random. [default: 100]
     --seed <s>                    Seed for random sampling. [default: 12345]
+    --index-dir <dir>             Directory in which to save exemplar indexes (e.g., rarity weights) for reuse across runs.
+    --top-k <k>                   Only output the k highest scoring brands, best first.
+    --bloom <p>                   Approximate merge methods with a Bloom filter with false positive rate p.
+    --partitions <n>              Score out of core, hash partitioning followers into n buckets on disk (jaccard, proportion and cosine methods).
+    --tmp-dir <dir>               Directory for the out-of-core buckets (defaults to the system temp directory).
+    --shard <i/n>                 Only score the ith of n shards of the brands (0 <= i < n); combine the outputs with brandelion merge.
+    --backend <name>              Score with sets, index or out-of-core, or choose whichever is estimated fastest and fits in memory from the sizes of the follower files [default: auto]
+    --max-memory <mb>             Memory the auto backend may plan to use, in MB (defaults to 80% of the available memory).
+    --precompute                  Save the indexes that shards share (rarity weights, merged and inverted exemplar indexes, adamic degrees) to --index-dir.
+    --metrics <file>              Write the wall time, CPU time, peak memory and throughput of each stage to this json file.
+    --profile <stage>             Run this stage (e.g., score or chi2) under cProfile, saving its stats next to --metrics.
 """
 
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict
+import datetime
 from docopt import docopt
 import io
 from itertools import groupby
-import gzip
+import itertools
+import hashlib
+import heapq
 import json
 import math
 import numpy as np
 import os
 import re
 import random
-from scipy.sparse import vstack
 import sys
 
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.feature_selection import chi2 as skchi2
-from sklearn import linear_model
-
-from . import report
+from . import metrics, partition, reader, report
 
 ### TEXT ANALYSIS ###
 
 
-def parse_json(json_file, include_date=False):
-    """ Yield screen_name, text tuples from a json file. """
-    if json_file[-2:] == 'gz':
-        fh = gzip.open(json_file, 'rt')
-    else:
-        fh = io.open(json_file, mode='rt', encoding='utf8')
-    for line in fh:
+def iter_json(json_file):
+    """ Yield the tweets in a json file, which may be gzipped. """
+    for line in reader.iter_lines(json_file):
         try:
             jj = json.loads(line)
-            if type(jj) is not list:
-                jj = [jj]
-            for j in jj:
-                if include_date:
-                    yield (j['user']['screen_name'].lower(), j['text'], j['created_at'])
-                else:
-                    if 'full_text' in j: # get untruncated text if available.
-                        yield (j['user']['screen_name'].lower(), j['full_text'])
-                    else:
-                        yield (j['user']['screen_name'].lower(), j['text'])
+        except Exception as e:
+            sys.stderr.write('skipping json error: %s\n' % e)
+            continue
+        for j in (jj if type(jj) is list else [jj]):
+            yield j
+
+
+def parse_json(json_file, include_date=False, since=None, until=None):
+    """ Yield screen_name, text tuples from a json file, which may be gzipped,
+    or from a directory of tweet partitions. If since or until is set, only
+    tweets created on days between them, inclusive, are kept; of partitions,
+    only those in range are read. """
+    if partition.is_partitioned(json_file):
+        tweets = partition.read_tweets(json_file, since, until)
+        since = until = None  # already filtered.
+    else:
+        tweets = iter_json(json_file)
+    for j in tweets:
+        try:
+            text = j['full_text'] if 'full_text' in j else j['text']  # get untruncated text if available.
+            if (since or until) and not partition.in_range(partition.tweet_day(j['created_at']), since, until):
+                continue
+            if include_date:
+                yield (j['user']['screen_name'].lower(), text, j['created_at'])
+            else:
+                yield (j['user']['screen_name'].lower(), text)
 
         except Exception as e:
             sys.stderr.write('skipping json error: %s\n' % e)
 
 
-def extract_tweets(json_file):
+def extract_tweets(json_file, since=None, until=None):
     """ Yield screen_name, string tuples, where the string is the
-    concatenation of all tweets of this user. """
-    for screen_name, tweet_iter in groupby(parse_json(json_file), lambda x: x[0]):
+    concatenation of all tweets of this user (created between since and
+    until, if set). """
+    for screen_name, tweet_iter in groupby(parse_json(json_file, since=since, until=until), lambda x: x[0]):
         tweets = [t[1] for t in tweet_iter]
         yield screen_name, ' '.join(tweets)
 
 
-def preprocess(s):
+def preprocess(s, hashtag='hashtag'):
     """
     >>> preprocess('#hi there http://www.foo.com @you isn"t RT &lt;&gt;')
     'hashtaghi hashtaghi there isn"t'
@@ -88,7 +122,7 @@ def preprocess(s):
     s = re.sub(r'@\S+', ' ', s)  # map all mentions to thisisamention
     # s = re.sub('http\S+', 'http', s)  # keep only http from urls
     s = re.sub(r'http\S+', ' ', s)  # keep only http from urls
-    s = re.sub(r'#(\S+)', r'hashtag\1 hashtag\1', s)  # #foo -> hashtagfoo hashtagfoo (for retaining hashtags even using bigrams)
+    s = re.sub(r'#(\S+)', r'%s\1 %s\1' % (hashtag, hashtag), s)  # #foo -> hashtagfoo hashtagfoo (for retaining hashtags even using bigrams)
     # s = re.sub(r'[0-9]+', '9', s)  # 1234 -> 9
     s = re.sub(r'\bRT\b', ' ', s, re.IGNORECASE)
     s = re.sub(r'&[a-z]+;', ' ', s, re.IGNORECASE)
@@ -96,20 +130,42 @@ def preprocess(s):
     return s.lower()
 
 
+def as_documents(docs):
+    """ Yield screen_name, string tuples from a dict or an iterable of pairs
+    whose values are a string or a list of tweets.
+    >>> list(as_documents({'a': ['hi there', 'bye']}))
+    [('a', 'hi there bye')]
+    """
+    for screen_name, text in (docs.items() if isinstance(docs, dict) else docs):
+        yield screen_name, text if isinstance(text, str) else ' '.join(text)
+
+
+def vectorize_documents(docs, vec, dofit=True):
+    """ Return the screen names in docs and a matrix where each row corresponds
+    to one of them, and each column corresponds to the number of times a term
+    is used by that account. docs are streamed once. """
+    screen_names = []
+
+    def texts():
+        for screen_name, text in as_documents(docs):
+            screen_names.append(screen_name)
+            yield text
+    X = vec.fit_transform(texts()) if dofit else vec.transform(texts())
+    return screen_names, X
+
+
 def vectorize(json_file, vec, dofit=True):
     """ Return a matrix where each row corresponds to a Twitter account, and
     each column corresponds to the number of times a term is used by that
     account. """
-    ## CountVectorizer, efficiently.
-    screen_names = [x[0] for x in extract_tweets(json_file)]
-    if dofit:
-        X = vec.fit_transform(x[1] for x in extract_tweets(json_file))
-    else:
-        X = vec.transform(x[1] for x in extract_tweets(json_file))
-    return screen_names, X
+    return vectorize_documents(extract_tweets(json_file), vec, dofit)
 
 
 def chi2(exemplars, samples, n=300):
+    from scipy.sparse import vstack
+    from sklearn.feature_selection import chi2 as skchi2
+    from sklearn import linear_model
+
     y = np.array(([1.] * exemplars.shape[0]) + ([.0] * samples.shape[0]))
     X = vstack((exemplars, samples)).tocsr()
     clf = linear_model.LogisticRegression(penalty='l2')
@@ -130,6 +186,7 @@ def do_score(vec, coef):
 
 
 def write_top_words(fname, vocab, scores):
+    mkdirs(fname)
     outf = io.open(fname, 'w', encoding='utf8')
     for i in np.argsort(scores)[::-1]:
         if scores[i] > 0:
@@ -137,87 +194,805 @@ def write_top_words(fname, vocab, scores):
     outf.close()
 
 
-def analyze_text(brand_tweets_file, exemplar_tweets_file, sample_tweets_file, outfile, analyze_fn):
-    analyze = getattr(sys.modules[__name__], analyze_fn)
+def vocabulary(vec):
+    """ Return the ngram of each column of a fitted vectorizer. """
+    if hasattr(vec, 'get_feature_names_out'):
+        return list(vec.get_feature_names_out())
+    return vec.get_feature_names()
+
+
+def save_text_model(fname, vec, coef, analyze_fn, ngram_range=None, hashtags=False):
+    """ Save the ngrams with positive scores, and their scores, as json. This
+    is all that load_text_model needs to score brands. Vectorizers with a
+    feature_analyzer need its ngram_range and hashtags settings. """
+    vocab = vocabulary(vec)
+    keep = [i for i in range(len(vocab)) if coef[i] > 0]
+    model = {'method': analyze_fn, 'ngram_range': list(ngram_range or vec.ngram_range),
+             'vocabulary': [vocab[i] for i in keep], 'coef': [float(coef[i]) for i in keep]}
+    if hashtags:
+        model['hashtags'] = True
+    mkdirs(fname)
+    with report.atomic_open(fname, 'wt', encoding='utf8') as f:
+        f.write(json.dumps(model, ensure_ascii=False))
+    print('saved text model with %d ngrams to %s' % (len(keep), fname))
+
+
+def load_text_model(fname):
+    """ Return a vectorizer that only counts the ngrams of a model saved by
+    save_text_model (or listed in a .topwords file), and their scores. """
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    with io.open(fname, 'rt', encoding='utf8') as f:
+        text = f.read()
+    if text.startswith('{'):
+        model = json.loads(text)
+    else:  # "<ngram> <score>" lines, as written by write_top_words.
+        lines = [line.rsplit(' ', 1) for line in text.splitlines() if ' ' in line]
+        model = {'ngram_range': [2, 2], 'vocabulary': [ngram for ngram, _ in lines],
+                 'coef': [float(score) for _, score in lines]}
+    if model.get('hashtags'):
+        vec = CountVectorizer(vocabulary=model['vocabulary'], binary=True,
+                              analyzer=feature_analyzer(tuple(model['ngram_range']), True))
+    else:
+        vec = CountVectorizer(vocabulary=model['vocabulary'], preprocessor=preprocess,
+                              ngram_range=tuple(model['ngram_range']), binary=True)
+    return vec, np.array(model['coef'], dtype=float)
+
 
+def fit_text(exemplar_docs, sample_docs, analyze_fn='chi2'):
+    """ Fit a bigram vectorizer to the exemplars' documents and return it
+    with analyze_fn's score for each ngram, which score_text can reuse for
+    any number of brands. Documents are (screen_name, text) pairs or a dict. """
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    analyze = getattr(sys.modules[__name__], analyze_fn)
     vec = CountVectorizer(min_df=3, preprocessor=preprocess, ngram_range=(2, 2), binary=True)
-    _, exemplar_vectors = vectorize(exemplar_tweets_file, vec, dofit=True)
+    with metrics.stage('vectorize_exemplars') as info:
+        _, exemplar_vectors = vectorize_documents(exemplar_docs, vec, dofit=True)
+        info['records'] = exemplar_vectors.shape[0]
     print('read tweets for %d exemplar accounts' % exemplar_vectors.shape[0])
-    brands, brand_vectors = vectorize(brand_tweets_file, vec, dofit=False)
-    print('read tweets for %d brand accounts' % brand_vectors.shape[0])
-    _, sample_vectors = vectorize(sample_tweets_file, vec, dofit=False)
+    with metrics.stage('vectorize_samples') as info:
+        _, sample_vectors = vectorize_documents(sample_docs, vec, dofit=False)
+        info['records'] = sample_vectors.shape[0]
     print('read tweets for %d sample accounts' % sample_vectors.shape[0])
+    with metrics.stage(analyze_fn) as info:
+        coef = analyze(exemplar_vectors, sample_vectors)
+        info['records'] = exemplar_vectors.shape[0] + sample_vectors.shape[0]
+    return vec, coef
+
+
+def score_text(brand_docs, vec, coef):
+    """ Return arrays of the brands' screen names and their scores under the
+    ngram scores coef from fit_text. """
+    with metrics.stage('vectorize_brands') as info:
+        brands, brand_vectors = vectorize_documents(brand_docs, vec, dofit=False)
+        info['records'] = brand_vectors.shape[0]
+    print('read tweets for %d brand accounts' % brand_vectors.shape[0])
+    with metrics.stage('score') as info:
+        info['records'] = len(brands)
+        return score_arrays((brand, do_score(brand_vec, coef)) for brand, brand_vec in zip(brands, brand_vectors))
 
-    scores = analyze(exemplar_vectors, sample_vectors)
-    vocab = vec.get_feature_names()
+
+def score_arrays(results):
+    """ Return arrays of the names and scores in a list of (name, score) pairs.
+    >>> score_arrays([('a', 0.5), ('b', 0.25)])
+    (array(['a', 'b'], dtype='<U1'), array([0.5 , 0.25]))
+    """
+    results = list(results)
+    return (np.array([name for name, _ in results], dtype=str),
+            np.array([score for _, score in results], dtype=float))
+
+
+# TEXT STATISTICS
+
+
+def count_document_frequencies(json_file):
+    """ Return a dict from day to the number of documents that day, and a
+    Counter of the number of documents containing each bigram. A document is
+    the tweets of one account on one day. """
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    ngrams = CountVectorizer(preprocessor=preprocess, ngram_range=(2, 2)).build_analyzer()
+    texts = defaultdict(list)
+    for screen_name, text, created_at in parse_json(json_file, include_date=True):
+        texts[(partition.tweet_day(created_at), screen_name)].append(text)
+    days = {}
+    for (day, screen_name), tweets in texts.items():
+        ndocs, counts = days.setdefault(day, [0, Counter()])
+        days[day][0] += 1
+        counts.update(set(ngrams(' '.join(tweets))))
+    return days
+
+
+def text_stats_path(stats_dir, label, day):
+    return os.path.join(stats_dir, label, day + '.json')
+
+
+def file_fingerprint(fname):
+    """ Return a hash of the contents of a file, or of the index of a directory of tweet partitions. """
+    if partition.is_partitioned(fname):
+        fname = os.path.join(fname, partition.INDEX)
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def read_ingested(stats_dir):
+    """ Return a dict from class label to a dict from the fingerprint of each
+    file added to its tables to the file's name and days. """
+    path = os.path.join(stats_dir, 'ingested.json')
+    if not os.path.exists(path):
+        return {}
+    with io.open(path, 'rt', encoding='utf8') as f:
+        return json.load(f)
+
+
+def update_text_stats(stats_dir, label, json_file):
+    """ Add the document frequencies of the tweets in json_file to the daily
+    tables of class label ('exemplars' or 'samples') in stats_dir. A file
+    whose contents were already added is skipped, so rerunning with the same
+    files doesn't count their tweets twice; new tweets go in new files. """
+    fingerprint = file_fingerprint(json_file)
+    previous = read_ingested(stats_dir).get(label, {}).get(fingerprint)
+    if previous:
+        print('skipping %s tweets from %s, already added from %s' % (label, json_file, previous['file']))
+        return
+    days = count_document_frequencies(json_file)
+    for day, (day_docs, day_df) in sorted(days.items()):
+        path = text_stats_path(stats_dir, label, day)
+        table = {'docs': 0, 'df': {}}
+        if os.path.exists(path):
+            with io.open(path, 'rt', encoding='utf8') as f:
+                table = json.load(f)
+        total_df = Counter(table['df'])
+        total_df.update(day_df)
+        mkdirs(path)
+        with report.atomic_open(path, 'wt', encoding='utf8') as f:
+            f.write(json.dumps({'docs': table['docs'] + day_docs, 'df': total_df}, ensure_ascii=False))
+    ingested = read_ingested(stats_dir)
+    ingested.setdefault(label, {})[fingerprint] = {'file': json_file, 'days': sorted(days)}
+    mkdirs(os.path.join(stats_dir, 'ingested.json'))
+    partition.write_json(os.path.join(stats_dir, 'ingested.json'), ingested)
+    print('added %d days of %s tweets from %s' % (len(days), label, json_file))
+
+
+def text_stats_days(stats_dir, label):
+    """ Return the sorted days with a table for class label. """
+    path = os.path.join(stats_dir, label)
+    if not os.path.isdir(path):
+        return []
+    return sorted(f[:-5] for f in os.listdir(path) if f.endswith('.json'))
+
+
+def expire_text_stats(stats_dir, window):
+    """ Delete the tables of days more than window days before the newest day of either class. """
+    days = text_stats_days(stats_dir, 'exemplars') + text_stats_days(stats_dir, 'samples')
+    if not days:
+        return
+    first = (datetime.datetime.strptime(max(days), '%Y-%m-%d') - datetime.timedelta(days=window - 1)).strftime('%Y-%m-%d')
+    for label in ('exemplars', 'samples'):
+        for day in text_stats_days(stats_dir, label):
+            if day < first:
+                os.remove(text_stats_path(stats_dir, label, day))
+                print('expired %s tweets of %s' % (label, day))
+
+
+def read_text_stats(stats_dir, label):
+    """ Return the number of documents of class label and a Counter of bigram
+    document frequencies, summed over its daily tables. """
+    ndocs, counts = 0, Counter()
+    for day in text_stats_days(stats_dir, label):
+        with io.open(text_stats_path(stats_dir, label, day), 'rt', encoding='utf8') as f:
+            table = json.load(f)
+        ndocs += table['docs']
+        counts.update(table['df'])
+    return ndocs, counts
+
+
+def chi2_from_stats(exemplar_stats, sample_stats, n=300, min_df=3):
+    """ Return the bigrams used by at least min_df exemplar documents, and
+    their chi2 statistics, computed from document frequencies as sklearn's
+    chi2 does from binary features. Only the n best bigrams that exemplars
+    use more often than samples get a nonzero score.
+    >>> vocab, scores = chi2_from_stats((4, Counter({'a b': 4, 'b c': 3})), (4, Counter({'b c': 4})))
+    >>> vocab, scores.tolist()
+    (['a b', 'b c'], [4.0, 0.0])
+    """
+    (nexemplars, exemplar_df), (nsamples, sample_df) = exemplar_stats, sample_stats
+    vocab = sorted(ngram for ngram, df in exemplar_df.items() if df >= min_df)
+    observed = np.array([[exemplar_df[v] for v in vocab], [sample_df.get(v, 0) for v in vocab]], dtype=float).reshape(2, len(vocab))
+    class_prob = np.array([[nexemplars], [nsamples]], dtype=float) / (nexemplars + nsamples)
+    expected = class_prob * observed.sum(axis=0)
+    chis = ((observed - expected) ** 2 / expected).sum(axis=0)
+    positive = observed[0] / nexemplars > observed[1] / max(nsamples, 1)
+    scores = np.zeros(len(vocab))
+    top = [i for i in chis.argsort()[::-1] if positive[i]][:n]
+    scores[top] = chis[top]
+    return vocab, scores
+
+
+def fit_text_stats(stats_dir, n=300):
+    """ Return a vectorizer of the selected bigrams and their chi2 scores, refit from the tables in stats_dir. """
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    with metrics.stage('chi2') as info:
+        exemplar_stats = read_text_stats(stats_dir, 'exemplars')
+        sample_stats = read_text_stats(stats_dir, 'samples')
+        if exemplar_stats[0] == 0 or sample_stats[0] == 0:
+            raise ValueError('%s needs both exemplar and sample tweets' % stats_dir)
+        vocab, scores = chi2_from_stats(exemplar_stats, sample_stats, n)
+        info['records'] = len(vocab)
+    print('refit chi2 from %d exemplar and %d sample documents' % (exemplar_stats[0], sample_stats[0]))
+    keep = np.nonzero(scores > 0)[0]
+    vec = CountVectorizer(vocabulary=[vocab[i] for i in keep], preprocessor=preprocess, ngram_range=(2, 2), binary=True)
+    return vec, scores[keep]
+
+
+def analyze_text_stats(stats_dir, exemplar_tweets_file=None, sample_tweets_file=None, window=None,
+                       brand_tweets_file=None, outfile=None, model_file=None, since=None, until=None, rolling=None):
+    """ Fold new exemplar and sample tweets into the tables in stats_dir, drop
+    days outside the window, refit chi2 from the tables, and save the model
+    and/or score brands with it. Historic tweets are never reread. """
+    with metrics.stage('update_stats'):
+        if exemplar_tweets_file:
+            update_text_stats(stats_dir, 'exemplars', exemplar_tweets_file)
+        if sample_tweets_file:
+            update_text_stats(stats_dir, 'samples', sample_tweets_file)
+        if window:
+            expire_text_stats(stats_dir, window)
+    vec, coef = fit_text_stats(stats_dir)
+    if model_file:
+        save_text_model(model_file, vec, coef, 'chi2')
+    if brand_tweets_file and outfile:
+        score_brand_tweets(brand_tweets_file, vec, coef, outfile, since, until, rolling)
+
+
+def analyze_text(brand_tweets_file, exemplar_tweets_file, sample_tweets_file, outfile, analyze_fn, model_file=None,
+                 since=None, until=None, rolling=None):
+    """ Fit a text model to the exemplar and sample tweets, and write the
+    scores of the brands to outfile. If model_file is set, save the model
+    there, to score other brands with score_text_file. """
+    vec, scores = fit_text(metrics.timed(extract_tweets(exemplar_tweets_file), 'read_exemplar_tweets'),
+                           metrics.timed(extract_tweets(sample_tweets_file), 'read_sample_tweets'), analyze_fn)
+    vocab = vocabulary(vec)
     write_top_words(outfile + '.topwords', vocab, scores)
+    if model_file:
+        save_text_model(model_file, vec, scores, analyze_fn)
     print('top 10 ngrams:\n', '\n'.join(['%s=%.4g' % (vocab[i], scores[i]) for i in np.argsort(scores)[::-1][:10]]))
-    outf = open(outfile, 'wt')
-    for bi, brand_vec in enumerate(brand_vectors):
-        outf.write('%s %g\n' % (brands[bi], do_score(brand_vec, scores)))
-        outf.flush()
+    score_brand_tweets(brand_tweets_file, vec, scores, outfile, since, until, rolling)
+
+
+def score_text_file(brand_tweets_file, model_file, outfile, since=None, until=None, rolling=None):
+    """ Write the scores of the brands under a saved text model to outfile.
+    Brand tweets are streamed through a vectorizer of just the model's ngrams. """
+    vec, coef = load_text_model(model_file)
+    print('loaded text model with %d ngrams' % len(coef))
+    score_brand_tweets(brand_tweets_file, vec, coef, outfile, since, until, rolling)
+
+
+def write_text_scores(outfile, brands, brand_scores):
+    mkdirs(outfile)
+    with metrics.stage('write') as info:
+        outf = open(outfile, 'wt')
+        for brand, score in zip(brands, brand_scores):
+            outf.write('%s %g\n' % (brand, score))
+        outf.close()
+        info['records'] = len(brands)
+
+
+# TIME WINDOWS
+
+
+def period_documents(json_file, since=None, until=None):
+    """ Return the period of the tweets in json_file ('day', or the period of
+    its partitions), and a generator of (period, screen_name, string) tuples,
+    where the string is the concatenation of the account's tweets in that
+    period. Partitions are read one at a time. """
+    index = partition.read_index(json_file)
+    if index:
+        sources = [(key, os.path.join(json_file, index['partitions'][key]['file']))
+                   for key in partition.partitions_in_range(index, since, until)]
+    else:
+        sources = [(None, json_file)]
+
+    def documents():
+        for key, fname in sources:
+            for screen_name, tweets in groupby(parse_json(fname, True, since, until), lambda x: x[0]):
+                texts = {}
+                for _, text, created_at in tweets:
+                    texts.setdefault(key or partition.tweet_day(created_at), []).append(text)
+                for period, period_texts in texts.items():
+                    yield period, screen_name, ' '.join(period_texts)
+    return index['period'] if index else 'day', documents()
+
+
+def rolling_scores(brand_tweets_file, vec, coef, window, since=None, until=None, batch_size=10000):
+    """ Return (screen_name, period, score) tuples of each brand's score over
+    each window of window consecutive periods, ending with period, in which it
+    tweeted. Each period's tweets are vectorized once, and only the ngrams
+    with scores are kept, counting the periods in the window that use each.
+    Sliding the window adds one period's counts and subtracts another's.
+    An account's tweets of a period are combined even if they are not
+    together in the file, but ngrams spanning tweets that are not next to each
+    other, such as the last tweet of one period and the first of the next, are not counted, so a single window over all tweets can score slightly
+    lower than score_text. """
+    period, documents = period_documents(brand_tweets_file, since, until)
+    columns = np.nonzero(coef)[0]
+    weights = coef[columns]
+    total = np.sum(coef)
+    present = defaultdict(dict)  # screen_name -> period -> indices into columns of the ngrams used.
+    batch = []
+
+    def add_batch():
+        X = vec.transform([text for _, _, text in batch])[:, columns].tocsr()
+        for (key, screen_name, _), i in zip(batch, range(X.shape[0])):
+            used = X.indices[X.indptr[i]:X.indptr[i + 1]]
+            if key in present[screen_name]:  # more tweets of the period, from elsewhere in the file.
+                used = np.union1d(present[screen_name][key], used)
+            present[screen_name][key] = used
+        del batch[:]
+    with metrics.stage('vectorize_brands') as info:
+        info['records'] = 0
+        for doc in documents:
+            batch.append(doc)
+            info['records'] += 1
+            if len(batch) == batch_size:
+                add_batch()
+        if batch:
+            add_batch()
+    keys = set(key for periods in present.values() for key in periods)
+    print('read tweets for %d brand accounts in %d %ss' % (len(present), len(keys), period))
+    if not keys:
+        return []
+    keys = partition.period_keys(since or min(keys), until or max(keys), period)
+    results = []
+    with metrics.stage('score') as info:
+        for screen_name, periods in present.items():
+            counts = np.zeros(len(columns), dtype=int)
+            nperiods = 0
+            for i, key in enumerate(keys):
+                if key in periods:
+                    counts[periods[key]] += 1
+                    nperiods += 1
+                if i >= window and keys[i - window] in periods:
+                    counts[periods[keys[i - window]]] -= 1
+                    nperiods -= 1
+                if i >= window - 1 and nperiods:
+                    results.append((screen_name, key, np.sum(weights[counts > 0]) / total))
+        info['records'] = len(results)
+    if len(keys) < window:
+        print('only %d %ss of tweets; none are scored over a window of %d' % (len(keys), period, window))
+    return results
+
+
+def day_range(since, until):
+    """ Return since and until as YYYY-MM-DD days, or None, raising ValueError if they aren't dates.
+    >>> day_range('2015-1-2', None)
+    ('2015-01-02', None)
+    """
+    return tuple(partition.parse_day(day).isoformat() if day else None for day in (since, until))
+
+
+def score_brand_tweets(brand_tweets_file, vec, coef, outfile, since=None, until=None, rolling=None):
+    """ Write the scores of the brands in brand_tweets_file to outfile, over
+    their tweets created between since and until (YYYY-MM-DD), or, if rolling
+    is set, as a time series of their scores over windows of rolling periods. """
+    since, until = day_range(since, until)
+    if not rolling:
+        brand_docs = metrics.timed(extract_tweets(brand_tweets_file, since, until), 'read_brand_tweets')
+        return write_text_scores(outfile, *score_text(brand_docs, vec, coef))
+    results = rolling_scores(brand_tweets_file, vec, coef, rolling, since, until)
+    mkdirs(outfile)
+    with metrics.stage('write') as info:
+        with io.open(outfile, 'wt', encoding='utf8') as outf:
+            for screen_name, key, score in results:
+                outf.write('%s %s %g\n' % (screen_name, key, score))
+        info['records'] = len(results)
+
+
+# FEATURE CONFIGURATIONS
+
+
+def parse_features(spec):
+    """ Return the name, ngram range, min_df and hashtags-only flag of a
+    --features spec, [<name>:]<option>,... where the options are ngrams=<n>
+    or ngrams=<n>-<m> (default 2), min_df=<n> (default 3) and hashtags.
+    >>> parse_features('tags:ngrams=1,min_df=2,hashtags')
+    ('tags', (1, 1), 2, True)
+    >>> parse_features('ngrams=1-2')
+    ('ngrams_1-2', (1, 2), 3, False)
+    """
+    name, _, options = spec.rpartition(':')
+    ngram_range, min_df, hashtags = (2, 2), 3, False
+    for option in options.split(','):
+        key, _, value = option.partition('=')
+        if key == 'ngrams' and value:
+            low, _, high = value.partition('-')
+            ngram_range = (int(low), int(high or low))
+        elif key == 'min_df' and value:
+            min_df = int(value)
+        elif key == 'hashtags' and not value:
+            hashtags = True
+        elif option:
+            raise ValueError('unknown option %s in --features %s' % (option, spec))
+    return name or re.sub(r'[^\w-]+', '_', options), ngram_range, min_df, hashtags
+
+
+def feature_path(fname, name):
+    """
+    >>> feature_path('out/scores.txt', 'unigrams')
+    'out/scores.unigrams.txt'
+    """
+    root, ext = os.path.splitext(fname)
+    return '%s.%s%s' % (root, name, ext)
+
+
+class Hashtag(str):
+    """ A token that preprocess made from a hashtag. """
+
+
+def tokenize(text, mark_hashtags=False):
+    """ Return the tokens of a document, after preprocess, as CountVectorizer
+    splits them. If mark_hashtags is set, the tokens made from hashtags are
+    Hashtags, found as the tokens that change when preprocess gives hashtags
+    another prefix, so that words such as 'hashtags' aren't taken for them.
+    >>> tokenize('Hello #world, hi')
+    ['hello', 'hashtagworld', 'hashtagworld', 'hi']
+    >>> [type(token).__name__ for token in tokenize('#s hashtags', True)]
+    ['Hashtag', 'Hashtag', 'str']
+    """
+    tokens = re.findall(r'(?u)\b\w\w+\b', preprocess(text))
+    if mark_hashtags:
+        others = re.findall(r'(?u)\b\w\w+\b', preprocess(text, 'hashtah'))
+        tokens = [Hashtag(token) if token != other else token for token, other in zip(tokens, others)]
+    return tokens
+
+
+def feature_analyzer(ngram_range=(2, 2), hashtags=False):
+    """ Return a function from a document, given as its tokens or as text, to
+    its ngrams, as CountVectorizer's word analyzer makes them. If hashtags is
+    set, only the tokens made from hashtags are kept, so tokens must be
+    marked by tokenize.
+    >>> feature_analyzer((1, 2))(['a', 'bb', 'cc'])
+    ['a', 'bb', 'cc', 'a bb', 'bb cc']
+    >>> feature_analyzer((1, 1), hashtags=True)('#eco hashtags')
+    ['hashtageco', 'hashtageco']
+    """
+    low, high = ngram_range
+
+    def analyze(doc):
+        tokens = tokenize(doc, hashtags) if isinstance(doc, str) else doc
+        if hashtags:
+            tokens = [token for token in tokens if isinstance(token, Hashtag)]
+        ngrams = [str(token) for token in tokens] if low == 1 else []
+        for n in range(max(low, 2), high + 1):
+            ngrams.extend(' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+        return ngrams
+    return analyze
+
+
+def tokenize_documents(docs, mark_hashtags=False):
+    """ Return the screen names in docs and a list of each one's tokens.
+    Equal tokens share one string, to keep the lists small. """
+    names, token_lists, strings = [], [], {}
+    for screen_name, text in as_documents(docs):
+        names.append(screen_name)
+        if mark_hashtags:  # a Hashtag equals the same word, so keep them apart.
+            token_lists.append([strings.setdefault((type(token), token), token) for token in tokenize(text, True)])
+        else:
+            token_lists.append([strings.setdefault(token, token) for token in tokenize(text)])
+    return names, token_lists
+
+
+def check_features(features):
+    """ Raise a ValueError unless the feature configurations have distinct
+    names, which name their output files. """
+    names = [name for name, _, _, _ in features]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError('--features names must be distinct, but these repeat: %s' % ', '.join(duplicates))
+
+
+def fit_text_features(exemplar_docs, sample_docs, features, analyze_fn='chi2'):
+    """ Fit a vectorizer, and analyze_fn's score for each ngram, for each of
+    the feature configurations from parse_features, as fit_text does for
+    bigrams, but reading and tokenizing the documents once for all of them.
+    Return a list of (vec, coef) pairs; each vec takes tokens or text. A
+    configuration that cannot be fit (e.g., if min_df leaves no ngrams) is
+    reported, and its pair is None. """
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    analyze = getattr(sys.modules[__name__], analyze_fn)
+    mark_hashtags = any(hashtags for _, _, _, hashtags in features)
+    with metrics.stage('tokenize_exemplars') as info:
+        _, exemplar_tokens = tokenize_documents(exemplar_docs, mark_hashtags)
+        info['records'] = len(exemplar_tokens)
+    print('read tweets for %d exemplar accounts' % len(exemplar_tokens))
+    with metrics.stage('tokenize_samples') as info:
+        _, sample_tokens = tokenize_documents(sample_docs, mark_hashtags)
+        info['records'] = len(sample_tokens)
+    print('read tweets for %d sample accounts' % len(sample_tokens))
+    models = []
+    for name, ngram_range, min_df, hashtags in features:
+        try:
+            with metrics.stage('vectorize_' + name) as info:
+                vec = CountVectorizer(analyzer=feature_analyzer(ngram_range, hashtags), min_df=min_df, binary=True)
+                exemplar_vectors = vec.fit_transform(exemplar_tokens)
+                sample_vectors = vec.transform(sample_tokens)
+                info['records'] = len(exemplar_tokens) + len(sample_tokens)
+            with metrics.stage('%s_%s' % (analyze_fn, name)) as info:
+                models.append((vec, analyze(exemplar_vectors, sample_vectors)))
+                info['records'] = len(exemplar_tokens) + len(sample_tokens)
+        except ValueError as e:
+            print('cannot fit features %s: %s' % (name, e))
+            models.append(None)
+    return models
+
+
+def score_text_features(brand_docs, models, mark_hashtags=False):
+    """ Return an array of the brands' screen names, and a list of arrays of
+    their scores under each (vec, coef) in models, tokenizing each brand once.
+    mark_hashtags must be set if any vec keeps only hashtags. """
+    with metrics.stage('tokenize_brands') as info:
+        brands, brand_tokens = tokenize_documents(brand_docs, mark_hashtags)
+        info['records'] = len(brands)
+    print('read tweets for %d brand accounts' % len(brands))
+    with metrics.stage('score') as info:
+        scores = [np.array([do_score(row, coef) for row in vec.transform(brand_tokens)], dtype=float)
+                  for vec, coef in models]
+        info['records'] = len(brands) * len(models)
+    return np.array(brands, dtype=str), scores
+
+
+def analyze_text_features(brand_tweets_file, exemplar_tweets_file, sample_tweets_file, outfile, analyze_fn, features,
+                          model_file=None, since=None, until=None, rolling=None):
+    """ Like analyze_text, for each feature configuration from parse_features,
+    writing each one's scores and top words to feature_path(outfile, name),
+    and its model, if model_file is set, to feature_path(model_file, name).
+    The tweets are read once for all configurations, except with rolling,
+    which reads the brand tweets once per configuration. Configurations that
+    cannot be fit are skipped. """
+    check_features(features)
+    models = fit_text_features(metrics.timed(extract_tweets(exemplar_tweets_file), 'read_exemplar_tweets'),
+                               metrics.timed(extract_tweets(sample_tweets_file), 'read_sample_tweets'), features, analyze_fn)
+    fitted = [(feature, model) for feature, model in zip(features, models) if model is not None]
+    if not fitted:
+        raise ValueError('none of the --features could be fit')
+    features, models = [feature for feature, _ in fitted], [model for _, model in fitted]
+    for (name, ngram_range, _, hashtags), (vec, coef) in zip(features, models):
+        vocab = vocabulary(vec)
+        write_top_words(feature_path(outfile, name) + '.topwords', vocab, coef)
+        if model_file:
+            save_text_model(feature_path(model_file, name), vec, coef, analyze_fn, ngram_range, hashtags)
+        print('top ngrams of %s: %s' % (name, ', '.join(vocab[i] for i in np.argsort(coef)[::-1][:5])))
+    if rolling:
+        for (name, _, _, _), (vec, coef) in zip(features, models):
+            score_brand_tweets(brand_tweets_file, vec, coef, feature_path(outfile, name), since, until, rolling)
+        return
+    since, until = day_range(since, until)
+    brands, scores = score_text_features(metrics.timed(extract_tweets(brand_tweets_file, since, until), 'read_brand_tweets'), models,
+                                         any(hashtags for _, _, _, hashtags in features))
+    for (name, _, _, _), brand_scores in zip(features, scores):
+        write_text_scores(feature_path(outfile, name), brands, brand_scores)
 
 
 ### FOLLOWER ANALYSIS ###
 
+
+class NetworkSettings(object):
+    """ How exemplar indexes are kept and used. index_dir is a directory in
+    which to save them for reuse across runs (see --index-dir). If bloom_error
+    is set, merge methods test membership with a Bloom filter with this false
+    positive rate instead of an exact index (see --bloom). backend 'sets'
+    compares each brand with each exemplar's set of followers in turn instead
+    of using the inverted index, which is faster for one or two exemplars
+    (see --backend). """
+
+    def __init__(self, index_dir=None, bloom_error=None, backend='index'):
+        self.index_dir = index_dir
+        self.bloom_error = bloom_error
+        self.backend = backend
+
+
+DEFAULT_SETTINGS = NetworkSettings()
+
+
+def index_follower_file(fname):
+    """ Return a list of (screen_name, n_followers, byte offset) tuples, one
+    per account in a follower file, and save it to the sidecar file
+    <fname>.idx so later reads can skip parsing the follower file. """
+    index = []
+    offset = 0
+    for line in reader.iter_lines(fname):
+        parts = line.split()
+        if len(parts) > 3:
+            index.append((parts[1].decode('utf8').lower(), len(set(parts[2:])), offset))
+        offset += len(line) + 1
+    stat = os.stat(fname)
+    try:
+        with report.atomic_open(fname + '.idx', 'wt', encoding='utf8') as f:
+            f.write(u'# %d %d %d\n' % (stat.st_size, stat.st_mtime_ns, len(index)))
+            for name, n, offset in index:
+                f.write(u'%s %d %d\n' % (name, n, offset))
+    except (IOError, OSError) as e:
+        print('cannot save follower index: %s' % e)
+    return index
+
+
+def read_follower_index(fname):
+    """ Return the (screen_name, n_followers, byte offset) tuples of a
+    follower file, from its sidecar index if it is up to date and complete,
+    otherwise by rebuilding the index. """
+    stat = os.stat(fname)
+    try:
+        with io.open(fname + '.idx', 'rt', encoding='utf8') as f:
+            header = f.readline().split()
+            if header[:3] == ['#', str(stat.st_size), str(stat.st_mtime_ns)] and len(header) == 4:
+                index = [(name, int(n), int(offset)) for name, n, offset in (line.split() for line in f)]
+                if len(index) == int(header[3]):
+                    return index
+    except (IOError, OSError, ValueError):
+        pass
+    return index_follower_file(fname)
+
+
+def follower_file_fingerprint(fname):
+    """ Return a short hash of the accounts and follower counts in a follower
+    file, which is the same on every machine with a copy of the file. """
+    h = hashlib.sha1()
+    for name, n, _ in read_follower_index(fname):
+        h.update(('%s %d\n' % (name, n)).encode('utf8'))
+    return h.hexdigest()[:16]
+
+
+def latest_index(fname):
+    """ Return an ordered dict from each screen name in a follower file to
+    its number of followers and byte offset. Of an account listed more than
+    once (e.g., collected twice), only its last line is kept. """
+    latest = OrderedDict()
+    for name, n, offset in read_follower_index(fname):
+        latest[name] = (n, offset)
+    return latest
+
+
 def get_twitter_handles(fname):
-    handles = set()
-    with open(fname, 'rt') as f:
-        for line in f:
-            handles.add(line[:90].split()[0].lower())
-    return handles
+    """ Return the screen names in a follower file, read from its index. """
+    return set(name for name, _, _ in read_follower_index(fname))
+
+
+def _parse_followers(line):
+    return set(map(int, line.split()[2:]))
+
+
+def read_followers_at(fname, offsets):
+    """ Return a dict from each byte offset in offsets to the follower ids on
+    the line of the follower file starting there. We seek to each line of an
+    uncompressed file, but stream a gzipped one, parsing only those lines. """
+    if reader.is_compressed(fname):
+        wanted = set(offsets)
+        found = {}
+        offset = 0
+        for line in reader.iter_lines(fname):
+            if offset in wanted:
+                found[offset] = _parse_followers(line)
+            offset += len(line) + 1
+        return found
+    with open(fname, 'rb') as f:
+        found = {}
+        for offset in offsets:
+            f.seek(offset)
+            found[offset] = _parse_followers(f.readline())
+        return found
+
+
+def read_account(fname, screen_name):
+    """ Return the follower ids of one account in a follower file, or None
+    if it isn't there, reading only that account's line. """
+    offsets = dict((name, offset) for name, _, offset in read_follower_index(fname))
+    if screen_name.lower() not in offsets:
+        return None
+    offset = offsets[screen_name.lower()]
+    return read_followers_at(fname, [offset])[offset]
+
+
+def read_follower_file(fname, min_followers=0, max_followers=1e10, blacklist=set(), names=None):
+    """ Read a file of follower information and return a dictionary mapping screen_name to a set of follower ids.
+    The filters are applied to the file's index, so only the lines of the
+    accounts we keep are parsed. Only the last line of an account listed more than once is used. If names is given, read just those accounts, in that order. """
+    offsets = {}
+    for name, (n, offset) in latest_index(fname).items():
+        if names is not None:
+            offsets[name] = offset
+        elif name not in blacklist:
+            if n > min_followers and n <= max_followers:
+                offsets[name] = offset
+        else:
+            print('skipping exemplar', name)
+    if names is not None:
+        offsets = dict((name, offsets[name]) for name in names if name in offsets)
+    found = read_followers_at(fname, list(offsets.values()))
+    return dict((name, found[offset]) for name, offset in offsets.items())
+
+
+def select_exemplars(fname, min_followers, max_followers, sample_exemplars, blacklist):
+    """ Return the screen names of the exemplars to keep, using only the
+    follower file's index. """
+    names = {}
+    for name, (n, _) in latest_index(fname).items():
+        if name not in blacklist:
+            if n > min_followers and n <= max_followers:
+                names[name] = n
+        else:
+            print('skipping exemplar', name)
+    names = list(names)
+    if sample_exemplars < 100:  # sample a subset of exemplars.
+        names = random.sample(sorted(names), int(len(names) * sample_exemplars / 100.))
+        print('sampled %d exemplars' % (len(names)))
+    return names
 
 
-def read_follower_file(fname, min_followers=0, max_followers=1e10, blacklist=set()):
-    """ Read a file of follower information and return a dictionary mapping screen_name to a set of follower ids. """
-    result = {}
-    with open(fname, 'rt') as f:
-        for line in f:
-            parts = line.split()
-            if len(parts) > 3:
-                if parts[1].lower() not in blacklist:
-                    followers = set(int(x) for x in parts[2:])
-                    if len(followers) > min_followers and len(followers) <= max_followers:
-                        result[parts[1].lower()] = followers
-                else:
-                    print('skipping exemplar', parts[1].lower())
-    return result
+def in_shard(screen_name, shard):
+    """ Return True if this account is in shard (i, n), i.e., the ith of n
+    subsets of accounts split by a hash of their name. Every machine agrees on
+    the split. shard=None means all accounts.
+    >>> [in_shard('7up', (i, 3)) for i in range(3)].count(True)
+    1
+    """
+    return shard is None or int(hashlib.md5(screen_name.encode('utf8')).hexdigest(), 16) % shard[1] == shard[0]
+
+
+def parse_shard(s):
+    """ Return the shard (i, n) written as "i/n", checking that 0 <= i < n.
+    >>> parse_shard('1/3')
+    (1, 3)
+    >>> parse_shard('3/3')
+    Traceback (most recent call last):
+    ...
+    ValueError: --shard must be i/n with 0 <= i < n, not 3/3
+    """
+    parts = s.split('/')
+    if len(parts) != 2 or not all(part.isdigit() for part in parts) or not 0 <= int(parts[0]) < int(parts[1]):
+        raise ValueError('--shard must be i/n with 0 <= i < n, not %s' % s)
+    return int(parts[0]), int(parts[1])
 
 
-def iter_follower_file(fname):
+def iter_follower_file(fname, shard=None):
     """ Iterator from a file of follower information and return a tuple of screen_name, follower ids.
     File format is:
     <iso timestamp> <screen_name> <follower_id1> <follower_ids2> ...
+    If shard=(i, n) is given, only yield the accounts in that shard.
+    The file may be gzipped; it is read and decompressed in the background.
     """
-    with open(fname, 'rt') as f:
-        for line in f:
-            parts = line.split()
-            if len(parts) > 3:
-                yield parts[1].lower(), set(int(x) for x in parts[2:])
+    for line in reader.iter_lines(fname):
+        parts = line.split()
+        if len(parts) > 3:
+            name = parts[1].decode('utf8').lower()
+            if in_shard(name, shard):
+                yield name, set(map(int, parts[2:]))
 
 
-# JACCARD
+class FollowerFile(object):
+    """ A follower file that can be iterated more than once, yielding the
+    same screen_name, follower ids tuples as iter_follower_file. """
 
+    def __init__(self, fname, shard=None):
+        self.fname = fname
+        self.shard = shard
 
-def _jaccard(a, b):
-    """ Return the Jaccard similarity between two sets a and b. """
-    return 1. * len(a & b) / len(a | b)
+    def __iter__(self):
+        return iter_follower_file(self.fname, self.shard)
+
+
+# JACCARD
 
 
 def jaccard(brands, exemplars, weighted_avg=False, sqrt=False):
     """ Return the average Jaccard similarity between a brand's followers and the
     followers of each exemplar. """
-    scores = {}
-    for brand, followers in brands:
-        if weighted_avg:
-            scores[brand] = np.average([_jaccard(followers, others) for others in exemplars.values()],
-                                       weights=[1. / len(others) for others in exemplars.values()])
-        else:
-            scores[brand] = 1. * sum(_jaccard(followers, others) for others in exemplars.values()) / len(exemplars)
-        # limit to exemplars with less than 40k followers:  scores[brand] = 1. * sum(_jaccard(brands[brand], others) for others in exemplars.itervalues() if len(others) < 40000) / len(exemplars)
-    if sqrt:
-        scores = dict([(b, math.sqrt(s)) for b, s in scores.items()])
-    return scores
+    score = set_scorer(exemplars, 'jaccard', weighted_avg, sqrt)
+    return dict((brand, score(followers)) for brand, followers in brands)
 
 
 def jaccard_weighted_avg(brands, exemplars):
@@ -236,51 +1011,52 @@ def jaccard_merge(brands, exemplars):
     """ Return the average Jaccard similarity between a brand's followers and
     the followers of each exemplar. We merge all exemplar followers into one
     big pseudo-account."""
-    scores = {}
-    exemplar_followers = set()
-    for followers in exemplars.values():
-        exemplar_followers |= followers
+    return merged_scores(brands, exemplars, 'jaccard')
 
-    for brand, followers in brands:
-        scores[brand] = _jaccard(followers, exemplar_followers)
-    return scores
 
+def _merge_counts(ids, counts, arrays):
+    """ Add one to the count of each id in arrays, returning the new sorted ids and counts.
+    >>> ids, counts = _merge_counts(np.array([2]), np.array([5]), [np.array([1, 2]), np.array([2])])
+    >>> ids.tolist(), counts.tolist()
+    ([1, 2], [1, 7])
+    """
+    all_counts = np.concatenate([counts] + [np.ones(len(a), dtype=np.int64) for a in arrays])
+    ids, codes = np.unique(np.concatenate([ids] + arrays), return_inverse=True)
+    return ids, np.bincount(codes.ravel(), weights=all_counts, minlength=len(ids)).astype(np.int64)
 
-def compute_log_degrees(brands, exemplars):
+
+def compute_log_degrees(brands, exemplars, chunk_size=10000000):
     """ For each follower, let Z be the total number of brands they follow.
-    Return a dictionary of 1. / log(Z), for each follower.
+    Return a sorted array of followers and an array of 1. / log(Z + 1) for each.
+    Brands are streamed once; counts are kept in compact arrays, merged every chunk_size follower ids.
+    >>> ids, degrees = compute_log_degrees([('b1', {1, 2}), ('b2', {2, 3})], {})
+    >>> ids.tolist(), degrees.round(3).tolist()
+    ([1, 2, 3], [1.443, 0.91, 1.443])
     """
-    counts = Counter()
-    for followers in brands.values():  # + exemplars.values():  # Include exemplars in these counts? No, don't want to penalize people who follow many exemplars.
-        counts.update(followers)
-    counts.update(counts.keys())  # Add 1 to each count.
-    for k in counts:
-        counts[k] = 1. / math.log(counts[k])
-    return counts
+    ids = np.zeros(0, dtype=np.int64)
+    counts = np.zeros(0, dtype=np.int64)
+    chunk = []
+    chunk_len = 0
+    for brand, followers in brands:  # Include exemplars in these counts? No, don't want to penalize people who follow many exemplars.
+        chunk.append(follower_array(followers))
+        chunk_len += len(followers)
+        if chunk_len >= chunk_size:
+            ids, counts = _merge_counts(ids, counts, chunk)
+            chunk = []
+            chunk_len = 0
+    ids, counts = _merge_counts(ids, counts, chunk)
+    return ids, 1. / np.log(counts + 1.)  # Add 1 to each count.
 
 
 # PROPORTION
 
 
-def _proportion(a, b):
-    """ Return the len(a & b) / len(a) """
-    return 1. * len(a & b) / len(a)
-
-
 def proportion(brands, exemplars, weighted_avg=False, sqrt=False):
     """
     Return the proportion of a brand's followers who also follow an exemplar.
     """
-    scores = {}
-    for brand, followers in brands:
-        if weighted_avg:
-            scores[brand] = np.average([_proportion(followers, others) for others in exemplars.values()],
-                                       weights=[1. / len(others) for others in exemplars.values()])
-        else:
-            scores[brand] = 1. * sum(_proportion(followers, others) for others in exemplars.values()) / len(exemplars)
-    if sqrt:
-        scores = dict([(b, math.sqrt(s)) for b, s in scores.items()])
-    return scores
+    score = set_scorer(exemplars, 'proportion', weighted_avg, sqrt)
+    return dict((brand, score(followers)) for brand, followers in brands)
 
 
 def proportion_weighted_avg(brands, exemplars):
@@ -298,38 +1074,18 @@ def proportion_sqrt(brands, exemplars):
 def proportion_merge(brands, exemplars):
     """ Return the proportion of a brand's followers who also follower an
     exemplar. We merge all exemplar followers into one big pseudo-account."""
-    scores = {}
-    exemplar_followers = set()
-    for followers in exemplars.values():
-        exemplar_followers |= followers
-
-    for brand, followers in brands:
-        scores[brand] = _proportion(followers, exemplar_followers)
-    return scores
+    return merged_scores(brands, exemplars, 'proportion')
 
 
 # COSINE SIMILARITY
 
 
-def _cosine(a, b):
-    """ Return the len(a & b) / len(a) """
-    return 1. * len(a & b) / (math.sqrt(len(a)) * math.sqrt(len(b)))
-
-
 def cosine(brands, exemplars, weighted_avg=False, sqrt=False):
     """
     Return the cosine similarity betwee a brand's followers and the exemplars.
     """
-    scores = {}
-    for brand, followers in brands:
-        if weighted_avg:
-            scores[brand] = np.average([_cosine(followers, others) for others in exemplars.values()],
-                                       weights=[1. / len(others) for others in exemplars.values()])
-        else:
-            scores[brand] = 1. * sum(_cosine(followers, others) for others in exemplars.values()) / len(exemplars)
-    if sqrt:
-        scores = dict([(b, math.sqrt(s)) for b, s in scores.items()])
-    return scores
+    score = set_scorer(exemplars, 'cosine', weighted_avg, sqrt)
+    return dict((brand, score(followers)) for brand, followers in brands)
 
 
 def cosine_weighted_avg(brands, exemplars):
@@ -347,116 +1103,1165 @@ def cosine_sqrt(brands, exemplars):
 def cosine_merge(brands, exemplars):
     """ Return the proportion of a brand's followers who also follower an
     exemplar. We merge all exemplar followers into one big pseudo-account."""
-    scores = {}
-    exemplar_followers = set()
-    for followers in exemplars.values():
-        exemplar_followers |= followers
+    return merged_scores(brands, exemplars, 'cosine')
 
-    for brand, followers in brands:
-        scores[brand] = _cosine(followers, exemplar_followers)
-    return scores
+
+def adamic_scorer(ids, degrees, exemplars):
+    """ Return a function mapping a brand's followers to its adamic score,
+    given the follower degrees from compute_log_degrees. """
+    exemplar_arrays = dict([(exemplar, follower_array(followers)) for exemplar, followers in exemplars.items()])
+    exemplar_sums = dict([(exemplar, lookup(ids, degrees, a).sum()) for exemplar, a in exemplar_arrays.items()])
+
+    def score(followers, brand_followers=None):
+        if brand_followers is None:
+            brand_followers = follower_array(followers)
+        brand_sum = lookup(ids, degrees, brand_followers).sum()
+        total = 0.
+        for exemplar, exemplar_followers in exemplar_arrays.items():
+            common = np.intersect1d(brand_followers, exemplar_followers, assume_unique=True)
+            total += lookup(ids, degrees, common).sum() / (brand_sum + exemplar_sums[exemplar])
+        return total / len(exemplars)
+    return score
+
+
+def brand_log_degrees(brands, settings=DEFAULT_SETTINGS):
+    """ Return compute_log_degrees over all brands. If settings.index_dir is
+    set, the degrees of a FollowerFile are saved there, so that shards, which
+    only see some of the brands, can load the degrees of all of them. """
+    if iter(brands) is brands:
+        raise ValueError('adamic needs to read the brands twice; pass a FollowerFile, not an iterator')
+    fname = getattr(brands, 'fname', None)
+    path = None
+    if settings.index_dir is not None and fname is not None:
+        path = os.path.join(settings.index_dir, 'degrees-%s.npz' % follower_file_fingerprint(fname))
+    index = load_index(path)
+    if index is not None:
+        return index['ids'], index['degrees']
+    if getattr(brands, 'shard', None) is not None:
+        raise ValueError('adamic needs degrees over all brands; run analyze --precompute with the same --index-dir first')
+    ids, degrees = compute_log_degrees(brands, None)
+    print('computed degrees for %d followers' % len(ids))
+    save_index(path, ids=ids, degrees=degrees)
+    return ids, degrees
 
 
 def adamic(brands, exemplars):
     """ Return the average Adamic/Adar similarity between a brand's followers
     and the followers of each exemplar. We approximate the number of followed
-    accounts per user by only considering those in our brand set."""
-    print('adamic deprecated...requires loading all brands in memory.')
-    return
-    degrees = compute_log_degrees(brands, exemplars)
+    accounts per user by only considering those in our brand set.
+    Brands are streamed twice (once to count follower degrees, once to score),
+    so they must be re-iterable, e.g., a FollowerFile."""
+    ids, degrees = brand_log_degrees(brands)
+    score = adamic_scorer(ids, degrees, exemplars)
     scores = {}
-    exemplar_sums = dict([(exemplar, sum(degrees[z] for z in exemplars[exemplar])) for exemplar in exemplars])
-
-    for brand in sorted(brands):
-        brand_sum = sum(degrees[z] for z in brands[brand])
-        total = 0.
-        for exemplar in exemplars:
-            total += sum(degrees[z] for z in brands[brand] & exemplars[exemplar]) / (brand_sum + exemplar_sums[exemplar])
-        scores[brand] = total / len(exemplars)
+    for brand, followers in brands:
+        scores[brand] = score(followers)
     return scores
 
 
-def compute_rarity_scores(exemplars):
+# ENCODED FOLLOWERS
+
+
+def follower_array(followers):
+    """ Return the follower ids as a sorted numpy array. An array is taken to
+    be one already, as as_accounts makes them.
+    >>> follower_array({3, 1, 2}).tolist()
+    [1, 2, 3]
+    """
+    if isinstance(followers, np.ndarray):
+        return followers
+    return np.sort(np.fromiter(followers, dtype=np.int64, count=len(followers)))
+
+
+class Exemplars(dict):
+    """ A dict from exemplar screen_name to follower set, read from a follower
+    file. key identifies the file and the exemplars selected from it (see
+    exemplar_key); their indexes are memoized and saved under it. Indexes of
+    exemplars without a key are rebuilt each time they are needed. """
+
+    def __init__(self, followers=(), key=None):
+        dict.__init__(self, followers)
+        self.key = key
+
+
+def exemplar_key(fname, names):
+    """ Return a short hash identifying the exemplars with these screen names
+    in a follower file. Like the brand degrees, it relies on the file's
+    follower_file_fingerprint, so it is cheap to compute from the index and is
+    the same on every machine, assuming the same accounts and follower counts
+    mean the same followers. The names capture the min/max followers, sampling
+    and blacklist used to select the exemplars. """
+    h = hashlib.sha1(follower_file_fingerprint(fname).encode('utf8'))
+    for name in sorted(names):
+        h.update(('%s\n' % name).encode('utf8'))
+    return h.hexdigest()[:16]
+
+
+def index_path(exemplars, kind, settings):
+    """ Return the file in settings.index_dir storing the index of this kind
+    for these exemplars, or None if indexes aren't persisted (no index_dir,
+    or exemplars without a key). """
+    key = getattr(exemplars, 'key', None)
+    if settings.index_dir is None or key is None:
+        return None
+    return os.path.join(settings.index_dir, '%s-%s.npz' % (kind, key))
+
+
+def load_index(path):
+    """ Return a dict of the arrays saved at path, or None if there are none. """
+    if path is None or not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        print('loaded index', path)
+        return dict(data.items())
+
+
+def save_index(path, **arrays):
+    """ Save arrays to path, if it is not None. """
+    if path is None:
+        return
+    mkdirs(path)
+    with report.atomic_open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def member_positions(ids, followers):
+    """ Return the positions in the sorted array ids of the followers found there (others are ignored).
+    >>> member_positions(np.array([2, 4, 6]), np.array([1, 4, 6, 7])).tolist()
+    [1, 2]
+    """
+    if len(ids) == 0:
+        return np.zeros(0, dtype=np.int64)
+    pos = np.searchsorted(ids, followers)
+    pos[pos == len(ids)] = 0
+    return pos[ids[pos] == followers]
+
+
+def lookup(ids, values, followers):
+    """ Return the values of the followers found in the sorted array ids (others are ignored).
+    >>> lookup(np.array([2, 4, 6]), np.array([.2, .4, .6]), np.array([1, 4, 6, 7])).tolist()
+    [0.4, 0.6]
+    """
+    return values[member_positions(ids, followers)]
+
+
+# MERGED EXEMPLAR INDEX
+
+# Most exemplar indexes of each kind to keep in memory; the least recently used are dropped.
+max_memo = 4
+_merged_indexes = OrderedDict()
+_inverted_indexes = OrderedDict()
+_PAIR_SCORES = {
+    # Score of a brand with b followers and an exemplar with e followers, c of which they share.
+    # Given an upper bound on c, these are also upper bounds on the score.
+    'jaccard': lambda b, e, c: c / (b + e - c),
+    'proportion': lambda b, e, c: c / b,
+    'cosine': lambda b, e, c: c / (np.sqrt(b) * np.sqrt(e)),
+}
+
+
+def recall(memo, key):
+    """ Return the index memoized under key, or None, marking it most recently used. """
+    if key is None or key not in memo:
+        return None
+    memo.move_to_end(key)
+    return memo[key]
+
+
+def remember(memo, key, index):
+    """ Memoize index under key, unless key is None, dropping the least recently used beyond max_memo.
+    >>> memo = OrderedDict()
+    >>> for key in range(max_memo + 1):
+    ...     remember(memo, key, key)
+    >>> list(memo) == list(range(1, max_memo + 1))
+    True
+    """
+    if key is None:
+        return
+    memo[key] = index
+    while len(memo) > max_memo:
+        memo.popitem(last=False)
+
+
+_BLOOM_SEEDS = (0x9e3779b97f4a7c15, 0x632be59bd9b4e019)
+
+
+def _hash64(ids, seed):
+    """ Hash an array of ids to uint64 (splitmix64). """
+    z = ids.astype(np.uint64) + np.uint64(seed)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return z ^ (z >> np.uint64(31))
+
+
+def _bloom_positions(ids, nbits, nhashes):
+    """ Return an (nhashes, len(ids)) array of bit positions, by double hashing. """
+    h1 = _hash64(ids, _BLOOM_SEEDS[0])
+    h2 = _hash64(ids, _BLOOM_SEEDS[1]) | np.uint64(1)
+    return np.array([(h1 + np.uint64(i) * h2) % np.uint64(nbits) for i in range(nhashes)]).astype(np.int64)
+
+
+def bloom_filter(ids, error):
+    """ Return the bits and number of hash functions of a Bloom filter
+    containing ids, sized for false positive rate error. """
+    nbytes = max(1, int(math.ceil(-len(ids) * math.log(error) / math.log(2) ** 2 / 8)))
+    nhashes = max(1, int(round(nbytes * 8. / max(len(ids), 1) * math.log(2))))
+    bits = np.zeros(nbytes, dtype=np.uint8)
+    for positions in _bloom_positions(ids, nbytes * 8, nhashes):
+        np.bitwise_or.at(bits, positions >> 3, (1 << (positions & 7)).astype(np.uint8))
+    return bits, nhashes
+
+
+def bloom_contains(bits, nhashes, ids):
+    """ Return a boolean array, True for each id that may be in the filter.
+    >>> bits, nhashes = bloom_filter(np.arange(100), .01)
+    >>> bool(bloom_contains(bits, nhashes, np.arange(100)).all())
+    True
+    """
+    found = np.ones(len(ids), dtype=bool)
+    for positions in _bloom_positions(ids, len(bits) * 8, nhashes):
+        found &= (bits[positions >> 3] >> (positions & 7)) & 1 == 1
+    return found
+
+
+def merged_index(exemplars, settings=DEFAULT_SETTINGS):
+    """ Return an index of the union of all exemplar followers, shared by all
+    merge methods. It holds 'size', the number of distinct followers, and
+    either 'ids', their sorted array, or, if settings.bloom_error is set, a
+    Bloom filter ('bits', 'nhashes'). It is built once per set of keyed
+    Exemplars, kept in memory for the max_memo most recent sets, and saved in
+    settings.index_dir if set. """
+    bloom_error = settings.bloom_error
+    key = getattr(exemplars, 'key', None)
+    if key is not None and bloom_error is not None:
+        key = '%s-%g' % (key, bloom_error)
+    index = recall(_merged_indexes, key)
+    if index is not None:
+        return index
+    path = index_path(exemplars, 'merged' if bloom_error is None else 'bloom%g' % bloom_error, settings)
+    index = load_index(path)
+    if index is None:
+        arrays = [follower_array(followers) for followers in exemplars.values()]
+        ids = np.unique(np.concatenate(arrays)) if arrays else np.zeros(0, dtype=np.int64)
+        if bloom_error is None:
+            index = {'ids': ids, 'size': np.array(len(ids))}
+        else:
+            bits, nhashes = bloom_filter(ids, bloom_error)
+            index = {'bits': bits, 'nhashes': np.array(nhashes), 'size': np.array(len(ids))}
+        save_index(path, **index)
+    remember(_merged_indexes, key, index)
+    return index
+
+
+def count_members(index, followers):
+    """ Return how many of the followers (a sorted array) are in the merged index.
+    >>> count_members(merged_index({'e1': {1, 2}, 'e2': {2, 3}}), np.array([2, 3, 4]))
+    2
+    """
+    if 'ids' in index:
+        return len(lookup(index['ids'], index['ids'], followers))
+    return int(bloom_contains(index['bits'], int(index['nhashes']), followers).sum())
+
+
+def merged_scorer(index, base):
+    """ Return a function mapping a brand's followers (and optionally their
+    follower_array) to their jaccard, proportion or cosine (base) similarity
+    with the union of all exemplar followers, held in a merged_index. """
+    size = float(index['size'])
+    pair_score = _PAIR_SCORES[base]
+
+    def score(followers, array=None):
+        return pair_score(float(len(followers)), size, count_members(index, follower_array(followers) if array is None else array))
+    return score
+
+
+def merged_scores(brands, exemplars, base, settings=DEFAULT_SETTINGS):
+    """ Score each brand by the jaccard, proportion or cosine (base) similarity
+    between its followers and the union of all exemplar followers. """
+    score = merged_scorer(merged_index(exemplars, settings), base)
+    return dict((brand, score(followers)) for brand, followers in brands)
+
+
+# INVERTED EXEMPLAR INDEX
+
+
+def inverted_index(exemplars, settings=DEFAULT_SETTINGS):
+    """ Return an index from each exemplar follower to the exemplars they
+    follow, in compressed sparse row form: 'ids', the sorted distinct
+    followers; 'indptr', where each follower's exemplars start in 'columns';
+    'columns', the exemplars, numbered in sorted order of their names; and
+    'sizes', each exemplar's number of followers. It is built once per set of
+    keyed Exemplars, kept in memory for the max_memo most recent sets, and saved in
+    settings.index_dir if set.
+    >>> index = inverted_index({'e2': {2, 3}, 'e1': {1, 2}})
+    >>> index['ids'].tolist(), index['indptr'].tolist(), index['columns'].tolist(), index['sizes'].tolist()
+    ([1, 2, 3], [0, 1, 3, 4], [0, 0, 1, 1], [2, 2])
+    """
+    key = getattr(exemplars, 'key', None)
+    index = recall(_inverted_indexes, key)
+    if index is not None:
+        return index
+    path = index_path(exemplars, 'inverted', settings)
+    index = load_index(path)
+    if index is None:
+        arrays = [follower_array(exemplars[name]) for name in sorted(exemplars)]
+        sizes = np.array([len(a) for a in arrays], dtype=np.int64)
+        followers = np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64)
+        columns = np.repeat(np.arange(len(arrays), dtype=np.int32), sizes)
+        order = np.argsort(followers, kind='mergesort')  # stable, so each follower's exemplars stay sorted.
+        ids, counts = np.unique(followers[order], return_counts=True)
+        index = {'ids': ids, 'indptr': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                 'columns': columns[order], 'sizes': sizes}
+        save_index(path, **index)
+    remember(_inverted_indexes, key, index)
+    return index
+
+
+def overlap_counts(index, followers, positions=None):
+    """ Return how many of the followers (a sorted array) each exemplar in the
+    inverted index shares, in one walk over the followers' exemplar lists.
+    The cost depends on the number of followers, not on the number of exemplars.
+    positions, if given, are the followers' member_positions in index['ids'].
+    >>> overlap_counts(inverted_index({'e1': {1, 2}, 'e2': {2, 3}}), np.array([2, 3, 4])).tolist()
+    [1, 2]
+    """
+    indptr = index['indptr']
+    pos = member_positions(index['ids'], followers) if positions is None else positions
+    starts = indptr[pos]
+    lengths = indptr[pos + 1] - starts
+    ends = np.cumsum(lengths)
+    entries = np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) else 0)
+    return np.bincount(index['columns'][entries], minlength=len(index['sizes']))
+
+
+def overlap_scorer(exemplars, base, weighted_avg=False, sqrt=False, settings=DEFAULT_SETTINGS, index=None):
+    """ Return a function mapping a brand's followers (and optionally their
+    follower_array and its member_positions in the index) to its average base
+    ('jaccard', 'proportion' or 'cosine') similarity with the exemplars,
+    computed from its overlap_counts. Scores are identical to the
+    pairwise_scorer's. index, if given, is the exemplars' inverted_index. """
+    if index is None:
+        index = inverted_index(exemplars, settings)
+    columns = dict((name, col) for col, name in enumerate(sorted(exemplars)))
+    order = np.array([columns[name] for name in exemplars], dtype=np.int64)  # back to the order of exemplars.
+    sizes = index['sizes'][order].astype(float)
+    weights = 1. / sizes
+    pair_score = _PAIR_SCORES[base]
+
+    def score(followers, array=None, positions=None):
+        if array is None:
+            array = follower_array(followers)
+        pairs = pair_score(float(len(followers)), sizes, overlap_counts(index, array, positions)[order].astype(float))
+        if weighted_avg:
+            result = np.average(pairs, weights=weights)
+        else:
+            result = 1. * sum(pairs.tolist()) / len(exemplars)
+        return math.sqrt(result) if sqrt else result
+    return score
+
+
+def pairwise_scorer(exemplars, base, weighted_avg=False, sqrt=False):
+    """ Return a function like overlap_scorer's, which compares a brand's
+    followers with each exemplar's followers as sets, building no index. """
+    pair_score = _PAIR_SCORES[base]
+    sets = [as_set(followers) for followers in exemplars.values()]
+    weights = 1. / np.array([len(followers) for followers in sets], dtype=float)
+
+    def score(followers, array=None):
+        followers = as_set(followers)
+        pairs = [pair_score(len(followers), len(e), len(followers & e)) for e in sets]
+        if weighted_avg:
+            result = np.average(pairs, weights=weights)
+        else:
+            result = 1. * sum(pairs) / len(sets)
+        return math.sqrt(result) if sqrt else result
+    return score
+
+
+def as_set(followers):
+    """ Return the followers as a set, converting a follower_array. """
+    return followers if isinstance(followers, (set, frozenset)) else set(followers.tolist())
+
+
+def set_scorer(exemplars, base, weighted_avg=False, sqrt=False, settings=DEFAULT_SETTINGS):
+    """ Return the pairwise_scorer if settings.backend is 'sets', else the overlap_scorer. """
+    if settings.backend == 'sets':
+        return pairwise_scorer(exemplars, base, weighted_avg, sqrt)
+    return overlap_scorer(exemplars, base, weighted_avg, sqrt, settings)
+
+
+# RARITY
+
+
+def _compute_rarity_weights(exemplars, kind, exemplar_weight, settings):
+    """ Return a sorted array of the distinct exemplar followers and an array
+    of their weights, sum_i exemplar_weight(n_i) over the exemplars i they follow. """
+    path = index_path(exemplars, kind, settings)
+    index = load_index(path)
+    if index is not None:
+        return index['ids'], index['weights']
+    arrays = [follower_array(followers) for followers in exemplars.values()]
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    per_follower = np.concatenate([np.full(len(a), exemplar_weight(len(a))) for a in arrays])
+    ids, codes = np.unique(np.concatenate(arrays), return_inverse=True)
+    weights = np.bincount(codes.ravel(), weights=per_follower, minlength=len(ids))
+    save_index(path, ids=ids, weights=weights)
+    return ids, weights
+
+
+def compute_rarity_scores(exemplars, settings=DEFAULT_SETTINGS):
     """ Compute a score for each follower that is sum_i (1/n_i), where n_i is
-    the degree of the ith exemplar they follow.
-    >>> compute_rarity_scores({'e1':{1,2,3,4}, 'e2':{4,5}}).items()
+    the degree of the ith exemplar they follow. Return the sorted follower ids and their scores.
+    >>> ids, weights = compute_rarity_scores({'e1':{1,2,3,4}, 'e2':{4,5}})
+    >>> list(zip(ids.tolist(), weights.tolist()))
     [(1, 0.25), (2, 0.25), (3, 0.25), (4, 0.75), (5, 0.5)]
     """
-    scores = defaultdict(lambda: 0.)
-    for followers in exemplars.values():
-        score = 1. / len(followers)
-        for f in followers:
-            scores[f] += score
+    return _compute_rarity_weights(exemplars, 'rarity', lambda n: 1. / n, settings)
+
+
+def _rarity(brands, ids, weights):
+    scores = {}
+    for brand, followers in brands:
+        scores[brand] = lookup(ids, weights, follower_array(followers)).sum() / len(followers)
     return scores
 
 
 def rarity(brands, exemplars):
     """ Compute a score for each follower that is sum_i (1/n_i), where n_i is the degree of the ith exemplar they follow.
     The score for a brand is then the average of their follower scores."""
-    rarity = compute_rarity_scores(exemplars)
-    scores = {}
-    for brand, followers in brands:
-        scores[brand] = sum(rarity[f] for f in followers) / len(followers)
-    return scores
+    return _rarity(brands, *compute_rarity_scores(exemplars))
 
 
-def compute_rarity_scores_log(exemplars):
-    """ Compute a score for each follower that is sum_i (1/n_i), where n_i is
-    the degree of the ith exemplar they follow.
-    >>> compute_rarity_scores({'e1':{1,2,3,4}, 'e2':{4,5}}).items()
-    [(1, 0.25), (2, 0.25), (3, 0.25), (4, 0.75), (5, 0.5)]
+def compute_rarity_scores_log(exemplars, settings=DEFAULT_SETTINGS):
+    """ Compute a score for each follower that is sum_i (1/log(n_i)), where n_i is
+    the degree of the ith exemplar they follow. Return the sorted follower ids and their scores.
+    >>> ids, weights = compute_rarity_scores_log({'e1':{1,2,3,4}, 'e2':{4,5}})
+    >>> ids.tolist(), weights.round(3).tolist()
+    ([1, 2, 3, 4, 5], [0.721, 0.721, 0.721, 2.164, 1.443])
     """
-    scores = defaultdict(lambda: 0.)
-    for followers in exemplars.values():
-        score = 1. / math.log(len(followers))
-        for f in followers:
-            scores[f] += score
-    return scores
+    return _compute_rarity_weights(exemplars, 'rarity_log', lambda n: 1. / math.log(n), settings)
 
 
 def rarity_log(brands, exemplars):
     """ Compute a score for each follower that is sum_i (1/log(n_i)), where n_i is the degree of the ith exemplar they follow.
     The score for a brand is then the average of their follower scores."""
-    rarity = compute_rarity_scores_log(exemplars)
+    return _rarity(brands, *compute_rarity_scores_log(exemplars))
+
+
+# TOP-K
+
+_METHOD_SUFFIXES = {
+    # suffix: (weighted_avg, sqrt, merge)
+    '': (False, False, False),
+    '_weighted_avg': (True, False, False),
+    '_sqrt_no_weighted_avg': (False, True, False),
+    '_sqrt': (True, True, False),
+    '_merge': (False, False, True),
+}
+
+
+def parse_method(analyze_fn):
+    """ Return (base, weighted_avg, sqrt, merge) for a set similarity method, or None for other methods.
+    >>> parse_method('cosine_sqrt')
+    ('cosine', True, True, False)
+    >>> parse_method('rarity')
+    """
+    for base in _PAIR_SCORES:
+        if analyze_fn.startswith(base) and analyze_fn[len(base):] in _METHOD_SUFFIXES:
+            return (base,) + _METHOD_SUFFIXES[analyze_fn[len(base):]]
+    return None
+
+
+def make_scorer(analyze_fn, exemplars, settings=DEFAULT_SETTINGS):
+    """ Return a function mapping one brand's followers (and optionally their
+    follower_array, if already computed) to its analyze_fn score, doing any
+    precomputation over the exemplars only once. """
+    analyze = getattr(sys.modules[__name__], analyze_fn)
+    parsed = parse_method(analyze_fn)
+    if parsed and parsed[3]:
+        return merged_scorer(merged_index(exemplars, settings), parsed[0])
+    elif analyze_fn in ('rarity', 'rarity_log'):
+        compute = compute_rarity_scores if analyze_fn == 'rarity' else compute_rarity_scores_log
+        ids, weights = compute(exemplars, settings)
+        return lambda followers, array=None: lookup(ids, weights, follower_array(followers) if array is None else array).sum() / len(followers)
+    elif parsed:
+        return set_scorer(exemplars, *parsed[:3], settings=settings)
+    elif analyze_fn == 'adamic':
+        raise ValueError('adamic needs follower degrees over all brands; use adamic_scorer')
+    return lambda followers, array=None: analyze([(None, followers)], exemplars)[None]
+
+
+def length_bound(base, weighted_avg, sqrt, sizes):
+    """ Return a function mapping a brand's number of followers b to an upper
+    bound on its score against exemplars with these numbers of followers
+    (sizes), as it shares at most min(b, size) followers with each. Bounds
+    are memoized by b, as many brands have the same number of followers.
+    >>> length_bound('jaccard', False, False, [2, 4])(2)
+    0.75
+    """
+    pair_score = _PAIR_SCORES[base]
+    sizes = np.asarray(sizes, dtype=float)
+    weights = 1. / sizes if weighted_avg else np.ones(len(sizes))
+    bounds = {}
+
+    def bound(b):
+        if b not in bounds:
+            score = float(np.average(pair_score(float(b), sizes, np.minimum(sizes, b)), weights=weights))
+            bounds[b] = math.sqrt(score) if sqrt else score
+        return bounds[b]
+    return bound
+
+
+def degree_bound(index, base, weighted_avg, sqrt):
+    """ Return a function mapping the member_positions of a brand's followers
+    in an inverted index, and its number of followers b, to an upper bound on
+    its score. Each follower adds its degree, the (weighted) share of the
+    exemplars it follows, so the sum over b is exactly the brand's average
+    proportion. That bounds jaccard, and its square root bounds cosine, as
+    c / sqrt(b * size) <= sqrt(c / b) and the average of square roots is at
+    most the square root of the average.
+    >>> index = inverted_index({'e1': {1, 2}, 'e2': {2, 3}})
+    >>> degree_bound(index, 'jaccard', False, False)(np.array([1, 2]), 4)  # followers 2 and 3 of 4.
+    0.375
+    """
+    sizes = index['sizes'].astype(float)
+    weights = 1. / sizes if weighted_avg else np.ones(len(sizes))
+    rows = np.repeat(np.arange(len(index['ids'])), np.diff(index['indptr']))
+    degrees = np.bincount(rows, weights=weights[index['columns']], minlength=len(index['ids'])) / weights.sum()
+
+    def bound(positions, b):
+        score = float(degrees[positions].sum()) / b
+        if base == 'cosine':
+            score = math.sqrt(score)
+        return math.sqrt(score) if sqrt else score
+    return bound
+
+
+def top_k(brands, exemplars, analyze_fn, k, settings=DEFAULT_SETTINGS):
+    """ Return a list of the k highest scoring (brand, score) pairs, best
+    first, with ties broken by screen name as by heapq.nlargest over (score,
+    brand). For set similarity methods, we keep a heap of the best k brands
+    and skip brands whose score can't beat the worst of them: first by their
+    length_bound, which needs only their number of followers, then, with the
+    inverted index, by their degree_bound, whose probe of the index scoring
+    reuses. Other methods score every brand. """
+    parsed = parse_method(analyze_fn)
+    if parsed is None:
+        scores = analyze_categories(brands, [(None, exemplars)], analyze_fn, settings)
+        return heapq.nlargest(k, ((brand, s[0]) for brand, s in scores.items()), key=lambda x: (x[1], x[0]))
+    base, weighted_avg, sqrt, merge = parsed
+    degrees = None
+    if merge:
+        index = merged_index(exemplars, settings)
+        score = merged_scorer(index, base)
+        sizes = [index['size']]
+    elif settings.backend == 'sets':
+        score = pairwise_scorer(exemplars, base, weighted_avg, sqrt)
+        sizes = [len(followers) for followers in exemplars.values()]
+    else:
+        index = inverted_index(exemplars, settings)
+        score = overlap_scorer(exemplars, base, weighted_avg, sqrt, settings, index)
+        degrees = degree_bound(index, base, weighted_avg, sqrt)
+        sizes = index['sizes']
+    lengths = length_bound(base, weighted_avg, sqrt, sizes)
+    heap = []
+    pruned = 0
+    for brand, followers in brands:
+        # allow for rounding error in the bounds.
+        if len(heap) == k and lengths(len(followers)) < heap[0][0] - 1e-12:
+            pruned += 1
+            continue
+        if degrees is None:
+            item = (score(followers), brand)
+        else:
+            array = follower_array(followers)
+            positions = member_positions(index['ids'], array)
+            if len(heap) == k and degrees(positions, len(followers)) < heap[0][0] - 1e-12:
+                pruned += 1
+                continue
+            item = (score(followers, array, positions), brand)
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    print('pruned %d brands that could not reach the top %d' % (pruned, k))
+    return [(brand, s) for s, brand in sorted(heap, reverse=True)]
+
+
+# OUT-OF-CORE
+
+# Most bucket files to write at once; more buckets are written in several passes over the follower file.
+MAX_OPEN_BUCKETS = 256
+
+
+def partition_follower_file(fname, outdir, prefix, nbuckets, column):
+    """ Stream a follower file, appending (follower id, column) pairs to the
+    file <outdir>/<prefix>-<bucket>.bin of each follower's hash bucket.
+    column(screen_name, n_followers) returns the account's column index, or
+    None to skip it. Return a list of (column, screen_name, n_followers).
+    Like read_follower_file, only the last line of an account listed more than once is used.
+    At most MAX_OPEN_BUCKETS files are open at once, each pass over the
+    file writing the next MAX_OPEN_BUCKETS buckets. """
+    last = dict((name, i) for i, (name, _, _) in enumerate(read_follower_index(fname)))
+    accounts = []
+    columns = {}  # line -> column of the accounts kept in the first pass.
+    for first in range(0, nbuckets, MAX_OPEN_BUCKETS):
+        end = min(first + MAX_OPEN_BUCKETS, nbuckets)
+        outfs = []
+        try:
+            for b in range(first, end):
+                outfs.append(open(os.path.join(outdir, '%s-%d.bin' % (prefix, b)), 'wb'))
+            for i, (name, followers) in enumerate(iter_follower_file(fname)):
+                if last[name] != i:
+                    continue
+                if first == 0:
+                    col = column(name, len(followers))
+                    if col is None:
+                        continue
+                    columns[i] = col
+                    accounts.append((col, name, len(followers)))
+                elif i in columns:
+                    col = columns[i]
+                else:
+                    continue
+                ids = follower_array(followers)
+                buckets = (_hash64(ids, 0) % np.uint64(nbuckets)).astype(np.int64)
+                order = np.argsort(buckets, kind='stable')
+                ids, buckets = ids[order], buckets[order]
+                bounds = np.searchsorted(buckets, np.arange(first, end + 1))
+                for b in np.nonzero(np.diff(bounds))[0]:
+                    pairs = np.empty((bounds[b + 1] - bounds[b], 2), dtype=np.int64)
+                    pairs[:, 0] = ids[bounds[b]:bounds[b + 1]]
+                    pairs[:, 1] = col
+                    pairs.tofile(outfs[b])
+        finally:
+            for outf in outfs:
+                outf.close()
+    return accounts
+
+
+def _read_pairs(fname):
+    pairs = np.fromfile(fname, dtype=np.int64).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def count_bucket(brand_file, exemplar_file, nbrands, nexemplars):
+    """ Join the (follower id, column) pairs of brands and exemplars in one
+    bucket. Return a sparse nbrands x nexemplars matrix of shared followers,
+    the number of each brand's followers that follow any exemplar, and the
+    number of distinct exemplar followers in the bucket. """
+    from scipy.sparse import coo_matrix
+
+    brand_ids, brand_cols = _read_pairs(brand_file)
+    exemplar_ids, exemplar_cols = _read_pairs(exemplar_file)
+    order = np.argsort(exemplar_ids, kind='stable')
+    exemplar_ids, exemplar_cols = exemplar_ids[order], exemplar_cols[order]
+    left = np.searchsorted(exemplar_ids, brand_ids, 'left')
+    nmatches = np.searchsorted(exemplar_ids, brand_ids, 'right') - left
+    rows = np.repeat(brand_cols, nmatches)
+    starts = np.repeat(left - (np.cumsum(nmatches) - nmatches), nmatches)
+    cols = exemplar_cols[starts + np.arange(len(rows))]
+    counts = coo_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)), shape=(nbrands, nexemplars)).tocsr()
+    merged = np.bincount(brand_cols[nmatches > 0], minlength=nbrands)
+    return counts, merged, len(np.unique(exemplar_ids))
+
+
+def analyze_out_of_core(brand_follower_file, exemplar_follower_file, analyze_fn, nbuckets,
+                        min_followers=0, max_followers=1e10, sample_exemplars=100, blacklist=set(), tmpdir=None, shard=None):
+    """ Score brands with a jaccard, proportion or cosine method without
+    holding all followers in memory. Follower ids of brands and exemplars are
+    hash partitioned into nbuckets files in tmpdir; each bucket is joined on
+    its own to count the followers shared by each brand and exemplar, and the
+    counts are summed. Scores are identical to the in-memory methods. """
+    import shutil
+    import tempfile
+
+    parsed = parse_method(analyze_fn)
+    if parsed is None:
+        raise ValueError('out-of-core scoring only supports jaccard, proportion and cosine methods, not %s' % analyze_fn)
+    base, weighted_avg, sqrt, merge = parsed
+    workdir = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        names = select_exemplars(exemplar_follower_file, min_followers, max_followers, sample_exemplars, blacklist)
+        exemplar_cols = dict((name, col) for col, name in enumerate(names))
+        with metrics.stage('partition') as info:
+            exemplars = partition_follower_file(exemplar_follower_file, workdir, 'exemplars', nbuckets,
+                                                lambda name, n: exemplar_cols.get(name))
+            print('partitioned follower data for %d exemplars into %d buckets' % (len(exemplars), nbuckets))
+            brand_cols = itertools.count()
+            brands = partition_follower_file(brand_follower_file, workdir, 'brands', nbuckets,
+                                             lambda name, n: next(brand_cols) if in_shard(name, shard) else None)
+            print('partitioned follower data for %d brands' % len(brands))
+            info['records'] = len(exemplars) + len(brands)
+        with metrics.stage('count_buckets') as info:
+            counts, merged, merged_size = None, np.zeros(len(brands), dtype=np.int64), 0
+            for b in range(nbuckets):
+                bucket = count_bucket(os.path.join(workdir, 'brands-%d.bin' % b), os.path.join(workdir, 'exemplars-%d.bin' % b),
+                                      len(brands), len(names))
+                counts = bucket[0] if counts is None else counts + bucket[0]
+                merged += bucket[1]
+                merged_size += bucket[2]
+            info['records'] = nbuckets
+    finally:
+        shutil.rmtree(workdir)
+
+    exemplar_sizes = [0] * len(names)
+    for col, name, n in exemplars:
+        exemplar_sizes[col] = n
+    pair_score = _PAIR_SCORES[base]
+    scores = {}
+    for col, brand, n in brands:
+        if merge:
+            scores[brand] = pair_score(float(n), float(merged_size), int(merged[col]))
+            continue
+        shared = counts.getrow(col).toarray()[0]
+        pairs = [pair_score(float(n), float(exemplar_sizes[j]), int(shared[j])) for j in range(len(names))]
+        if weighted_avg:
+            scores[brand] = np.average(pairs, weights=[1. / size for size in exemplar_sizes])
+        else:
+            scores[brand] = 1. * sum(pairs) / len(names)
+    if sqrt:
+        scores = dict([(b, math.sqrt(s)) for b, s in scores.items()])
+    return scores
+
+
+# BACKEND PLANNER
+
+# Rough costs of each backend, measured on the medium benchmark data (see
+# benchmarks/methods.py); only their ratios matter. Seconds per follower id
+# parsed into a set; per brand and exemplar compared as sets, and per follower
+# id compared; per brand looked up in an exemplar index, and per follower id
+# looked up, times log2 of the index size; per exemplar follower id indexed;
+# and per follower id partitioned to disk and joined out of core.
+PARSE_SECONDS = 3.5e-7
+SET_PAIR_SECONDS = 3e-6
+SET_ID_SECONDS = 3.5e-8
+INDEX_BRAND_SECONDS = 2e-5
+INDEX_ID_SECONDS = 1.8e-8
+INDEX_BUILD_SECONDS = 2.3e-7
+OUT_OF_CORE_ID_SECONDS = 2.5e-6
+# Bytes per follower id held in a Python set, per exemplar follower id while
+# an index is built, and per follower id of an out-of-core bucket being joined.
+SET_BYTES = 70
+INDEX_BYTES = 40
+BUCKET_BYTES = 80
+BACKENDS = ['auto', 'sets', 'index', 'out-of-core']
+
+
+def available_memory():
+    """ Return the bytes of memory available to this process, or None if unknown. """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def follower_stats(fname, min_followers=0, max_followers=1e10, blacklist=set(), fraction=1.):
+    """ Return the number of accounts in a follower file, their total number
+    of followers and the most any has, read from the file's index. Only
+    accounts passing the filters are counted, and the first two numbers are
+    scaled by fraction, for sampled exemplars or a shard of brands. """
+    counts = [n for name, n, _ in read_follower_index(fname)
+              if name not in blacklist and n > min_followers and n <= max_followers]
+    return len(counts) * fraction, sum(counts) * fraction, max(counts) if counts else 0
+
+
+def plan_network(analyze_fn, brand_stats, exemplar_stats, backend='auto', memory=None, out_of_core=True):
+    """ Return the backend to score analyze_fn with ('sets', 'index' or
+    'out-of-core'), the number of out-of-core buckets, and the reason for
+    the choice. brand_stats and exemplar_stats are follower_stats; memory is
+    the bytes we may use, or None if unknown. With backend='auto', we pick
+    the backend with the least estimated time among those that fit in
+    memory, or out of core if none fit. out_of_core=False rules it out.
+    Bloom filters, being approximate, are only used when asked for with --bloom.
+    >>> plan_network('jaccard', (1000, 1e5, 500), (2, 400, 300))[:2]
+    ('sets', None)
+    >>> plan_network('jaccard', (1000, 1e5, 500), (200, 4e4, 300))[:2]
+    ('index', None)
+    >>> plan_network('jaccard', (1e4, 1e9, 1e6), (200, 1e8, 1e6), memory=4e9)[:2]
+    ('out-of-core', 44)
+    """
+    parsed = parse_method(analyze_fn)
+    nbrands, brand_ids, most_brand_ids = brand_stats
+    nexemplars, exemplar_ids, _ = exemplar_stats
+    parse = (brand_ids + exemplar_ids) * PARSE_SECONDS
+    held = (exemplar_ids + most_brand_ids) * SET_BYTES
+    estimates = {'index': (parse + nbrands * INDEX_BRAND_SECONDS + exemplar_ids * INDEX_BUILD_SECONDS +
+                           brand_ids * math.log(exemplar_ids + 2, 2) * INDEX_ID_SECONDS, held + exemplar_ids * INDEX_BYTES)}
+    if parsed and not parsed[3]:
+        estimates['sets'] = (parse + nbrands * nexemplars * SET_PAIR_SECONDS +
+                             (brand_ids * nexemplars + nbrands * exemplar_ids) * SET_ID_SECONDS, held)
+    nbuckets = None
+    if parsed and out_of_core:
+        total = brand_ids + exemplar_ids
+        nbuckets = max(2, int(math.ceil(total * BUCKET_BYTES / (memory / 2.)))) if memory else 16
+        passes = int(math.ceil(nbuckets / float(MAX_OPEN_BUCKETS)))  # each pass rereads the follower files.
+        estimates['out-of-core'] = (total * OUT_OF_CORE_ID_SECONDS + (passes - 1) * total * PARSE_SECONDS,
+                                    total * BUCKET_BYTES / nbuckets + most_brand_ids * SET_BYTES)
+
+    def describe(name):
+        return '%s %.3gs, %.0fMB' % (name, estimates[name][0], estimates[name][1] / 1e6)
+    others = ', '.join(describe(name) for name in sorted(estimates))
+    if backend != 'auto':
+        if backend == 'out-of-core' and parsed and not out_of_core:
+            raise ValueError('the out-of-core backend needs a single set of exemplars')
+        if backend not in estimates:
+            raise ValueError('the %s backend cannot score %s' % (backend, analyze_fn))
+        return backend, nbuckets if backend == 'out-of-core' else None, 'requested (estimates: %s)' % others
+    fits = [name for name in sorted(estimates) if memory is None or estimates[name][1] <= memory]
+    if fits:
+        best = min(fits, key=lambda name: estimates[name][0])
+        reason = 'fastest that fits in %s (estimates: %s)' % (
+            'memory' if memory is None else '%.0fMB' % (memory / 1e6), others)
+    elif 'out-of-core' in estimates:
+        best = 'out-of-core'
+        reason = 'in-memory backends need more than %.0fMB (estimates: %s)' % (memory / 1e6, others)
+    else:
+        best = min(estimates, key=lambda name: estimates[name][1])
+        reason = 'none fits in %.0fMB, so using the one needing least memory (estimates: %s)' % (memory / 1e6, others)
+    return best, nbuckets if best == 'out-of-core' else None, reason
+
+
+# MULTIPLE CATEGORIES
+
+
+def read_manifest(fname):
+    """ Read a file of "<category> <exemplar follower file>" lines, returning
+    a list of (category, file) pairs. Relative paths are relative to the manifest. """
+    categories = []
+    with open(fname, 'rt') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) > 1 and not parts[0].startswith('#'):
+                categories.append((parts[0], os.path.join(os.path.dirname(fname), parts[1])))
+    return categories
+
+
+def category_name(fname):
+    """
+    >>> category_name('/data/eco.exemplar_followers.txt.gz')
+    'eco'
+    """
+    return os.path.basename(fname).split('.')[0]
+
+
+def category_names(fnames):
+    """ Return the category_name of each exemplar follower file, unless two
+    share one, in which case each is named by its path relative to the
+    files' common directory, without extensions.
+    >>> category_names(['/data/eco/a.txt', '/data/lux/a.txt', '/data/lux/b.txt.gz'])
+    ['eco/a', 'lux/a', 'lux/b']
+    """
+    names = [category_name(f) for f in fnames]
+    if len(set(names)) == len(names):
+        return names
+    paths = [os.path.abspath(f) for f in fnames]
+    common = os.path.commonpath(paths) if len(set(paths)) > 1 else os.path.dirname(paths[0])
+    names = []
+    for path in paths:
+        rel = os.path.relpath(path, common)
+        names.append(os.path.join(os.path.dirname(rel), category_name(rel)).replace(os.sep, '/'))
+    return names
+
+
+def check_categories(categories):
+    """ Raise a ValueError unless the (name, file) pairs have distinct names,
+    which label the columns of the output. """
+    names = [name for name, _ in categories]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError('categories must have distinct names, but %s appear more than once' % ', '.join(duplicates))
+
+
+def analyze_categories(brands, categories, analyze_fn, settings=DEFAULT_SETTINGS):
+    """ Score each brand against several sets of exemplars in one pass over
+    the brands, sharing each brand's follower_array across categories.
+    categories is a list of (name, exemplars) pairs. Return a dict from brand
+    to a list of scores, one per category. """
+    if analyze_fn == 'adamic':  # degrees depend only on the brands, so compute them once.
+        ids, degrees = brand_log_degrees(brands, settings)
+        scorers = [adamic_scorer(ids, degrees, exemplars) for _, exemplars in categories]
+    else:
+        scorers = [make_scorer(analyze_fn, exemplars, settings) for _, exemplars in categories]
     scores = {}
     for brand, followers in brands:
-        scores[brand] = sum(rarity[f] for f in followers) / len(followers)
+        array = follower_array(followers) if len(scorers) > 1 else None
+        scores[brand] = [score(followers, array) for score in scorers]
     return scores
 
 
+# IN-MEMORY API
+
+
+def as_accounts(accounts):
+    """ Return a list of (screen_name, followers) pairs from a dict or an
+    iterable of pairs whose followers are sets, lists or arrays of ids. Sets
+    are kept as they are; lists and arrays become follower_arrays, which the
+    scorers use directly. Sorted int64 arrays of distinct ids are not copied.
+    FollowerFiles are returned as they are, to be streamed.
+    >>> as_accounts({'a': [3, 1, 3], 'b': {2}})
+    [('a', array([1, 3])), ('b', {2})]
+    """
+    if isinstance(accounts, (FollowerFile, metrics.TimedIterable)):
+        return accounts
+    if isinstance(accounts, dict):
+        accounts = accounts.items()
+    return [(screen_name, followers if isinstance(followers, (set, frozenset)) else _sorted_ids(followers))
+            for screen_name, followers in accounts]
+
+
+def _sorted_ids(followers):
+    array = np.asarray(followers)
+    if array.dtype == np.int64 and array.ndim == 1 and np.all(array[1:] > array[:-1]):
+        return array
+    return np.unique(array.astype(np.int64))
+
+
+def as_exemplars(exemplars):
+    """ Return a dict from exemplar screen_name to followers; see as_accounts. """
+    if isinstance(exemplars, dict) and all(isinstance(f, (set, frozenset)) for f in exemplars.values()):
+        return exemplars
+    return dict(iter_follower_file(exemplars.fname) if isinstance(exemplars, FollowerFile) else as_accounts(exemplars))
+
+
+def score_brands(brands, scorer):
+    """ Return arrays of the brands' screen names and their scores under a
+    scorer from make_scorer, which can be reused across calls. """
+    return score_arrays((brand, scorer(followers)) for brand, followers in as_accounts(brands))
+
+
+def score_network(brands, exemplars, analyze_fn='jaccard', k=None, settings=DEFAULT_SETTINGS):
+    """ Score brands against exemplars, without reading or writing any files.
+    Brands and exemplars map screen names to followers, as in as_accounts.
+    Return arrays of screen names and scores, sorted by screen name, or, if k
+    is set, the k highest scoring brands, best first. settings is a
+    NetworkSettings; by default indexes are exact and kept only in memory.
+    >>> score_network({'b': [1, 2], 'a': [1, 4]}, {'e': [1, 2, 3]})
+    (array(['a', 'b'], dtype='<U1'), array([0.25      , 0.66666667]))
+    """
+    brands, exemplars = as_accounts(brands), as_exemplars(exemplars)
+    if k:
+        return score_arrays(top_k(brands, exemplars, analyze_fn, k, settings))
+    scores = analyze_categories(brands, [(None, exemplars)], analyze_fn, settings)
+    return score_arrays((brand, scores[brand][0]) for brand in sorted(scores))
+
+
+def score_categories(brands, categories, analyze_fn='jaccard', settings=DEFAULT_SETTINGS):
+    """ Score brands against a list of (category, exemplars) pairs. Return an
+    array of screen names, sorted, and a matrix with a column of scores per category. """
+    brands = as_accounts(brands)
+    categories = [(name, as_exemplars(exemplars)) for name, exemplars in categories]
+    scores = analyze_categories(brands, categories, analyze_fn, settings)
+    names = sorted(scores)
+    return np.array(names, dtype=str), np.array([scores[b] for b in names], dtype=float).reshape(len(names), len(categories))
+
+
+def read_exemplars(exemplar_follower_file, min_followers, max_followers, sample_exemplars, blacklist):
+    names = select_exemplars(exemplar_follower_file, min_followers, max_followers, sample_exemplars, blacklist)
+    exemplars = Exemplars(read_follower_file(exemplar_follower_file, names=names),
+                          exemplar_key(exemplar_follower_file, names))
+    print('read follower data for %d exemplars' % (len(exemplars)))
+    return exemplars
+
+
 def mkdirs(filename):
     report.mkdirs(os.path.dirname(filename))
 
 
-def analyze_followers(brand_follower_file, exemplar_follower_file, outfile, analyze_fn,
-                      min_followers, max_followers, sample_exemplars):
-    brands = iter_follower_file(brand_follower_file)
-    exemplars = read_follower_file(exemplar_follower_file, min_followers=min_followers, max_followers=max_followers, blacklist=get_twitter_handles(brand_follower_file))
-    print('read follower data for %d exemplars' % (len(exemplars)))
-    if sample_exemplars < 100:  # sample a subset of exemplars.
-        exemplars = dict([(k, exemplars[k]) for k in random.sample(exemplars.keys(), int(len(exemplars) * sample_exemplars / 100.))])
-        print('sampled %d exemplars' % (len(exemplars)))
-    analyze = getattr(sys.modules[__name__], analyze_fn)
-    scores = analyze(brands, exemplars)
+def precompute(brands, exemplars, analyze_fn, settings):
+    """ Build and save (in settings.index_dir) the indexes analyze_fn needs
+    that depend on all brands or all exemplars, so that shards can share them. """
+    parsed = parse_method(analyze_fn)
+    if analyze_fn in ('rarity', 'rarity_log'):
+        make_scorer(analyze_fn, exemplars, settings)
+    elif analyze_fn == 'adamic':
+        brand_log_degrees(brands, settings)
+    elif parsed:
+        if parsed[3]:
+            merged_index(exemplars, settings)
+        else:
+            inverted_index(exemplars, settings)
+
+
+def run_id(brand_follower_file, exemplar_follower_files, *params):
+    """ Return a short hash identifying a run's inputs and parameters, so
+    that merge can refuse to combine shards of different runs. """
+    h = hashlib.sha1(follower_file_fingerprint(brand_follower_file).encode('utf8'))
+    for name, fname in exemplar_follower_files:
+        h.update(('%s %s' % (name, follower_file_fingerprint(fname))).encode('utf8'))
+    h.update(repr(params).encode('utf8'))
+    return h.hexdigest()[:16]
+
+
+def analyze_followers(brand_follower_file, exemplar_follower_files, outfile, analyze_fn,
+                      min_followers, max_followers, sample_exemplars, index_dir=None, k=None, bloom=None,
+                      partitions=None, tmpdir=None, shard=None, precompute_only=False, backend='auto', max_memory=None):
+    """ Score brands against one exemplar follower file, writing "brand score"
+    lines, or against a list of (category, file) pairs, writing a table with a
+    column per category. If partitions is set, score out of core with that many hash buckets.
+    If shard=(i, n) is set, only score the ith of n shards of the brands.
+    If precompute_only is set, only build the indexes shards share.
+    Otherwise, plan_network picks the backend, if it is 'auto', planning to
+    use at most max_memory bytes (by default, 80% of the available memory). """
+    brands = metrics.timed(FollowerFile(brand_follower_file, shard), 'read_brands')
+    blacklist = get_twitter_handles(brand_follower_file)
+    if not isinstance(exemplar_follower_files, list):
+        exemplar_follower_files = [(category_name(exemplar_follower_files), exemplar_follower_files)]
+    check_categories(exemplar_follower_files)
+    if partitions and backend == 'auto':
+        backend = 'out-of-core'
+    parsed = parse_method(analyze_fn)
+    if bloom and parsed and parsed[3]:
+        print('backend: bloom (requested with --bloom)')
+    elif not precompute_only:
+        with metrics.stage('plan') as info:
+            brand_stats = follower_stats(brand_follower_file, fraction=1. / shard[1] if shard else 1.)
+            stats = [follower_stats(fname, min_followers, max_followers, blacklist, sample_exemplars / 100.)
+                     for _, fname in exemplar_follower_files]
+            exemplar_stats = (sum(x[0] for x in stats), sum(x[1] for x in stats), max(x[2] for x in stats))
+            if max_memory is None and available_memory():
+                max_memory = .8 * available_memory()
+            backend, nbuckets, reason = plan_network(analyze_fn, brand_stats, exemplar_stats, backend, max_memory,
+                                                     len(exemplar_follower_files) == 1)
+            info.update(backend=backend, reason=reason)
+        print('backend: %s (%s)' % (backend, reason))
+        if backend == 'out-of-core':
+            partitions = partitions or nbuckets
+        else:
+            partitions = None
+    settings = NetworkSettings(index_dir, bloom, 'sets' if backend == 'sets' else 'index')
+    run = None
+    if shard:
+        run = run_id(brand_follower_file, exemplar_follower_files, analyze_fn, min_followers, max_followers,
+                     sample_exemplars, random.getstate()[1][:4], k, bloom)  # include the state of the sampling seed.
+    if partitions:
+        if len(exemplar_follower_files) > 1:
+            raise ValueError('--partitions needs a single set of exemplars')
+        with metrics.stage('score_out_of_core') as info:
+            scores = analyze_out_of_core(brand_follower_file, exemplar_follower_files[0][1], analyze_fn, partitions,
+                                         min_followers, max_followers, sample_exemplars, blacklist, tmpdir, shard)
+            info['records'] = len(scores)
+        if k:
+            results = heapq.nlargest(k, scores.items(), key=lambda x: (x[1], x[0]))
+        else:
+            results = [(brand, scores[brand]) for brand in sorted(scores)]
+        write_scores(outfile, ['%s %g' % result for result in results], shard, run, k)
+        return
+    with metrics.stage('read_exemplars') as info:
+        categories = [(name, read_exemplars(fname, min_followers, max_followers, sample_exemplars, blacklist))
+                      for name, fname in exemplar_follower_files]
+        info['records'] = sum(len(exemplars) for _, exemplars in categories)
+    if precompute_only:
+        with metrics.stage('precompute'):
+            for name, exemplars in categories:
+                precompute(FollowerFile(brand_follower_file), exemplars, analyze_fn, settings)
+        print('indexes for %s saved to %s' % (analyze_fn, index_dir))
+        return
+    if len(categories) > 1:
+        if k:
+            raise ValueError('--top-k needs a single set of exemplars')
+        with metrics.stage('score') as info:
+            names, scores = score_categories(brands, categories, analyze_fn, settings)
+            info['records'] = len(names)
+        lines = ['#brand %s' % ' '.join(name for name, _ in categories)]
+        lines.extend('%s %s' % (brand, ' '.join('%g' % x for x in row)) for brand, row in zip(names, scores))
+        write_scores(outfile, lines, shard, run)
+        return
+    with metrics.stage('score') as info:
+        names, scores = score_network(brands, categories[0][1], analyze_fn, k, settings)
+        info['records'] = None if k else len(names)
+    write_scores(outfile, ['%s %g' % result for result in zip(names, scores)], shard, run, k)
+
+
+def shard_header(lines, shard, run, k=None):
+    """ Return the header of a shard's output: the shard, the run, the number
+    of brands, the top-k setting and a checksum of the result lines.
+    >>> shard_header(['a 0.5'], (0, 2), 'abc')
+    '# shard 0/2 run=abc brands=1 k=0 sha1=92f5fb59953c94a807910e9a971d5903d089dce5'
+    """
+    body = ''.join(line + '\n' for line in lines)
+    nbrands = sum(1 for line in lines if not line.startswith('#'))
+    checksum = hashlib.sha1(body.encode('utf8')).hexdigest()
+    return '# shard %d/%d run=%s brands=%d k=%d sha1=%s' % (shard[0], shard[1], run, nbrands, k or 0, checksum)
+
+
+def write_scores(outfile, lines, shard=None, run=None, k=None):
+    """ Write result lines to outfile, after a shard_header if this is a shard. """
     mkdirs(outfile)
-    outf = open(outfile, 'wt')
-    for brand in sorted(scores):
-        outf.write('%s %g\n' % (brand, scores[brand]))
-        outf.flush()
-    outf.close()
+    with metrics.stage('write') as info:
+        outf = io.open(outfile, 'wt', encoding='utf8')
+        if shard:
+            outf.write(shard_header(lines, shard, run, k) + '\n')
+        for line in lines:
+            outf.write(line + '\n')
+        outf.close()
+        info['records'] = len(lines)
     print('results written to', outfile)
 
 
-def main():
-    args = docopt(__doc__)
+def main(argv=None):
+    args = docopt(__doc__, argv)
     print(args)
     if '--seed' in args:
         random.seed(args['--seed'])
+    metrics.start(args['--metrics'], args['--profile'])
+    try:
+        run_command(args)
+    finally:
+        metrics.save('analyze')
+
+
+def run_command(args):
     if args['--network']:
-        analyze_followers(args['--brand-followers'], args['--exemplar-followers'], args['--output'], args['--network-method'],
-                          int(args['--min-followers']), int(float(args['--max-followers'])), float(args['--sample-exemplars']))
+        if args['--exemplar-manifest']:
+            exemplar_files = read_manifest(args['--exemplar-manifest'])
+        elif len(args['--exemplar-followers']) > 1:
+            exemplar_files = list(zip(category_names(args['--exemplar-followers']), args['--exemplar-followers']))
+        else:
+            exemplar_files = args['--exemplar-followers'][0]
+        try:
+            shard = parse_shard(args['--shard']) if args['--shard'] else None
+        except ValueError as e:
+            exit(str(e))
+        if args['--backend'] not in BACKENDS:
+            exit('unknown --backend %s; choose from %s' % (args['--backend'], ', '.join(BACKENDS)))
+        try:
+            analyze_followers(args['--brand-followers'], exemplar_files, args['--output'], args['--network-method'],
+                              int(args['--min-followers']), int(float(args['--max-followers'])), float(args['--sample-exemplars']),
+                              index_dir=args['--index-dir'], k=int(args['--top-k']) if args['--top-k'] else None,
+                              bloom=float(args['--bloom']) if args['--bloom'] else None,
+                              partitions=int(args['--partitions']) if args['--partitions'] else None, tmpdir=args['--tmp-dir'],
+                              shard=shard, precompute_only=args['--precompute'], backend=args['--backend'],
+                              max_memory=float(args['--max-memory']) * 1e6 if args['--max-memory'] else None)
+        except ValueError as e:
+            exit('cannot analyze followers: %s' % e)
     if args['--text']:
-        analyze_text(args['--brand-tweets'], args['--exemplar-tweets'], args['--sample-tweets'], args['--output'], args['--text-method'])
+        window = dict(since=args['--since'], until=args['--until'],
+                      rolling=int(args['--rolling']) if args['--rolling'] else None)
+        if args['--text-stats']:
+            analyze_text_stats(args['--text-stats'], args['--exemplar-tweets'], args['--sample-tweets'],
+                               int(args['--window']) if args['--window'] else None, args['--brand-tweets'],
+                               args['--output'], args['--save-model'], **window)
+        elif args['--text-model']:
+            score_text_file(args['--brand-tweets'], args['--text-model'], args['--output'], **window)
+        elif args['--features']:
+            try:
+                analyze_text_features(args['--brand-tweets'], args['--exemplar-tweets'], args['--sample-tweets'], args['--output'],
+                                      args['--text-method'], [parse_features(spec) for spec in args['--features']],
+                                      args['--save-model'], **window)
+            except ValueError as e:
+                exit('cannot fit features: %s' % e)
+        else:
+            analyze_text(args['--brand-tweets'], args['--exemplar-tweets'], args['--sample-tweets'], args['--output'],
+                         args['--text-method'], args['--save-model'], **window)
 
 
 if __name__ == '__main__':
@@ -9,16 +9,19 @@ The most commonly used brandelion commands are:
      analyze    Compute brand analytics scores.
      collect    Collect brand Twitter information.
      diagnose   Run diagnostics.
+     merge      Merge the outputs of sharded analyze runs.
+     partition  Partition collected tweets by day or week.
      report     Summarize the results of the analysis
+     serve      Serve scores over HTTP from an in-memory exemplar index.
 See 'brandelion help <command>' for more information on a specific command.
 
 """
-from subprocess import call
 from docopt import docopt
+from importlib import import_module
 
 from .. import __version__
 
-CMDS = ['analyze', 'collect', 'diagnose', 'report']
+CMDS = ['analyze', 'collect', 'diagnose', 'merge', 'partition', 'report', 'serve']
 
 
 def main():
@@ -28,9 +31,12 @@ def main():
 
     argv = [args['<command>']] + args['<args>']
     if args['<command>'] in CMDS:
-        exit(call(['brandelion-%s' % args['<command>']] + argv))
+        # Run the subcommand in this interpreter; its heavy imports are lazy.
+        exit(import_module('.' + args['<command>'], __package__).main(argv))
     elif args['<command>'] in ['help', None]:
-        exit(call(['brandelion', '--help']))
+        if args['<args>'] and args['<args>'][0] in CMDS:
+            exit(import_module('.' + args['<args>'][0], __package__).main([args['<args>'][0], '--help']))
+        exit(docopt(__doc__, argv=['--help']))
     else:
         exit("%r is not a brandelion command. See 'brandelion help'." % args['<command>'])
 
@@ -3,9 +3,9 @@
 """Collect Twitter data for brands.
 
 usage:
-    brandelion collect --tweets --input <file> --output <file> --max=<N>
-    brandelion collect --followers --input <file> --output <file> --max=<N> [--loop]
-    brandelion collect --exemplars --query <string>  --output <file>
+    brandelion collect --tweets --input <file> --output <file> --max=<N> [--metrics <file> --profile <stage>]
+    brandelion collect --followers --input <file> --output <file> --max=<N> [--loop --metrics <file> --profile <stage>]
+    brandelion collect --exemplars --query <string>  --output <file> [--cache <dir> --cache-ttl <hours> --threads <n> --metrics <file> --profile <stage>]
 
 Options
     -h, --help
@@ -17,31 +17,36 @@ Options
     -e, --exemplars                 Fetch exemplars from Twitter lists
     -q, --query <string>            A single string used to search for Twitter lists.
     -m, --max=<N>                   Maximum number of followers or tweets to collect per account [default: 50000].
+    --cache <dir>                   Directory to cache search results and Twitter list members [default: ~/.brandelion_cache].
+    --cache-ttl <hours>             Refetch cached searches and lists older than this many hours [default: 168].
+    --threads <n>                   Number of search pages or lists to fetch concurrently [default: 4].
+    --metrics <file>                Write the time of each stage, API latencies and rate limit waits to this json file.
+    --profile <stage>               Run this stage (e.g., list_members) under cProfile, saving its stats next to --metrics.
 """
 
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 from docopt import docopt
 import gzip
+import hashlib
 import io
 import json
+import os
 import re
 import requests
 import sys
+import threading
 import time
 import traceback
 import requests
 
-import twutil
-
 import json
 import time
 
 ##import config from init.py:
-from .. import config
-
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError as GoogleHttpError
+from .. import get_config
+from . import metrics, report
 
 
 def iter_lines(filename):
@@ -58,20 +63,27 @@ def fetch_followers(account_file, outfile, limit, do_loop):
     account_file. Write results to outfile file in format:
 
     screen_name user_id follower_id_1 follower_id_2 ..."""
+    import twutil
+
     print('Fetching followers for accounts in %s' % account_file)
     niters = 1
+    report.mkdirs(os.path.dirname(outfile))
     while True:
-        outf = gzip.open(outfile, 'wt')
-        for screen_name in iter_lines(account_file):
-            timestamp = datetime.datetime.now().isoformat()
-            print('collecting followers for', screen_name)
-            followers = twutil.collect.followers_for_screen_name(screen_name, limit)
-            if len(followers) > 0:
-                outf.write('%s %s %s\n' % (timestamp, screen_name, ' '.join(followers)))
-                outf.flush()
-            else:
-                print('unknown user', screen_name)
-        outf.close()
+        with metrics.stage('followers') as info:
+            info['records'] = 0
+            outf = gzip.open(outfile, 'wt')
+            for screen_name in iter_lines(account_file):
+                timestamp = datetime.datetime.now().isoformat()
+                print('collecting followers for', screen_name)
+                with metrics.record_sleeps(twutil.collect), metrics.timed_event('twitter_followers'):
+                    followers = twutil.collect.followers_for_screen_name(screen_name, limit)
+                if len(followers) > 0:
+                    outf.write('%s %s %s\n' % (timestamp, screen_name, ' '.join(followers)))
+                    outf.flush()
+                    info['records'] += 1
+                else:
+                    print('unknown user', screen_name)
+            outf.close()
         if not do_loop:
             return
         else:
@@ -85,14 +97,22 @@ def fetch_followers(account_file, outfile, limit, do_loop):
 def fetch_tweets(account_file, outfile, limit):
     """ Fetch up to limit tweets for each account in account_file and write to
     outfile. """
+    import twutil
+
     print('fetching tweets for accounts in', account_file)
+    report.mkdirs(os.path.dirname(outfile))
     outf = io.open(outfile, 'wt')
-    for screen_name in iter_lines(account_file):
-        print('\nFetching tweets for %s' % screen_name)
-        for tweet in twutil.collect.tweets_for_user(screen_name, limit):
-            tweet['user']['screen_name'] = screen_name
-            outf.write('%s\n' % json.dumps(tweet, ensure_ascii=False))
-            outf.flush()
+    with metrics.stage('tweets') as info:
+        info['records'] = 0
+        for screen_name in iter_lines(account_file):
+            print('\nFetching tweets for %s' % screen_name)
+            with metrics.record_sleeps(twutil.collect), metrics.timed_event('twitter_tweets'):
+                tweets = twutil.collect.tweets_for_user(screen_name, limit)
+            for tweet in tweets:
+                tweet['user']['screen_name'] = screen_name
+                outf.write('%s\n' % json.dumps(tweet, ensure_ascii=False))
+                outf.flush()
+                info['records'] += 1
 
 
 #DEPRECATED
@@ -122,61 +142,227 @@ def fetch_tweets(account_file, outfile, limit):
 
 
 #NEW FETCH lists
-def google_search(search_term, api_key, cse_id, **kwargs):
+def read_cache(path, ttl):
+    """ Return the json object cached at path, or None if it is missing or
+    older than ttl seconds. """
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with io.open(path, 'rt', encoding='utf8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_cache(path, obj):
+    """ Atomically write a json object to path, so concurrent readers never
+    see a partial file. """
+    report.mkdirs(os.path.dirname(path))
+    with report.atomic_open(path, 'wt', encoding='utf8') as f:
+        f.write(json.dumps(obj, ensure_ascii=False))
+
+
+_google_services = threading.local()
+# Most Custom Search requests to send per second, across threads, and how
+# many times to retry a request refused for exceeding the rate limit,
+# waiting search_backoff seconds, doubled after each retry.
+search_rate = 5.
+search_retries = 4
+search_backoff = 1.
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+class RateLimiter(object):
+    """ Space calls to wait() at least 1 / rate seconds apart, across threads. """
+
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate else 0.
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            with metrics.timed_event('google_rate_limit_wait'):
+                time.sleep(delay)
+
+
+def is_rate_limited(error):
+    """ Return True if a Google API HttpError asks us to slow down, rather than
+    failing for good (e.g., when the daily quota is used up). """
+    if error.resp.status == 429:
+        return True
+    content = error.content.decode('utf8', 'replace') if isinstance(error.content, bytes) else str(error.content)
+    return error.resp.status == 403 and any(reason in content for reason in RATE_LIMIT_REASONS)
+
+
+def google_service(api_key):
+    """ Return a customsearch client for this api key, built once per thread
+    (the underlying http connection is not thread safe). """
+    from googleapiclient.discovery import build
+
+    services = _google_services.__dict__.setdefault('services', {})
+    if api_key not in services:
+        services[api_key] = build("customsearch", "v1", developerKey=api_key, cache_discovery=False)
+    return services[api_key]
+
+
+def search_cache_path(cache_dir, search_term, cse_id, **kwargs):
+    """ Path of the cached results for this query. """
+    key = json.dumps([search_term, cse_id, sorted(kwargs.items())])
+    return os.path.join(cache_dir, 'search', hashlib.sha1(key.encode('utf8')).hexdigest() + '.json')
+
+
+def google_search(search_term, api_key, cse_id, service=None, cache_dir=None, ttl=24 * 3600, limiter=None, **kwargs):
+    """ Return the urls of one page of Google Custom Search results. Results
+    less than ttl seconds old are read from cache_dir, if given. service may be
+    any object with the customsearch interface, and defaults to a shared client.
+    Requests wait their turn with limiter, if given, and are retried with
+    backoff when the API says we exceeded its rate limit. """
+    from googleapiclient.errors import HttpError as GoogleHttpError
+
+    if cache_dir:
+        path = search_cache_path(cache_dir, search_term, cse_id, **kwargs)
+        final_urls = read_cache(path, ttl)
+        if final_urls is not None:
+            return final_urls
     final_urls = []
     try:
-        service = build("customsearch", "v1", developerKey=api_key)
-        res = service.cse().list(q=search_term, cx=cse_id, **kwargs).execute()
-        for item in res['items']:
+        if service is None:
+            service = google_service(api_key)
+        for attempt in range(search_retries + 1):
+            if limiter:
+                limiter.wait()
+            try:
+                with metrics.timed_event('google_search'):
+                    res = service.cse().list(q=search_term, cx=cse_id, **kwargs).execute()
+                break
+            except GoogleHttpError as e:
+                if attempt == search_retries or not is_rate_limited(e):
+                    raise
+                print('Google rate limit exceeded, retrying in %gs' % (search_backoff * 2 ** attempt))
+                with metrics.timed_event('google_rate_limit_wait'):
+                    time.sleep(search_backoff * 2 ** attempt)
+        for item in res.get('items', []):
             final_urls.append(item['formattedUrl'])
+    except GoogleHttpError as e:
+        print("something wrong with Google HTTP Error: %s" % e)
         return final_urls
-    except GoogleHttpError:
-        print("something wrong with Google HTTP Errpr")
-        return final_urls
+    if cache_dir and len(final_urls) > 0:  # don't cache failed requests.
+        write_cache(path, final_urls)
+    return final_urls
 
 
-def fetch_lists(keyword,max_results=20):
+def fetch_lists(keyword, max_results=20, cache_dir=None, ttl=24 * 3600, nthreads=4, service=None):
     """
     Fetch the urls of up to max_results Twitter lists that match the provided keyword.
+    Pages are requested nthreads at a time, but no faster than search_rate
+    requests a second, and we stop early once a page is empty or contains only
+    urls we've already seen. The API serves at most 100 results (10 pages) per query.
     >>> len(fetch_lists('politics', max_results=4))
     4
     """
     #CONFIG FILE READ
+    config = get_config()
     api_key=config.get('GOOGLE_CSE_KEYS','API_KEY')
     cse_id=config.get('GOOGLE_CSE_KEYS','CSE_ID')
 
     results = []
-    start_c = 1
+    seen = set()
     search_term = "inurl:lists + "+keyword
-    while len(results)<max_results:
-        temp_res = google_search(search_term,api_key,cse_id,num=10,start=start_c)
-        if len(temp_res) == 0:
-            print("Google API Error, returning retrieved results")
-            return results
-        results.extend(temp_res)
-        start_c += 10
+    starts = list(range(1, min(max_results, 100) + 1, 10))
+    limiter = RateLimiter(search_rate)
+
+    def search(start):
+        return google_search(search_term, api_key, cse_id, service=service, cache_dir=cache_dir,
+                             ttl=ttl, limiter=limiter, num=10, start=start)
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as pool:
+        while len(results) < max_results and len(starts) > 0:
+            batch, starts = starts[:nthreads], starts[nthreads:]
+            for temp_res in pool.map(search, batch):
+                if len(temp_res) == 0:
+                    print("Google API Error, returning retrieved results")
+                    return results[:max_results]
+                new_res = [r for r in temp_res if r not in seen]
+                if len(new_res) == 0:
+                    print("Google API returned no new results, returning retrieved results")
+                    return results[:max_results]
+                seen.update(new_res)
+                results.extend(new_res)
     return results[:max_results]
 
-def fetch_list_members(list_url):
-    """ Get all members of the list specified by the given url. E.g., https://twitter.com/lore77/lists/libri-cultura-education """
-    match = re.match(r'.+twitter\.com\/(.+)\/lists\/(.+)', list_url)
+
+def parse_list_url(list_url):
+    """ Return the (owner screen_name, slug) of a Twitter list url, or None.
+    >>> parse_list_url('https://twitter.com/lore77/lists/libri-cultura-education/members')
+    ('lore77', 'libri-cultura-education')
+    """
+    match = re.match(r'.+twitter\.com\/([^/]+)\/lists\/([^/?#]+)', list_url)
     if not match:
+        return None
+    return match.groups()
+
+
+def list_cache_path(cache_dir, screen_name, slug):
+    """ Path of the cached members of list screen_name/slug. """
+    key = re.sub(r'[^\w\-]', '_', '%s__%s' % (screen_name.lower(), slug.lower()))
+    return os.path.join(cache_dir, 'lists', key + '.json')
+
+
+def fetch_list_members(list_url, cache_dir=None, ttl=7 * 24 * 3600):
+    """ Get all members of the list specified by the given url. E.g., https://twitter.com/lore77/lists/libri-cultura-education
+    If cache_dir is given, members fetched less than ttl seconds ago are
+    read from disk instead of Twitter. """
+    import twutil
+
+    parsed = parse_list_url(list_url)
+    if not parsed:
         print('cannot parse list url %s' % list_url)
         return []
-    screen_name, slug = match.groups()
+    screen_name, slug = parsed
+    if cache_dir:
+        path = list_cache_path(cache_dir, screen_name, slug)
+        members = read_cache(path, ttl)
+        if members is not None:
+            print('using cached list %s/%s' % (screen_name, slug))
+            return members
     print('collecting list %s/%s' % (screen_name, slug))
-    return twutil.collect.list_members(slug, screen_name)
+    with metrics.record_sleeps(twutil.collect), metrics.timed_event('twitter_list_members'):
+        members = twutil.collect.list_members(slug, screen_name)
+    if cache_dir and len(members) > 0:  # don't cache failed requests.
+        write_cache(path, members)
+    return members
+
+
+def fetch_all_list_members(list_urls, cache_dir=None, ttl=7 * 24 * 3600, nthreads=4):
+    """ Fetch the members of each list concurrently, fetching each distinct
+    owner/slug only once. Return a list of member lists, one per distinct list. """
+    unique_urls = {}
+    for list_url in list_urls:
+        parsed = parse_list_url(list_url)
+        key = tuple(x.lower() for x in parsed) if parsed else list_url
+        unique_urls.setdefault(key, list_url)
+    with ThreadPoolExecutor(max_workers=max(1, nthreads)) as pool:
+        return list(pool.map(lambda u: fetch_list_members(u, cache_dir, ttl), unique_urls.values()))
 
 
-def fetch_exemplars(keyword, outfile, n=50):
+def fetch_exemplars(keyword, outfile, n=50, cache_dir=None, ttl=7 * 24 * 3600, nthreads=4):
     """ Fetch top lists matching this keyword, then return Twitter screen
     names along with the number of different lists on which each appers.. """
-    list_urls = fetch_lists(keyword, n)
+    with metrics.stage('search_lists') as info:
+        list_urls = fetch_lists(keyword, n, cache_dir, ttl, nthreads)
+        info['records'] = len(list_urls)
     print('found %d lists for %s' % (len(list_urls), keyword))
     counts = Counter()
-    for list_url in list_urls:
-        counts.update(fetch_list_members(list_url))
+    with metrics.stage('list_members') as info:
+        for members in fetch_all_list_members(list_urls, cache_dir, ttl, nthreads):
+            counts.update(members)
+        info['records'] = len(list_urls)
     # Write to file.
+    report.mkdirs(os.path.dirname(outfile))
     outf = io.open(outfile, 'wt')
     for handle in sorted(counts):
         outf.write('%s\t%d\n' % (handle, counts[handle]))
@@ -184,14 +370,19 @@ def fetch_exemplars(keyword, outfile, n=50):
     print('saved exemplars to', outfile)
 
 
-def main():
-    args = docopt(__doc__)
-    if args['--followers']:
-        fetch_followers(args['--input'], args['--output'], int(args['--max']), args['--loop'])
-    elif args['--tweets']:
-        fetch_tweets(args['--input'], args['--output'], int(args['--max']))
-    else:
-        fetch_exemplars(args['--query'], args['--output'])
+def main(argv=None):
+    args = docopt(__doc__, argv)
+    metrics.start(args['--metrics'], args['--profile'])
+    try:
+        if args['--followers']:
+            fetch_followers(args['--input'], args['--output'], int(args['--max']), args['--loop'])
+        elif args['--tweets']:
+            fetch_tweets(args['--input'], args['--output'], int(args['--max']))
+        else:
+            fetch_exemplars(args['--query'], args['--output'], cache_dir=os.path.expanduser(args['--cache']),
+                            ttl=float(args['--cache-ttl']) * 3600, nthreads=int(args['--threads']))
+    finally:
+        metrics.save('collect')
 
 
 if __name__ == '__main__':
@@ -3,7 +3,7 @@
 """Run diagnostics on a dataset.
 
 usage:
-    brandelion diagnose --network --brand-followers <file> --exemplar-followers <file> --validation <file> --output <file> [--network-method <string>]
+    brandelion diagnose --network --brand-followers <file> --exemplar-followers <file> --validation <file> --output <file> [--network-method <string> --metrics <file> --profile <stage>]
 
 Options
     -h, --help
@@ -14,14 +14,15 @@ Options
     -o, --output <file>           File to store results
     -t, --text                    Analyze text.
     -v, --validation <file>       File containing third-party scores for each brand by Twitter name, (e.g., surveys), for comparison.
+    --metrics <file>              Write the wall time, CPU time, peak memory and throughput of each stage to this json file.
+    --profile <stage>             Run this stage (e.g., correlate) under cProfile, saving its stats next to --metrics.
 """
 
 from docopt import docopt
 import os
-import scipy.stats as scistat
 import random
 
-from . import analyze, report
+from . import analyze, metrics, report
 
 
 random.seed(123)
@@ -37,6 +38,8 @@ def read_scores(fname):
 
 
 def validate(scores, validation):
+    import scipy.stats as scistat
+
     keys = sorted(validation.keys())
     predicted = [scores[k] for k in keys]
     truth = [validation[k] for k in keys]
@@ -49,6 +52,8 @@ def diagnose_text(brand_tweets_file, exemplar_tweets_file, sample_tweets_file, v
 
 def correlation_by_exemplar(brands, exemplars, validation_scores, analyze_fn_str, outf):
     """ Report the overall correlation with the validation scores using each exemplar in isolation. """
+    import scipy.stats as scistat
+
     analyze_fn = getattr(analyze, analyze_fn_str)
     keys = sorted(k for k in validation_scores.keys() if k in set(x[0] for x in brands))
     truth = [validation_scores[k] for k in keys]
@@ -73,20 +78,28 @@ def mkdirs(filename):
 def diagnose_followers(brand_follower_file, exemplar_follower_file, validation_file, analyze_fn, output_file):
     mkdirs(output_file)
     outf = open(output_file, 'wt')
-    brands = analyze.read_follower_file(brand_follower_file).items()
-    exemplars = analyze.read_follower_file(exemplar_follower_file, blacklist=analyze.get_twitter_handles(brand_follower_file))
+    with metrics.stage('read_brands') as info:
+        brands = analyze.read_follower_file(brand_follower_file).items()
+        info['records'] = len(brands)
+    with metrics.stage('read_exemplars') as info:
+        exemplars = analyze.read_follower_file(exemplar_follower_file, blacklist=analyze.get_twitter_handles(brand_follower_file))
+        info['records'] = len(exemplars)
     print('read follower data for %d exemplars' % (len(exemplars)))
     scores = report.read_scores(validation_file)
-    return correlation_by_exemplar(brands, exemplars, scores, analyze_fn, outf)
+    with metrics.stage('correlate') as info:
+        info['records'] = len(exemplars)
+        return correlation_by_exemplar(brands, exemplars, scores, analyze_fn, outf)
 
 
-def main():
-    args = docopt(__doc__)
+def main(argv=None):
+    args = docopt(__doc__, argv)
     print(args)
-    if '--network' in args:
-        diagnose_followers(args['--brand-followers'], args['--exemplar-followers'], args['--validation'], args['--network-method'], args['--output'])
-    if '--text' in args:
-        diagnose_text(args['--brand-tweets'], args['--exemplar-tweets'], args['--sample-tweets'], args['--validation'], args['--text-method'])
+    metrics.start(args['--metrics'], args['--profile'])
+    try:
+        if args['--network']:
+            diagnose_followers(args['--brand-followers'], args['--exemplar-followers'], args['--validation'], args['--network-method'], args['--output'])
+    finally:
+        metrics.save('diagnose')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Merge the outputs of sharded analyze runs into one score file.
+
+usage:
+    brandelion merge --output <file> <shard>...
+
+Options
+    -h, --help
+    -o, --output <file>     File to store the merged results.
+"""
+
+from docopt import docopt
+import hashlib
+import heapq
+import io
+import os
+
+from . import report
+
+
+def read_shard(fname):
+    """ Return the header fields and result lines of a shard output file. """
+    with io.open(fname, 'rt', encoding='utf8') as f:
+        header = f.readline().split()
+        lines = [line.rstrip('\n') for line in f]
+    fields = dict(x.split('=', 1) for x in header[3:] if '=' in x)
+    shard = header[2].split('/') if len(header) > 2 else []
+    valid = header[:2] == ['#', 'shard'] and len(shard) == 2 and all(x.isdigit() for x in shard)
+    if not valid or not all(key in fields for key in ('run', 'brands', 'k', 'sha1')):
+        raise ValueError('%s is not the output of analyze --shard' % fname)
+    fields['shard'], fields['nshards'] = int(shard[0]), int(shard[1])
+    body = ''.join(line + '\n' for line in lines)
+    if hashlib.sha1(body.encode('utf8')).hexdigest() != fields['sha1']:
+        raise ValueError('checksum mismatch in %s; the file is truncated or corrupt' % fname)
+    if sum(1 for line in lines if not line.startswith('#')) != int(fields['brands']):
+        raise ValueError('%s should have %s brands' % (fname, fields['brands']))
+    return fields, lines
+
+
+def merge_shards(fnames):
+    """ Check that fnames are all the shards of one run, each exactly once,
+    and return their combined result lines: sorted by brand, or, for --top-k
+    runs, the best k overall. """
+    shards = [(fname,) + read_shard(fname) for fname in fnames]
+    first = shards[0][1]
+    seen = {}
+    for fname, fields, _ in shards:
+        for key in ('run', 'nshards', 'k'):
+            if fields[key] != first[key]:
+                raise ValueError('%s has %s=%s, but %s has %s=%s' % (fname, key, fields[key], shards[0][0], key, first[key]))
+        if fields['shard'] in seen:
+            raise ValueError('shard %d appears twice: %s and %s' % (fields['shard'], seen[fields['shard']], fname))
+        seen[fields['shard']] = fname
+    missing = sorted(set(range(first['nshards'])) - set(seen))
+    if missing:
+        raise ValueError('missing shards %s of %d' % (', '.join(str(i) for i in missing), first['nshards']))
+    headers = []
+    rows = {}
+    for fname, _, lines in shards:
+        for line in lines:
+            if line.startswith('#'):
+                if line not in headers:
+                    headers.append(line)
+                continue
+            brand = line.split()[0]
+            if brand in rows:
+                raise ValueError('brand %s appears in more than one shard' % brand)
+            rows[brand] = line
+    k = int(first['k'])
+    if k:
+        best = heapq.nlargest(k, rows, key=lambda b: (float(rows[b].split()[1]), b))
+        return headers + [rows[b] for b in best]
+    return headers + [rows[b] for b in sorted(rows)]
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv)
+    try:
+        lines = merge_shards(args['<shard>'])
+    except ValueError as e:
+        exit('cannot merge shards: %s' % e)
+    report.mkdirs(os.path.dirname(args['--output']))
+    with io.open(args['--output'], 'wt', encoding='utf8') as outf:
+        for line in lines:
+            outf.write(line + '\n')
+    print('merged %d shards into %s' % (len(args['<shard>']), args['--output']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""Record how long each stage of a command takes, for --metrics and --profile.
+
+A stage records its wall time, CPU time, the peak resident memory of the
+process so far, and, if it says how many records it handled, their
+throughput. Commands also record events, such as the latency of each API
+request, which are summarized by count, total and maximum seconds.
+
+Nothing is recorded unless start() was called, so stages cost nothing in
+normal runs.
+"""
+
+from contextlib import contextmanager
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+from . import report
+
+try:
+    import resource
+except ImportError:  # not available on Windows.
+    resource = None
+
+enabled = False
+# Name of the stage to run under cProfile, and the file to dump its stats to.
+profile_stage = None
+profile_file = None
+metrics_file = None
+_stages = []
+_events = {}
+_lock = threading.Lock()
+_started = None
+
+
+def start(fname=None, profile=None):
+    """ Start recording stages, to be written to fname as json by save().
+    If profile names a stage, that stage is run under cProfile and its stats
+    are dumped to <fname>.<stage>.prof (or <stage>.prof without fname). """
+    global enabled, profile_stage, profile_file, metrics_file, _started
+    if not fname and not profile:
+        return
+    enabled = True
+    metrics_file = fname
+    profile_stage = profile
+    profile_file = '%s.%s.prof' % (fname, profile) if fname else '%s.prof' % profile
+    _started = (time.time(), time.process_time())
+    del _stages[:]
+    _events.clear()
+
+
+def peak_rss_mb():
+    """ Return the peak resident memory of this process so far, in MB, or None if unknown. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1e6 if sys.platform == 'darwin' else peak / 1e3, 1)  # bytes on macOS, KB elsewhere.
+
+
+def _finish(record, wall, cpu):
+    record['wall_seconds'] = round(wall, 4)
+    record['cpu_seconds'] = round(cpu, 4)
+    record['peak_rss_mb'] = peak_rss_mb()
+    if record.get('records') is not None:
+        record['records_per_second'] = round(record['records'] / wall, 1) if wall > 0 else None
+
+
+@contextmanager
+def stage(name):
+    """ Record a stage of a command. The stage can set 'records' in the
+    yielded dict to the number of records it handled.
+    >>> with stage('count') as info:
+    ...     info['records'] = 10
+    """
+    if not enabled:
+        yield {}
+        return
+    record = {'stage': name, 'records': None}
+    with _lock:
+        _stages.append(record)
+    profiler = None
+    if name == profile_stage:
+        import cProfile
+        profiler = cProfile.Profile()
+    start_wall, start_cpu = time.time(), time.process_time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+            print('profile of %s written to %s' % (name, profile_file))
+        _finish(record, time.time() - start_wall, time.process_time() - start_cpu)
+
+
+class TimedIterable(object):
+    """ Wrap an iterable (e.g., a FollowerFile), recording the time spent
+    producing its items as a stage of its own, apart from the time spent
+    using them. Like the iterable, it can be iterated more than once. """
+
+    def __init__(self, iterable, name):
+        self.iterable = iterable
+        self.name = name
+
+    def __getattr__(self, attr):
+        # Pass on attributes, such as a FollowerFile's fname, that callers look for.
+        if attr == 'iterable':
+            raise AttributeError(attr)
+        return getattr(self.iterable, attr)
+
+    def __iter__(self):
+        if not enabled:
+            for item in self.iterable:
+                yield item
+            return
+        record = {'stage': self.name, 'records': 0}
+        with _lock:
+            _stages.append(record)
+        wall = cpu = 0.
+        it = iter(self.iterable)
+        try:
+            while True:
+                start_wall, start_cpu = time.time(), time.process_time()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+                finally:
+                    wall += time.time() - start_wall
+                    cpu += time.process_time() - start_cpu
+                record['records'] += 1
+                yield item
+        finally:
+            _finish(record, wall, cpu)
+
+
+def timed(iterable, name):
+    """ Return iterable, wrapped to record the time spent reading it if metrics are enabled. """
+    return TimedIterable(iterable, name) if enabled else iterable
+
+
+def event(name, seconds):
+    """ Record an event that took seconds, such as an API request. Thread safe. """
+    if not enabled:
+        return
+    with _lock:
+        summary = _events.setdefault(name, {'count': 0, 'total_seconds': 0., 'max_seconds': 0.})
+        summary['count'] += 1
+        summary['total_seconds'] += seconds
+        summary['max_seconds'] = max(summary['max_seconds'], seconds)
+
+
+@contextmanager
+def timed_event(name):
+    """ Record the time taken by the enclosed block as an event. """
+    start = time.time()
+    try:
+        yield
+    finally:
+        event(name, time.time() - start)
+
+
+class _SleepRecorder(object):
+    """ Stands in for the time module of a client library, recording each
+    sleep as a rate limit wait. """
+
+    def __init__(self, name):
+        self._name = name
+
+    def sleep(self, seconds):
+        with timed_event(self._name):
+            time.sleep(seconds)
+
+    def __getattr__(self, attr):
+        return getattr(time, attr)
+
+
+_patched = {}
+
+
+@contextmanager
+def record_sleeps(module, name='rate_limit_wait'):
+    """ Within the block, record the sleeps of a client library module, such
+    as twutil.collect, which sleeps to wait out Twitter's rate limits, as
+    events. The module's time is restored when the last of any nested or
+    concurrent blocks exits. """
+    with _lock:
+        if module.__name__ not in _patched:
+            if not enabled or getattr(module, 'time', None) is not time:
+                module = None
+            else:
+                _patched[module.__name__] = [module.time, 0]
+                module.time = _SleepRecorder(name)
+        if module is not None:
+            _patched[module.__name__][1] += 1
+    try:
+        yield
+    finally:
+        if module is not None:
+            with _lock:
+                _patched[module.__name__][1] -= 1
+                if _patched[module.__name__][1] == 0:
+                    module.time = _patched.pop(module.__name__)[0]
+
+
+def save(command):
+    """ Write the stages and events recorded for command to the metrics file, as json. """
+    if not enabled or not metrics_file:
+        return
+    for summary in _events.values():
+        summary['total_seconds'] = round(summary['total_seconds'], 4)
+        summary['max_seconds'] = round(summary['max_seconds'], 4)
+    result = {'command': command, 'argv': sys.argv,
+              'wall_seconds': round(time.time() - _started[0], 4),
+              'cpu_seconds': round(time.process_time() - _started[1], 4),
+              'peak_rss_mb': peak_rss_mb(), 'stages': _stages, 'events': _events}
+    report.mkdirs(os.path.dirname(metrics_file))
+    with io.open(metrics_file, 'wt', encoding='utf8') as f:
+        f.write(json.dumps(result, indent=2))
+    print('metrics written to', metrics_file)
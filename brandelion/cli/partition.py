@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Partition collected tweets by the day or week they were created.
+
+usage:
+    brandelion partition --output <dir> [--period <period> --gzip] <tweets>...
+
+Options
+    -h, --help
+    -o, --output <dir>      Directory of partitions to create, or to add the tweets to.
+    --period <period>       Partition tweets by day or by week (starting Monday) [default: day]
+    --gzip                  Compress the partitions.
+
+Each partition holds the tweets of one day or week, one per line, sorted by
+account, with duplicate tweets (e.g., from overlapping collect runs) dropped.
+index.json lists the partitions, so that analyze --text --since/--until
+reads only those in range. Adding tweets rewrites only the partitions they fall in.
+"""
+
+import datetime
+from docopt import docopt
+import gzip
+import heapq
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from . import reader, report
+
+INDEX = 'index.json'
+PERIODS = {'day': 1, 'week': 7}
+# Most files to keep open at once while partitioning tweets or merging partitions.
+MAX_OPEN = 256
+
+
+def tweet_day(created_at):
+    """ Return the UTC day a tweet was created.
+    >>> tweet_day('Thu Jan 01 23:00:00 -0500 2015')
+    '2015-01-02'
+    """
+    created = datetime.datetime.strptime(created_at, '%a %b %d %H:%M:%S %z %Y')
+    return (created - created.utcoffset()).strftime('%Y-%m-%d')
+
+
+def parse_day(day):
+    """ Return the date of a YYYY-MM-DD string, raising ValueError for anything else. """
+    return datetime.datetime.strptime(day, '%Y-%m-%d').date()
+
+
+def period_key(day, period):
+    """ Return the first day of the period containing day.
+    >>> period_key('2015-01-01', 'day'), period_key('2015-01-01', 'week')
+    ('2015-01-01', '2014-12-29')
+    """
+    date = parse_day(day)
+    if period == 'week':
+        date -= datetime.timedelta(days=date.weekday())
+    return date.isoformat()
+
+
+def period_keys(first, last, period):
+    """ Return the keys of the periods from the one containing first to the one containing last.
+    >>> period_keys('2015-01-01', '2015-01-13', 'week')
+    ['2014-12-29', '2015-01-05', '2015-01-12']
+    """
+    date, end = parse_day(period_key(first, period)), parse_day(last)
+    keys = []
+    while date <= end:
+        keys.append(date.isoformat())
+        date += datetime.timedelta(days=PERIODS[period])
+    return keys
+
+
+def last_day(key, period):
+    """
+    >>> last_day('2014-12-29', 'week')
+    '2015-01-04'
+    """
+    return (parse_day(key) + datetime.timedelta(days=PERIODS[period] - 1)).isoformat()
+
+
+def in_range(day, since=None, until=None):
+    """ Return True if day is between since and until, inclusive; either may be None. """
+    return (since is None or day >= since) and (until is None or day <= until)
+
+
+def is_partitioned(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, INDEX))
+
+
+def read_index(dirname):
+    """ Return the index of a partition directory, or None if there is none. """
+    if not is_partitioned(dirname):
+        return None
+    with io.open(os.path.join(dirname, INDEX), 'rt', encoding='utf8') as f:
+        return json.load(f)
+
+
+def write_json(path, obj):
+    with report.atomic_open(path, 'wt', encoding='utf8') as f:
+        f.write(json.dumps(obj, indent=1, sort_keys=True))
+
+
+def open_lines(fname):
+    """ Return a binary file of the lines of a partition. Unlike
+    reader.iter_lines this starts no thread, so that many partitions can be
+    read at once. """
+    return gzip.open(fname, 'rb') if reader.is_compressed(fname) else open(fname, 'rb')
+
+
+def read_partition(fname):
+    """ Yield the tweets of a partition file. """
+    with open_lines(fname) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def screen_name(tweet):
+    return tweet['user']['screen_name'].lower()
+
+
+def tweet_id(tweet):
+    return tweet.get('id_str') or tweet.get('id')
+
+
+def write_partition(fname, tweets):
+    """ Write tweets to fname, atomically, sorted by account; tweets of an
+    account keep their order. Return the number of accounts. """
+    tweets.sort(key=screen_name)
+    with report.atomic_open(fname, 'wb', gzip.open if reader.is_compressed(fname) else io.open) as f:
+        for tweet in tweets:
+            f.write(json.dumps(tweet, ensure_ascii=False).encode('utf8') + b'\n')
+    return len(set(screen_name(t) for t in tweets))
+
+
+def spill_tweets(json_files, spill_dir, period):
+    """ Append each tweet in json_files to a file in spill_dir named by its
+    partition key, and return the keys. Only MAX_OPEN files are kept open. """
+    handles = {}
+    keys = set()
+    try:
+        for json_file in json_files:
+            for line in reader.iter_lines(json_file):
+                try:
+                    obj = json.loads(line)
+                    for tweet in (obj if isinstance(obj, list) else [obj]):
+                        key = period_key(tweet_day(tweet['created_at']), period)
+                        if key not in handles:
+                            if len(handles) >= MAX_OPEN:
+                                for f in handles.values():
+                                    f.close()
+                                handles.clear()
+                            handles[key] = open(os.path.join(spill_dir, key), 'ab')
+                        handles[key].write(json.dumps(tweet, ensure_ascii=False).encode('utf8') + b'\n')
+                        keys.add(key)
+                except Exception as e:
+                    sys.stderr.write('skipping json error: %s\n' % e)
+    finally:
+        for f in handles.values():
+            f.close()
+    return keys
+
+
+def partition_tweets(json_files, outdir, period='day', compress=False):
+    """ Add the tweets in json_files, as written by collect --tweets, to the
+    partitions in outdir, and update its index. Only the partitions that
+    receive tweets are read and rewritten, one at a time. """
+    if period not in PERIODS:
+        raise ValueError('unknown period %s; choose day or week' % period)
+    index = read_index(outdir) or {'period': period, 'partitions': {}}
+    if index['period'] != period:
+        raise ValueError('%s is partitioned by %s, not %s' % (outdir, index['period'], period))
+    report.mkdirs(outdir)
+    spill_dir = tempfile.mkdtemp(dir=outdir, prefix='.spill')
+    try:
+        keys = spill_tweets(json_files, spill_dir, period)
+        for key in sorted(keys):
+            old = index['partitions'].get(key)
+            tweets = []
+            seen = set()
+            sources = ([os.path.join(outdir, old['file'])] if old else []) + [os.path.join(spill_dir, key)]
+            for source in sources:
+                for tweet in read_partition(source):
+                    tid = tweet_id(tweet)
+                    if tid is None or tid not in seen:
+                        seen.add(tid)
+                        tweets.append(tweet)
+            fname = key + ('.json.gz' if compress else '.json')
+            accounts = write_partition(os.path.join(outdir, fname), tweets)
+            if old and old['file'] != fname:
+                os.remove(os.path.join(outdir, old['file']))
+            index['partitions'][key] = {'file': fname, 'tweets': len(tweets), 'accounts': accounts}
+    finally:
+        shutil.rmtree(spill_dir)
+    write_json(os.path.join(outdir, INDEX), index)
+    print('added tweets to %d %s partitions in %s' % (len(keys), period, outdir))
+    return index
+
+
+def partitions_in_range(index, since=None, until=None):
+    """ Return the sorted keys of the partitions with days between since and until, inclusive. """
+    return [key for key in sorted(index['partitions'])
+            if in_range(key, None, until) and in_range(last_day(key, index['period']), since, None)]
+
+
+def iter_partitions(dirname, since=None, until=None):
+    """ Yield the key of each partition in range, in order, with a generator
+    of its tweets created between since and until. """
+    index = read_index(dirname)
+    for key in partitions_in_range(index, since, until):
+        tweets = read_partition(os.path.join(dirname, index['partitions'][key]['file']))
+        if not (in_range(key, since, until) and in_range(last_day(key, index['period']), since, until)):
+            tweets = (t for t in tweets if in_range(tweet_day(t['created_at']), since, until))
+        yield key, tweets
+
+
+def read_tweets(dirname, since=None, until=None):
+    """ Yield the tweets created between since and until, inclusive, grouped
+    by account, and in order of partition within an account. Since each
+    partition is sorted by account, they are merged without sorting, reading
+    only the partitions in range. """
+    runs = [tweets for _, tweets in iter_partitions(dirname, since, until)]
+    if len(runs) <= MAX_OPEN:
+        return heapq.merge(*runs, key=screen_name)
+    return merge_in_passes(runs)
+
+
+def merge_in_passes(runs):
+    """ Yield the tweets of runs, each sorted by account, merged as
+    heapq.merge would, but with at most MAX_OPEN files open at once: each
+    pass merges groups of MAX_OPEN runs into temporary files, in order, so
+    tweets of an account keep the order of their runs. """
+    tmpdir = tempfile.mkdtemp(prefix='brandelion-merge')
+    try:
+        npass = 0
+        while len(runs) > MAX_OPEN:
+            merged = []
+            for i in range(0, len(runs), MAX_OPEN):
+                fname = os.path.join(tmpdir, '%d-%d' % (npass, i))
+                with open(fname, 'wb') as f:
+                    for tweet in heapq.merge(*runs[i:i + MAX_OPEN], key=screen_name):
+                        f.write(json.dumps(tweet, ensure_ascii=False).encode('utf8') + b'\n')
+                merged.append(fname)
+            for fname in os.listdir(tmpdir):  # the runs of the previous pass are merged.
+                if not fname.startswith('%d-' % npass):
+                    os.remove(os.path.join(tmpdir, fname))
+            runs = [read_partition(fname) for fname in merged]
+            npass += 1
+        for tweet in heapq.merge(*runs, key=screen_name):
+            yield tweet
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv)
+    try:
+        partition_tweets(args['<tweets>'], args['--output'], args['--period'], args['--gzip'])
+    except ValueError as e:
+        exit('cannot partition tweets: %s' % e)
+
+
+if __name__ == '__main__':
+    main()
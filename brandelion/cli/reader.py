@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Read large, possibly gzipped, files with decompression in the background.
+
+A background thread reads the file in large blocks, decompressing and
+splitting them into lines, and passes them on through a bounded queue, so
+that decompression and disk reads overlap with the caller's parsing.
+
+Gzipped files are decompressed with, in order of preference: python-isal's
+multi-threaded igzip, if installed; a pigz or igzip process, if on the path;
+or the gzip module (zlib releases the GIL, so this still overlaps).
+"""
+
+import gzip
+import os
+import shutil
+import subprocess
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Bytes to read at a time, and how many blocks of lines to read ahead.
+BLOCK_SIZE = 1 << 22
+QUEUE_SIZE = 8
+# Command line decompressors to try, in order, if python-isal isn't installed.
+DECOMPRESSORS = [['pigz', '-dc'], ['igzip', '-dc']]
+# Set to False to always decompress with the gzip module.
+external_decompressors = True
+
+_END = object()
+
+
+def is_compressed(fname):
+    """
+    >>> is_compressed('followers.txt.gz'), is_compressed('followers.txt')
+    (True, False)
+    """
+    return fname.endswith('gz')
+
+
+def open_binary(fname):
+    """ Return a binary file of the decompressed contents of fname, and the
+    decompressor process writing it, if any. """
+    if not is_compressed(fname):
+        return open(fname, 'rb'), None
+    if external_decompressors:
+        try:
+            from isal import igzip_threaded
+            return igzip_threaded.open(fname, 'rb', threads=min(4, os.cpu_count() or 1)), None
+        except ImportError:
+            pass
+        for command in DECOMPRESSORS:
+            path = shutil.which(command[0])
+            if path:
+                with open(fname, 'rb'):  # raise the usual error if fname is missing.
+                    pass
+                proc = subprocess.Popen([path] + command[1:] + [fname], stdout=subprocess.PIPE, bufsize=BLOCK_SIZE)
+                return proc.stdout, proc
+    return gzip.open(fname, 'rb'), None
+
+
+def _put(blocks, item, stop):
+    """ Put item on the queue, unless the reader stops first. """
+    while not stop.is_set():
+        try:
+            blocks.put(item, timeout=.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _read_blocks(fname, blocks, stop):
+    """ Put lists of the lines of fname on the queue blocks, then _END, or the exception that stopped us. """
+    try:
+        f, proc = open_binary(fname)
+        try:
+            rest = b''
+            while not stop.is_set():
+                block = f.read(BLOCK_SIZE)
+                if not block:
+                    break
+                lines = (rest + block).split(b'\n')
+                rest = lines.pop()
+                if lines and not _put(blocks, lines, stop):
+                    break
+            if rest and not stop.is_set():
+                _put(blocks, [rest], stop)
+        finally:
+            f.close()
+            if proc is not None:
+                if stop.is_set():
+                    proc.kill()
+                if proc.wait() != 0 and not stop.is_set():
+                    raise IOError('%s exited with status %d reading %s' % (proc.args[0], proc.returncode, fname))
+        _put(blocks, _END, stop)
+    except Exception as e:
+        _put(blocks, e, stop)
+
+
+def iter_lines(fname):
+    """ Yield the lines of fname as bytes, without the \n ending them (a \r
+    before it is kept, so each line takes len(line) + 1 bytes of the file),
+    decompressing gzipped files. The file is read and decompressed ahead, in
+    a background thread, up to QUEUE_SIZE blocks. """
+    blocks = queue.Queue(QUEUE_SIZE)
+    stop = threading.Event()
+    thread = threading.Thread(target=_read_blocks, args=(fname, blocks, stop))
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            lines = blocks.get()
+            if lines is _END:
+                break
+            if isinstance(lines, Exception):
+                raise lines
+            for line in lines:
+                yield line
+    finally:
+        stop.set()
+        thread.join()
@@ -3,23 +3,35 @@
 """Generate reports to summarize the results.
 
 usage:
-    brandelion report --scores <file> --output <directory> [--validation <file>]
+    brandelion report (--scores <file>)... --output <directory> [(--validation <file>)... --labels <n> --hexbin <n> --jobs <n> --show]
 
 Options
     -h, --help
     -o, --output <directory>  Path to write results.
-    -v, --validation <file>   File containing third-party scores for each brand by Twitter name, (e.g., surveys), for comparison.
-    -s, --scores <file>       File containing the predicted scores for each brand by Twitter name.
+    -v, --validation <file>   File containing third-party scores for each brand by Twitter name, (e.g., surveys), for comparison. Repeat to compare with several.
+    -s, --scores <file>       File containing the predicted scores for each brand by Twitter name. Repeat to report several.
+    --labels <n>              Label only the n brands the scores most overestimate and the n they most underestimate [default: 10]
+    --hexbin <n>              Plot the density of brands as hexagons instead of a scatter when there are more than n [default: 5000]
+    -j, --jobs <n>            Number of plots to render in parallel [default: 4]
+    --show                    Also show each plot in a window, waiting for it to be closed.
+
+Each pair of scores and validation file is plotted to <directory>/scatter.pdf,
+or, with several pairs, to <directory>/scatter-<scores>-<validation>.pdf,
+where files with the same name are told apart by their directories.
+Plots are rendered without a display, so reports can run in batch jobs.
 """
 
+from contextlib import contextmanager
 from docopt import docopt
 import errno
+import io
 import os
-import matplotlib.pyplot as plt
-import scipy.stats as scistat
+import threading
 
 
 def mkdirs(path):
+    if not path:  # current directory
+        return
     try:
         os.makedirs(path)
     except OSError as exc:
@@ -29,16 +41,55 @@ def mkdirs(path):
             raise
 
 
+@contextmanager
+def atomic_open(path, mode='wt', opener=io.open, **kwargs):
+    """ Open a temporary file, with opener (e.g., gzip.open), that replaces
+    path only once it is complete and closed, so readers never see a partial
+    file. Its name is unique to this process and thread; it is removed if
+    writing fails. """
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    try:
+        with opener(tmp, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
 def read_scores(fname):
     scores = {}
     for line in open(fname):
         parts = line.strip().lower().split()
-        if len(parts) > 1:
+        if len(parts) > 1 and not parts[0].startswith('#'):
             scores[parts[0]] = float(parts[1])
     return scores
 
 
-def validate(scores, validation, title, outdir, doplot=True):
+# Rasterize the points of scatter plots with more brands than this, so large PDFs stay quick to open.
+RASTERIZE = 1000
+
+
+def outliers(predicted, truth, n):
+    """ Return the indices of the n points furthest above and the n furthest
+    below the least squares line of truth on predicted.
+    >>> sorted(outliers([1, 2, 3, 4, 5], [1, 2, 9, 4, 0], 1))
+    [2, 4]
+    """
+    import numpy as np
+
+    predicted, truth = np.asarray(predicted, dtype=float), np.asarray(truth, dtype=float)
+    if len(predicted) <= 2 * n:
+        return list(range(len(predicted)))
+    slope, intercept = np.polyfit(predicted, truth, 1) if np.ptp(predicted) > 0 else (0., np.mean(truth))
+    order = np.argsort(truth - (slope * predicted + intercept))
+    return sorted(set(order[:n].tolist()) | set(order[-n:].tolist()))
+
+
+def validate(scores, validation, title, outdir, doplot=True, fname='scatter.pdf', nlabels=10, hexbin=5000, show=False):
+    import scipy.stats as scistat
+
     keys = sorted(validation.keys())
     keys = list(set(keys) & set(scores.keys()))
     predicted = [scores[k] for k in keys]
@@ -46,29 +97,100 @@ def validate(scores, validation, title, outdir, doplot=True):
     corr = scistat.pearsonr(predicted, truth)
     print('Pearson:', corr)
     if doplot:
-        plt.figure()
-        plt.scatter(predicted, truth)
-        plt.xlabel('predicted')
-        plt.ylabel('truth')
-        plt.xlim(min(predicted), max(predicted))
-        plt.ylim(min(truth), max(truth))
-        for x, y, label in zip(predicted, truth, keys):
-            plt.annotate(label, xy=(x, y), xytext=(0, 0),
-                         textcoords='offset points', size='10',
-                         bbox=dict(boxstyle='round,pad=0.0', edgecolor='white',
-                                   fc='white', alpha=0.9))
-            plt.title('%s\nr(%d)=%.3f (p=%g)' % (title, len(truth), corr[0], corr[1]))
-        plt.savefig(outdir + '/scatter.pdf')
-        plt.show()
+        import matplotlib
+        if not show:
+            matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots()
+        if len(keys) > hexbin:
+            ax.hexbin(predicted, truth, gridsize=50, bins='log', mincnt=1, cmap='Blues')
+        else:
+            ax.scatter(predicted, truth, rasterized=len(keys) > RASTERIZE)
+        ax.set_xlabel('predicted')
+        ax.set_ylabel('truth')
+        ax.set_xlim(min(predicted), max(predicted))
+        ax.set_ylim(min(truth), max(truth))
+        for i in outliers(predicted, truth, nlabels):
+            ax.annotate(keys[i], xy=(predicted[i], truth[i]), xytext=(0, 0),
+                        textcoords='offset points', size='10',
+                        bbox=dict(boxstyle='round,pad=0.0', edgecolor='white',
+                                  fc='white', alpha=0.9))
+        ax.set_title('%s\nr(%d)=%.3f (p=%g)' % (title, len(truth), corr[0], corr[1]))
+        fig.savefig(os.path.join(outdir, fname))
+        if show:
+            plt.show()
+        plt.close(fig)
     return corr[0]
 
 
-def main():
-    args = docopt(__doc__)
-    scores = read_scores(args['--scores'])
+def file_labels(fnames):
+    """ Return a label for each file: its name without its extension, or, if
+    two files share that, its path relative to the files' common directory,
+    with _ for /.
+    >>> file_labels(['run1/jaccard.txt', 'run2/jaccard.txt', 'run2/cosine.txt'])
+    ['run1_jaccard', 'run2_jaccard', 'run2_cosine']
+    """
+    labels = [os.path.splitext(os.path.basename(f))[0] for f in fnames]
+    if len(set(labels)) == len(labels) or len(set(fnames)) == 1:
+        return labels
+    paths = [os.path.abspath(f) for f in fnames]
+    common = os.path.commonpath(paths)
+    return [os.path.splitext(os.path.relpath(path, common))[0].replace(os.sep, '_') for path in paths]
+
+
+def report_names(scores_files, validation_files):
+    """ Return the name of the plot of each pair of scores and validation
+    files, raising ValueError if two pairs would share one.
+    >>> report_names(['out/jaccard.txt'], ['surveys/eco.txt', 'surveys/lux.txt'])
+    ['scatter-jaccard-eco.pdf', 'scatter-jaccard-lux.pdf']
+    """
+    scores_labels, validation_labels = file_labels(scores_files), file_labels(validation_files)
+    names = ['scatter-%s-%s.pdf' % (s, v) for s in scores_labels for v in validation_labels]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError('more than one pair of files would be plotted to %s' % ', '.join(duplicates))
+    return names
+
+
+def report_pair(scores_file, validation_file, outdir, fname, nlabels=10, hexbin=5000, show=False):
+    """ Plot one scores file against one validation file, and return their correlation. """
+    title = '%s vs. %s' % (os.path.basename(scores_file), os.path.basename(validation_file))
+    return validate(read_scores(scores_file), read_scores(validation_file), title, outdir,
+                    fname=fname, nlabels=nlabels, hexbin=hexbin, show=show)
+
+
+def report_all(scores_files, validation_files, outdir, jobs=4, **kwargs):
+    """ Plot every scores file against every validation file, jobs at a time,
+    in separate processes, and return a list of (scores file, validation
+    file, correlation) tuples. """
+    from concurrent.futures import ProcessPoolExecutor
+
+    pairs = [(s, v) for s in scores_files for v in validation_files]
+    fnames = ['scatter.pdf'] if len(pairs) == 1 else report_names(scores_files, validation_files)
+    if jobs <= 1 or len(pairs) == 1 or kwargs.get('show'):
+        corrs = [report_pair(s, v, outdir, f, **kwargs) for (s, v), f in zip(pairs, fnames)]
+    else:
+        with ProcessPoolExecutor(min(jobs, len(pairs))) as pool:
+            futures = [pool.submit(report_pair, s, v, outdir, f, **kwargs) for (s, v), f in zip(pairs, fnames)]
+            corrs = [future.result() for future in futures]
+    return [(s, v, corr) for (s, v), corr in zip(pairs, corrs)]
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv)
     mkdirs(args['--output'])
     if args['--validation']:
-        validate(scores, read_scores(args['--validation']), '', args['--output'])
+        try:
+            results = report_all(args['--scores'], args['--validation'], args['--output'], int(args['--jobs']),
+                                 nlabels=int(args['--labels']), hexbin=int(args['--hexbin']), show=args['--show'])
+        except ValueError as e:
+            exit('cannot report: %s' % e)
+        if len(results) > 1:
+            for scores_file, validation_file, corr in results:
+                print('%s %s r=%.3f' % (scores_file, validation_file, corr))
+    else:
+        for scores_file in args['--scores']:
+            read_scores(scores_file)
 
 
 if __name__ == '__main__':
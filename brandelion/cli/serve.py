@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Serve brand scores over HTTP, keeping the exemplar index in memory.
+
+usage:
+    brandelion serve --exemplar-followers <file> [--network-method <string> --min-followers <n> --max-followers <n> --text-model <file> --index-dir <dir> --host <host> --port <n> --socket <path> --reload-interval <s>]
+
+Options
+    -h, --help
+    --exemplar-followers <file>   File containing follower data for exemplar accounts.
+    --network-method <string>     Method to do network analysis [default: jaccard]
+    --min-followers <n>           Ignore exemplars that don't have at least n followers [default: 0]
+    --max-followers <n>           Ignore exemplars that have more than least n followers [default: 1e10]
+    --text-model <file>           A model saved by analyze --text --save-model (or a .topwords file), to also score tweets.
+    --index-dir <dir>             Directory in which to save exemplar indexes for reuse across runs.
+    --host <host>                 Host to listen on [default: 127.0.0.1]
+    --port <n>                    Port to listen on [default: 8642]
+    --socket <path>               Listen on this Unix socket instead of a TCP port.
+    --reload-interval <s>         Check for changed exemplar or text model files every s seconds [default: 5]
+
+Requests are JSON, POSTed to:
+    /network  {"followers": [id, ...]} or {"accounts": {"screen_name": [id, ...], ...}}
+    /text     {"tweets": ["text", ...]} or {"accounts": {"screen_name": ["text", ...], ...}}
+and return {"score": s} or {"scores": {"screen_name": s, ...}}. GET /status describes what is loaded.
+"""
+
+from docopt import docopt
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+import json
+import os
+import threading
+import time
+
+from . import analyze
+
+
+class Scorers(object):
+    """ The exemplar index and text model being served. reload() rebuilds
+    them in the background when their files change, and swaps them in
+    atomically, so requests never wait for a reload. """
+
+    def __init__(self, exemplar_file, analyze_fn, min_followers=0, max_followers=1e10, text_model=None, index_dir=None):
+        self.exemplar_file = exemplar_file
+        self.analyze_fn = analyze_fn
+        self.min_followers = min_followers
+        self.max_followers = max_followers
+        self.text_model = text_model
+        self.settings = analyze.NetworkSettings(index_dir)
+        self.mtimes = None
+        self.network = None
+        self.text = None
+        self.status = {}
+        self.reload()
+
+    def _mtimes(self):
+        return [os.path.getmtime(f) for f in (self.exemplar_file, self.text_model) if f]
+
+    def reload(self):
+        """ Rebuild the scorers if the exemplar or text model files changed. Return True if they were rebuilt. """
+        mtimes = self._mtimes()
+        if mtimes == self.mtimes:
+            return False
+        start = time.time()
+        exemplars = analyze.read_exemplars(self.exemplar_file, self.min_followers, self.max_followers, 100, set())
+        network = analyze.make_scorer(self.analyze_fn, exemplars, self.settings)
+        text = None
+        if self.text_model:
+            text = analyze.load_text_model(self.text_model)
+        self.network, self.text, self.mtimes = network, text, mtimes
+        self.status = {'exemplars': len(exemplars), 'network_method': self.analyze_fn,
+                       'text_model': self.text_model, 'loaded': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'load_seconds': round(time.time() - start, 3)}
+        print('loaded %d exemplars in %.2fs' % (len(exemplars), time.time() - start))
+        return True
+
+    def score_network(self, followers):
+        check_list(followers, 'followers')
+        return self.network(set(int(x) for x in followers))
+
+    def score_text(self, tweets):
+        if self.text is None:
+            raise ValueError('no --text-model loaded')
+        check_list(tweets, 'tweets')
+        vec, coef = self.text
+        return analyze.do_score(vec.transform([' '.join(tweets)]), coef)
+
+
+def check_list(values, name):
+    """ Raise a ValueError unless values is a non-empty list (a score of no
+    followers or tweets is undefined, and a string is not a list of tweets). """
+    if not isinstance(values, list) or not values:
+        raise ValueError('%s must be a non-empty list' % name)
+
+
+def watch(scorers, interval):
+    """ Reload scorers every interval seconds, if their files changed. """
+    while True:
+        time.sleep(interval)
+        try:
+            scorers.reload()
+        except Exception as e:  # keep serving the old index if the new files are bad.
+            print('reload failed: %s' % e)
+
+
+class ScoreHandler(BaseHTTPRequestHandler):
+    scorers = None
+
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._reply(200, self.scorers.status)
+        else:
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        score = {'/network': self.scorers.score_network, '/text': self.scorers.score_text}.get(self.path)
+        if score is None:
+            return self._reply(404, {'error': 'unknown path %s' % self.path})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf8'))
+            if 'accounts' in request:
+                if not isinstance(request['accounts'], dict):
+                    raise ValueError('accounts must map screen names to lists')
+                result = {'scores': dict((name, score(x)) for name, x in request['accounts'].items())}
+            else:
+                result = {'score': score(request['followers' if self.path == '/network' else 'tweets'])}
+        except KeyError as e:
+            return self._reply(400, {'error': 'missing %s' % e})
+        except (ValueError, TypeError, ZeroDivisionError) as e:
+            return self._reply(400, {'error': str(e)})
+        self._reply(200, result)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(scorers, host='127.0.0.1', port=8642, socket_path=None):
+    """ Return an HTTP server answering score requests with scorers, on a TCP port or a Unix socket. """
+    handler = type('Handler', (ScoreHandler,), {'scorers': scorers})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return ThreadingUnixHTTPServer(socket_path, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    args = docopt(__doc__, argv)
+    scorers = Scorers(args['--exemplar-followers'], args['--network-method'], int(args['--min-followers']),
+                      int(float(args['--max-followers'])), args['--text-model'], args['--index-dir'])
+    watcher = threading.Thread(target=watch, args=(scorers, float(args['--reload-interval'])))
+    watcher.daemon = True
+    watcher.start()
+    server = make_server(scorers, args['--host'], int(args['--port']), args['--socket'])
+    print('serving scores on %s' % (args['--socket'] or '%s:%s' % (args['--host'], args['--port'])))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -55,7 +55,10 @@ setup(
             'brandelion-collect = brandelion.cli.collect:main',
             'brandelion-analyze = brandelion.cli.analyze:main',
             'brandelion-diagnose = brandelion.cli.diagnose:main',
+            'brandelion-merge = brandelion.cli.merge:main',
+            'brandelion-partition = brandelion.cli.partition:main',
             'brandelion-report = brandelion.cli.report:main',
+            'brandelion-serve = brandelion.cli.serve:main',
         ],
     },
     test_suite='tests',
@@ -0,0 +1,628 @@
+# -*- coding: utf-8 -*-
+import collections
+import datetime
+import gzip
+import heapq
+import io
+import itertools
+import json
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from brandelion.cli import analyze, partition
+
+
+class TempDirTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        analyze._merged_indexes.clear()
+        analyze._inverted_indexes.clear()
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+
+def write_followers(fname, accounts):
+    """ Write a follower file with a line for each (screen_name, follower ids) pair. """
+    with open(fname, 'wt') as f:
+        for i, (name, followers) in enumerate(accounts):
+            f.write('2015-01-01T00:00:%02d %s %s\n' % (i % 60, name, ' '.join(str(x) for x in followers)))
+
+
+def read_scores(fname):
+    with open(fname) as f:
+        return [line.split() for line in f]
+
+
+def tweet(screen_name, day, text, tweet_id=None):
+    """ Return a tweet as collected by collect --tweets, created at noon UTC on day (YYYY-MM-DD). """
+    created = datetime.datetime.strptime(day, '%Y-%m-%d').strftime('%a %b %d 12:00:00 +0000 %Y')
+    return {'id_str': str(tweet_id or hash((screen_name, day, text)) % 10 ** 12), 'text': text,
+            'created_at': created, 'user': {'screen_name': screen_name}}
+
+
+def write_tweets(fname, tweets):
+    with io.open(fname, 'wt', encoding='utf8') as f:
+        for t in tweets:
+            f.write(json.dumps(t) + '\n')
+
+
+def random_tweets(prefix, naccounts, days, words, seed):
+    """ Return tweets of naccounts accounts on each of days, drawn from words. """
+    rand = np.random.RandomState(seed)
+    tweets = []
+    for i in range(naccounts):
+        for day in days:
+            for _ in range(rand.randint(0, 3)):
+                text = ' '.join(rand.choice(words, rand.randint(3, 8)))
+                tweets.append(tweet('%s%d' % (prefix, i), day, text, len(tweets) + seed * 100000))
+    return tweets
+
+
+WORDS = ['solar', 'panel', 'green', 'energy', 'recycle', 'plastic', 'coffee', 'morning', 'game', 'tonight',
+         'great', 'day', '#eco', '#win', 'hashtag', 'hashtags', 'new', 'shoes']
+DAYS = ['2015-01-%02d' % d for d in range(1, 11)]
+
+
+def random_accounts(prefix, n, seed, users=500, size=(5, 60)):
+    rand = np.random.RandomState(seed)
+    return [('%s%d' % (prefix, i), sorted(set(rand.randint(0, users, rand.randint(*size)).tolist()))) for i in range(n)]
+
+
+METHODS = [base + suffix for base in ['jaccard', 'proportion', 'cosine']
+           for suffix in ['', '_weighted_avg', '_sqrt_no_weighted_avg', '_sqrt', '_merge']]
+
+
+class TestIndexReuse(TempDirTest):
+
+    def test_key(self):
+        fname = self.path('exemplars.txt')
+        write_followers(fname, [('e1', [1, 2, 3]), ('e2', [4, 5])])
+        exemplars = analyze.read_exemplars(fname, 0, 1e10, 100, set())
+        self.assertEqual(exemplars, {'e1': {1, 2, 3}, 'e2': {4, 5}})
+        self.assertEqual(exemplars.key, analyze.read_exemplars(fname, 0, 1e10, 100, set()).key)
+        # selecting other exemplars, or changing their follower counts, gives a new key.
+        self.assertNotEqual(exemplars.key, analyze.read_exemplars(fname, 2, 1e10, 100, set()).key)
+        self.assertNotEqual(exemplars.key, analyze.read_exemplars(fname, 0, 1e10, 100, {'e2'}).key)
+        write_followers(fname, [('e1', [1, 2, 3]), ('e2', [4, 5, 6])])
+        self.assertNotEqual(exemplars.key, analyze.read_exemplars(fname, 0, 1e10, 100, set()).key)
+
+    def test_unkeyed_not_persisted(self):
+        settings = analyze.NetworkSettings(index_dir=self.dir)
+        analyze.compute_rarity_scores({'e1': {1, 2}}, settings)
+        analyze.merged_index({'e1': {1, 2}}, settings)
+        self.assertEqual(os.listdir(self.dir), [])
+        self.assertEqual(len(analyze._merged_indexes), 0)
+
+    def test_persisted_rarity(self):
+        settings = analyze.NetworkSettings(index_dir=self.dir)
+        exemplars = analyze.Exemplars({'e1': {1, 2, 3, 4}, 'e2': {4, 5}}, 'a')
+        ids, weights = analyze.compute_rarity_scores(exemplars, settings)
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+        ids2, weights2 = analyze.compute_rarity_scores(exemplars, settings)
+        self.assertEqual(ids.tolist(), ids2.tolist())
+        self.assertEqual(weights.tolist(), weights2.tolist())
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+        # other exemplars get their own index.
+        changed = analyze.Exemplars({'e1': {1, 2, 3, 4}, 'e2': {3, 6}}, 'b')
+        ids3, weights3 = analyze.compute_rarity_scores(changed, settings)
+        self.assertEqual(len(os.listdir(self.dir)), 2)
+        self.assertEqual(list(zip(ids3.tolist(), weights3.tolist())),
+                         [(1, .25), (2, .25), (3, .75), (4, .25), (6, .5)])
+
+    def test_merged_memo(self):
+        brands = [('b', {1, 4})]
+        self.assertEqual(analyze.jaccard_merge(brands, {'e1': {1, 4}})['b'], 1.)
+        self.assertEqual(analyze.jaccard_merge(brands, {'e1': {2, 3}})['b'], 0.)
+
+    def test_merged_memo_bounded(self):
+        for i in range(analyze.max_memo + 3):
+            analyze.jaccard_merge([('b', {1})], analyze.Exemplars({'e%d' % i: {i}}, str(i)))
+        self.assertEqual(len(analyze._merged_indexes), analyze.max_memo)
+        # the most recent index is kept.
+        exemplars = analyze.Exemplars({'e%d' % i: {i}}, str(i))
+        self.assertIs(analyze.merged_index(exemplars), analyze.merged_index(exemplars))
+
+    def test_inverted_memo_bounded(self):
+        for i in range(analyze.max_memo + 3):
+            analyze.jaccard([('b', {1})], analyze.Exemplars({'e%d' % i: {i}, 'f': {1}}, str(i)))
+        self.assertEqual(len(analyze._inverted_indexes), analyze.max_memo)
+        exemplars = analyze.Exemplars({'e1': {1, 2}, 'f': {3}}, 'new')
+        self.assertEqual(analyze.jaccard([('b', {1, 2})], exemplars)['b'], .5)
+
+
+class TestTopK(unittest.TestCase):
+
+    def test_matches_full_sort(self):
+        brands = [(name, set(followers)) for name, followers in random_accounts('b', 60, 3, size=(2, 80))]
+        # brands with the same followers tie, and are ordered by name.
+        brands += [('c%d' % i, followers) for i, (_, followers) in enumerate(brands[:20])]
+        exemplars = dict((name, set(followers)) for name, followers in random_accounts('e', 6, 4))
+        for backend in ['index', 'sets']:
+            settings = analyze.NetworkSettings(backend=backend)
+            for method in METHODS + ['rarity']:
+                scores = analyze.analyze_categories(brands, [(None, exemplars)], method, settings)
+                for k in [1, 5, 30, 100]:
+                    expected = heapq.nlargest(k, ((brand, s[0]) for brand, s in scores.items()), key=lambda x: (x[1], x[0]))
+                    self.assertEqual(analyze.top_k(brands, exemplars, method, k, settings), expected, msg=(method, backend, k))
+
+
+class TestInMemoryAPI(unittest.TestCase):
+
+    def test_follower_types(self):
+        brands = random_accounts('b', 20, 5)
+        exemplars = random_accounts('e', 4, 6)
+        rand = np.random.RandomState(7)
+        kinds = {
+            'set': lambda followers: set(followers),
+            'list': lambda followers: list(reversed(followers)) + followers[:2],  # unsorted, with repeats.
+            'array': lambda followers: np.array(followers, dtype=np.int64),
+            'unsorted array': lambda followers: rand.permutation(np.array(followers, dtype=np.int32)),
+        }
+        for backend in ['index', 'sets']:
+            settings = analyze.NetworkSettings(backend=backend)
+            for method in METHODS + ['rarity', 'adamic']:
+                expected = analyze.score_network(dict((name, set(f)) for name, f in brands),
+                                                 dict((name, set(f)) for name, f in exemplars), method, settings=settings)
+                for kind, convert in kinds.items():
+                    names, scores = analyze.score_network(dict((name, convert(f)) for name, f in brands),
+                                                          dict((name, convert(f)) for name, f in exemplars), method, settings=settings)
+                    self.assertEqual(names.tolist(), expected[0].tolist())
+                    for score, other in zip(scores, expected[1]):
+                        self.assertAlmostEqual(score, other, places=12, msg=(backend, method, kind))
+
+    def test_arrays_not_copied(self):
+        followers = np.array([1, 5, 9], dtype=np.int64)
+        self.assertIs(analyze.as_accounts({'a': followers})[0][1], followers)
+        self.assertEqual(analyze.as_accounts({'a': np.array([5, 1, 5])})[0][1].tolist(), [1, 5])
+
+
+class TestAdamic(TempDirTest):
+
+    def counter_adamic(self, brands, exemplars):
+        """ The original computation, with a Counter of degrees over dicts of sets. """
+        degrees = collections.Counter()
+        for followers in brands.values():
+            degrees.update(followers)
+        degrees.update(degrees.keys())
+        for k in degrees:
+            degrees[k] = 1. / math.log(degrees[k])
+        exemplar_sums = dict((exemplar, sum(degrees[z] for z in exemplars[exemplar])) for exemplar in exemplars)
+        scores = {}
+        for brand in brands:
+            brand_sum = sum(degrees[z] for z in brands[brand])
+            total = 0.
+            for exemplar in exemplars:
+                total += sum(degrees[z] for z in brands[brand] & exemplars[exemplar]) / (brand_sum + exemplar_sums[exemplar])
+            scores[brand] = total / len(exemplars)
+        return scores
+
+    def test_matches_counter(self):
+        brands = dict((name, set(f)) for name, f in random_accounts('b', 40, 8, users=300))
+        # exemplars followed by accounts that follow no brand.
+        exemplars = dict((name, set(f)) for name, f in random_accounts('e', 5, 9, users=400))
+        expected = self.counter_adamic(brands, exemplars)
+        fname = self.path('brands.txt')
+        write_followers(fname, sorted(brands.items()))
+        for scores in [analyze.adamic(sorted(brands.items()), exemplars), analyze.adamic(analyze.FollowerFile(fname), exemplars)]:
+            self.assertEqual(sorted(scores), sorted(expected))
+            for brand in expected:
+                self.assertAlmostEqual(scores[brand], expected[brand], places=12)
+        # merging the degree counts in chunks changes nothing.
+        ids, degrees = analyze.compute_log_degrees(sorted(brands.items()), exemplars, chunk_size=50)
+        self.assertEqual(ids.tolist(), sorted(set().union(*brands.values())))
+        whole = analyze.compute_log_degrees(sorted(brands.items()), exemplars)[1]
+        self.assertTrue(np.allclose(degrees, whole))
+
+
+class TestCategories(TempDirTest):
+
+    def test_names(self):
+        self.assertEqual(analyze.category_names(['x/eco.txt', 'x/lux.txt.gz']), ['eco', 'lux'])
+        self.assertEqual(analyze.category_names([self.path('eco/a.txt'), self.path('lux/a.txt')]), ['eco/a', 'lux/a'])
+
+    def test_same_stem(self):
+        brands = self.path('brands.txt')
+        write_followers(brands, [('b1', [1, 2, 3, 4]), ('b2', [5, 6, 7, 8])])
+        files = []
+        for category, followers in [('eco', [1, 2, 3, 9]), ('lux', [5, 6, 7, 9])]:
+            os.mkdir(self.path(category))
+            files.append(self.path(category + '/a.txt'))
+            write_followers(files[-1], [('e1', followers), ('e2', followers)])
+        outfile = self.path('scores.txt')
+        analyze.analyze_followers(brands, list(zip(analyze.category_names(files), files)), outfile,
+                                  'jaccard', 0, 1e10, 100)
+        self.assertEqual(read_scores(outfile), [['#brand', 'eco/a', 'lux/a'], ['b1', '0.6', '0'], ['b2', '0', '0.6']])
+        self.assertRaises(ValueError, analyze.analyze_followers, brands, [('a', f) for f in files], outfile,
+                          'jaccard', 0, 1e10, 100)
+
+
+class TestFollowerIndex(TempDirTest):
+
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self.fname = self.path('followers.txt')
+        write_followers(self.fname, [('A', [1, 2, 2, 3]), ('b', [4, 5, 6]), ('c', [7, 8, 9, 10])])
+
+    def test_index(self):
+        index = analyze.read_follower_index(self.fname)
+        self.assertEqual([(name, n) for name, n, _ in index], [('a', 3), ('b', 3), ('c', 4)])
+        with open(self.fname, 'rb') as f:
+            for name, _, offset in index:
+                f.seek(offset)
+                self.assertEqual(f.readline().split()[1].decode('utf8').lower(), name)
+        self.assertTrue(os.path.exists(self.fname + '.idx'))
+        self.assertEqual(analyze.read_follower_index(self.fname), index)
+        self.assertEqual(analyze.read_account(self.fname, 'B'), {4, 5, 6})
+        self.assertEqual(analyze.get_twitter_handles(self.fname), {'a', 'b', 'c'})
+
+    def test_gzip_and_crlf(self):
+        """ Offsets are into the decompressed lines of a gzipped file, and count the \r of CRLF lines. """
+        with open(self.fname, 'rb') as f:
+            data = f.read()
+        for fname, opener, contents in [(self.path('crlf.txt'), open, data.replace(b'\n', b'\r\n')),
+                                        (self.path('followers.txt.gz'), gzip.open, data),
+                                        (self.path('crlf.txt.gz'), gzip.open, data.replace(b'\n', b'\r\n'))]:
+            with opener(fname, 'wb') as f:
+                f.write(contents)
+            self.assertEqual([(name, n) for name, n, _ in analyze.read_follower_index(fname)], [('a', 3), ('b', 3), ('c', 4)])
+            self.assertTrue(os.path.exists(fname + '.idx'))
+            self.assertEqual(analyze.read_account(fname, 'c'), {7, 8, 9, 10})
+            self.assertEqual(analyze.read_follower_file(fname, names=['b', 'a']), {'a': {1, 2, 3}, 'b': {4, 5, 6}})
+
+    def test_rebuild_bad_index(self):
+        index = analyze.read_follower_index(self.fname)
+        with open(self.fname + '.idx') as f:
+            lines = f.readlines()
+        for bad in [lines[:-1], lines[:-1] + ['c 4\n'], lines[:-1] + ['c x 10\n'], lines[:1], ['#\n']]:
+            with open(self.fname + '.idx', 'wt') as f:
+                f.writelines(bad)
+            self.assertEqual(analyze.read_follower_index(self.fname), index)
+        with open(self.fname + '.idx') as f:
+            self.assertEqual(f.readlines(), lines)
+        self.assertEqual([f for f in os.listdir(self.dir) if f.endswith('.tmp')], [])
+
+    def test_rebuild_changed_file(self):
+        analyze.read_follower_index(self.fname)
+        write_followers(self.fname, [('d', [1, 2, 3, 4, 5])])
+        os.utime(self.fname, ns=(1, 1))
+        self.assertEqual([(name, n) for name, n, _ in analyze.read_follower_index(self.fname)], [('d', 5)])
+
+
+class TestOutOfCore(TempDirTest):
+
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self.brands = self.path('brands.txt')
+        self.exemplars = self.path('exemplars.txt')
+        write_followers(self.brands, random_accounts('b', 30, 1))
+        exemplars = random_accounts('e', 8, 2)
+        # an exemplar listed twice (e.g., collected twice): only its last line counts.
+        write_followers(self.exemplars, exemplars[:1] + [('e0', list(range(100, 110)))] + exemplars[1:])
+
+    def in_memory(self, method):
+        exemplars = analyze.read_follower_file(self.exemplars)
+        return getattr(analyze, method)(analyze.FollowerFile(self.brands), exemplars)
+
+    def test_parity(self):
+        for method in METHODS:
+            expected = self.in_memory(method)
+            for nbuckets in [1, 7]:
+                scores = analyze.analyze_out_of_core(self.brands, self.exemplars, method, nbuckets, tmpdir=self.dir)
+                self.assertEqual(sorted(scores), sorted(expected))
+                for brand in expected:
+                    self.assertAlmostEqual(scores[brand], expected[brand], places=12, msg=method)
+
+    def test_filters(self):
+        exemplars = analyze.read_follower_file(self.exemplars, min_followers=20, blacklist={'e3'})
+        expected = analyze.jaccard(analyze.FollowerFile(self.brands), exemplars)
+        scores = analyze.analyze_out_of_core(self.brands, self.exemplars, 'jaccard', 3, min_followers=20,
+                                             blacklist={'e3'}, tmpdir=self.dir)
+        for brand in expected:
+            self.assertAlmostEqual(scores[brand], expected[brand], places=12)
+
+    def test_bucket_passes(self):
+        """ With more buckets than may be open at once, they are written in several passes. """
+        expected = self.in_memory('cosine')
+        most = analyze.MAX_OPEN_BUCKETS
+        analyze.MAX_OPEN_BUCKETS = 3
+        try:
+            scores = analyze.analyze_out_of_core(self.brands, self.exemplars, 'cosine', 10, tmpdir=self.dir)
+        finally:
+            analyze.MAX_OPEN_BUCKETS = most
+        for brand in expected:
+            self.assertAlmostEqual(scores[brand], expected[brand], places=12)
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, analyze.analyze_out_of_core, self.brands, self.exemplars, 'rarity', 2)
+
+
+class TestPlanner(TempDirTest):
+
+    def test_choices(self):
+        brands = (1000, 1e5, 500)
+        self.assertEqual(analyze.plan_network('jaccard', brands, (2, 400, 300))[:2], ('sets', None))
+        self.assertEqual(analyze.plan_network('jaccard', brands, (200, 4e4, 300))[:2], ('index', None))
+        self.assertEqual(analyze.plan_network('rarity', brands, (2, 400, 300))[:2], ('index', None))
+        # merge methods can't be scored pairwise.
+        self.assertEqual(analyze.plan_network('jaccard_merge', brands, (2, 400, 300))[0], 'index')
+
+    def test_memory(self):
+        big = (1e4, 1e9, 1e6), (200, 1e8, 1e6)
+        self.assertEqual(analyze.plan_network('jaccard', *big, memory=4e9)[:2], ('out-of-core', 44))
+        self.assertEqual(analyze.plan_network('jaccard', *big, memory=4e9, out_of_core=False)[1], None)
+        self.assertEqual(analyze.plan_network('jaccard', *big, memory=1e12)[0], 'index')
+        self.assertEqual(analyze.plan_network('adamic', *big, memory=4e9)[:2], ('index', None))
+
+    def test_bucket_passes(self):
+        """ Buckets beyond MAX_OPEN_BUCKETS cost another read of the follower files. """
+        stats = (1e4, 1e9, 1e6), (200, 1e8, 1e6)
+        backend, nbuckets, reason = analyze.plan_network('jaccard', *stats, memory=1e8)
+        self.assertEqual(backend, 'out-of-core')
+        self.assertGreater(nbuckets, analyze.MAX_OPEN_BUCKETS)
+        passes = -(-nbuckets // analyze.MAX_OPEN_BUCKETS)
+        seconds = 1.1e9 * (analyze.OUT_OF_CORE_ID_SECONDS + (passes - 1) * analyze.PARSE_SECONDS)
+        self.assertIn('out-of-core %.3gs' % seconds, reason)
+
+    def test_requested(self):
+        stats = (1000, 1e5, 500), (2, 400, 300)
+        self.assertEqual(analyze.plan_network('jaccard', *stats, backend='index')[:2], ('index', None))
+        self.assertEqual(analyze.plan_network('jaccard', *stats, backend='out-of-core')[:2], ('out-of-core', 16))
+        self.assertRaises(ValueError, analyze.plan_network, 'adamic', *stats, backend='sets')
+        self.assertRaises(ValueError, analyze.plan_network, 'jaccard', *stats, backend='out-of-core', out_of_core=False)
+
+    def test_stats(self):
+        fname = self.path('followers.txt')
+        write_followers(fname, [('a', [1, 2, 3]), ('b', [4, 5]), ('c', list(range(10)))])
+        self.assertEqual(analyze.follower_stats(fname), (3, 15, 10))
+        self.assertEqual(analyze.follower_stats(fname, min_followers=2, blacklist={'c'}), (1, 3, 3))
+        self.assertEqual(analyze.follower_stats(fname, fraction=.5), (1.5, 7.5, 10))
+
+    def test_backends_agree(self):
+        brands, exemplars = self.path('brands.txt'), self.path('exemplars.txt')
+        write_followers(brands, random_accounts('b', 30, 1))
+        write_followers(exemplars, random_accounts('e', 5, 2))
+        outputs = []
+        for backend in ['sets', 'index', 'out-of-core']:
+            outfile = self.path(backend + '.txt')
+            analyze.analyze_followers(brands, exemplars, outfile, 'jaccard', 0, 1e10, 100, backend=backend)
+            outputs.append(dict((brand, float(score)) for brand, score in read_scores(outfile)))
+            self.assertEqual(analyze.DEFAULT_SETTINGS.backend, 'index')  # the run's settings don't leak.
+        for other in outputs[1:]:
+            self.assertEqual(sorted(other), sorted(outputs[0]))
+            for brand in other:
+                self.assertAlmostEqual(other[brand], outputs[0][brand], places=5)
+
+    def test_bad_backend(self):
+        args = analyze.docopt(analyze.__doc__, ['analyze', '--network', '--brand-followers', 'b.txt',
+                                                '--exemplar-followers', 'e.txt', '--output', 'o.txt', '--backend', 'foo'])
+        self.assertRaises(SystemExit, analyze.run_command, args)
+
+    def test_bad_shard(self):
+        for shard in ['1/0', '5/3', '1', 'a/b']:
+            args = analyze.docopt(analyze.__doc__, ['analyze', '--network', '--brand-followers', 'b.txt',
+                                                    '--exemplar-followers', 'e.txt', '--output', 'o.txt', '--shard', shard])
+            self.assertRaises(SystemExit, analyze.run_command, args)
+
+
+class TestTextStats(TempDirTest):
+
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self.exemplars = self.path('exemplars.json')
+        self.samples = self.path('samples.json')
+        write_tweets(self.exemplars, random_tweets('e', 20, DAYS, WORDS[:10], 1))
+        write_tweets(self.samples, random_tweets('s', 20, DAYS, WORDS[6:], 2))
+        self.stats = self.path('stats')
+
+    def test_chi2_from_stats(self):
+        """ chi2 from document frequencies matches sklearn's chi2 of binary document vectors. """
+        from scipy.sparse import vstack
+        from sklearn.feature_extraction.text import CountVectorizer
+        from sklearn.feature_selection import chi2
+
+        docs = {}
+        for label, fname in [('e', self.exemplars), ('s', self.samples)]:
+            for screen_name, text, created_at in analyze.parse_json(fname, include_date=True):
+                docs.setdefault(label, {}).setdefault((screen_name, partition.tweet_day(created_at)), []).append(text)
+        vec = CountVectorizer(preprocessor=analyze.preprocess, ngram_range=(2, 2), binary=True, min_df=1)
+        vec.fit([' '.join(t) for label in docs for t in docs[label].values()])
+        X = vstack([vec.transform([' '.join(t) for t in docs[label].values()]) for label in 'es'])
+        y = [1] * len(docs['e']) + [0] * len(docs['s'])
+        expected = dict(zip(analyze.vocabulary(vec), chi2(X, y)[0]))
+        stats = [(len(docs[label]), collections.Counter(dict(zip(analyze.vocabulary(vec),
+                  np.asarray((X[:len(docs['e'])] if label == 'e' else X[len(docs['e']):]).sum(axis=0))[0].tolist()))))
+                 for label in 'es']
+        vocab, scores = analyze.chi2_from_stats(stats[0], stats[1], n=len(expected), min_df=1)
+        for v, score in zip(vocab, scores):
+            if score > 0:
+                self.assertAlmostEqual(score, expected[v], places=8)
+        self.assertGreater((scores > 0).sum(), 0)
+
+    def test_update_once(self):
+        analyze.update_text_stats(self.stats, 'exemplars', self.exemplars)
+        analyze.update_text_stats(self.stats, 'samples', self.samples)
+        once = analyze.read_text_stats(self.stats, 'exemplars'), analyze.read_text_stats(self.stats, 'samples')
+        analyze.update_text_stats(self.stats, 'exemplars', self.exemplars)
+        shutil.copy(self.samples, self.path('copy.json'))
+        analyze.update_text_stats(self.stats, 'samples', self.path('copy.json'))
+        twice = analyze.read_text_stats(self.stats, 'exemplars'), analyze.read_text_stats(self.stats, 'samples')
+        self.assertEqual(once, twice)
+        # the same file may still be added to the other class.
+        analyze.update_text_stats(self.stats, 'samples', self.exemplars)
+        self.assertEqual(analyze.read_text_stats(self.stats, 'samples')[0], once[1][0] + once[0][0])
+
+    def test_incremental(self):
+        """ Adding tweets in two files gives the same tables as adding them in one. """
+        tweets = random_tweets('e', 20, DAYS, WORDS[:10], 1)
+        write_tweets(self.path('first.json'), tweets[:len(tweets) // 2])
+        write_tweets(self.path('second.json'), tweets[len(tweets) // 2:])
+        analyze.update_text_stats(self.stats, 'exemplars', self.exemplars)
+        analyze.update_text_stats(self.path('split'), 'exemplars', self.path('first.json'))
+        analyze.update_text_stats(self.path('split'), 'exemplars', self.path('second.json'))
+        whole = analyze.read_text_stats(self.stats, 'exemplars')
+        split = analyze.read_text_stats(self.path('split'), 'exemplars')
+        # an account's tweets of one day split across files count as two documents.
+        self.assertGreaterEqual(split[0], whole[0])
+        self.assertEqual(set(split[1]), set(whole[1]))
+
+    def test_window(self):
+        analyze.update_text_stats(self.stats, 'exemplars', self.exemplars)
+        analyze.update_text_stats(self.stats, 'samples', self.samples)
+        analyze.expire_text_stats(self.stats, 3)
+        self.assertEqual(analyze.text_stats_days(self.stats, 'exemplars'), DAYS[-3:])
+        vec, coef = analyze.fit_text_stats(self.stats)
+        self.assertEqual(len(analyze.vocabulary(vec)), len(coef))
+        self.assertTrue((coef > 0).all())
+
+
+class TestRollingScores(TempDirTest):
+
+    def setUp(self):
+        TempDirTest.setUp(self)
+        exemplars = random_tweets('e', 20, DAYS, WORDS[:10], 1)
+        samples = random_tweets('s', 20, DAYS, WORDS[6:], 2)
+        self.vec, self.coef = analyze.fit_text(self.documents(exemplars), self.documents(samples))
+        self.brands = random_tweets('b', 10, DAYS, WORDS, 3)
+
+    def documents(self, tweets):
+        docs = {}
+        for t in tweets:
+            docs.setdefault(t['user']['screen_name'].lower(), []).append(t['text'])
+        return docs
+
+    def brute_force(self, tweets, window):
+        """ Score each brand over each window, from the ngrams of its tweets of
+        each day in it. Ngrams don't span tweets that aren't next to each other in the file. """
+        used = {}
+        runs = itertools.groupby(tweets, lambda t: (t['user']['screen_name'].lower(), partition.tweet_day(t['created_at'])))
+        for key, run in runs:
+            ngrams = self.vec.transform([' '.join(t['text'] for t in run)]).nonzero()[1]
+            used.setdefault(key, set()).update(ngrams)
+        results = []
+        for brand in sorted(set(name for name, _ in used)):
+            for i in range(window - 1, len(DAYS)):
+                days = [(brand, day) for day in DAYS[i - window + 1:i + 1] if (brand, day) in used]
+                if days:
+                    ngrams = set().union(*[used[key] for key in days])
+                    results.append((brand, DAYS[i], sum(self.coef[j] for j in ngrams) / self.coef.sum()))
+        return results
+
+    def check(self, fname, tweets, window, **kwargs):
+        scores = sorted(analyze.rolling_scores(fname, self.vec, self.coef, window, **kwargs))
+        expected = self.brute_force(tweets, window)
+        self.assertEqual([s[:2] for s in scores], [s[:2] for s in expected])
+        for score, brute in zip(scores, expected):
+            self.assertAlmostEqual(score[2], brute[2], places=12)
+
+    def test_rolling(self):
+        fname = self.path('brands.json')
+        write_tweets(fname, self.brands)
+        for window in [1, 3]:
+            self.check(fname, self.brands, window)
+            self.check(fname, self.brands, window, batch_size=7)
+
+    def test_partitioned(self):
+        write_tweets(self.path('brands.json'), self.brands)
+        partition.partition_tweets([self.path('brands.json')], self.path('parts'))
+        self.check(self.path('parts'), self.brands, 3)
+
+    def test_scattered_tweets(self):
+        """ An account's tweets of one day that are not together in the file are all counted. """
+        # split each account's tweets of a day into two runs, between which other accounts tweet.
+        tweets = sorted(self.brands, key=lambda t: (t['created_at'], int(t['id_str']) % 2))
+        write_tweets(self.path('brands.json'), tweets)
+        self.check(self.path('brands.json'), tweets, 2)
+        self.check(self.path('brands.json'), tweets, 2, batch_size=3)
+
+
+class TestTextFeatures(TempDirTest):
+
+    def setUp(self):
+        TempDirTest.setUp(self)
+        self.files = []
+        # only the exemplars use hashtags, with the words 'hashtag' and 'hashtags' too.
+        plain = [w for w in WORDS if not w.startswith('#')]
+        for prefix, words, seed in [('b', WORDS, 3), ('e', WORDS, 1), ('s', plain[6:], 2)]:
+            self.files.append(self.path(prefix + '.json'))
+            write_tweets(self.files[-1], random_tweets(prefix, 20, DAYS, words, seed))
+
+    def scores(self, fname):
+        return dict((brand, float(score)) for brand, score in read_scores(fname))
+
+    def test_default_parity(self):
+        """ The default bigram configuration scores brands as the default run does. """
+        analyze.analyze_text(*self.files, outfile=self.path('default.txt'), analyze_fn='chi2')
+        analyze.analyze_text_features(*self.files, outfile=self.path('out.txt'), analyze_fn='chi2',
+                                      features=[analyze.parse_features('ngrams=2'), analyze.parse_features('tags:ngrams=1,hashtags')])
+        expected = self.scores(self.path('default.txt'))
+        scores = self.scores(self.path('out.ngrams_2.txt'))
+        self.assertEqual(sorted(scores), sorted(expected))
+        for brand in expected:
+            self.assertAlmostEqual(scores[brand], expected[brand], places=12)
+
+    def test_duplicate_names(self):
+        features = [analyze.parse_features('x:ngrams=1'), analyze.parse_features('x:ngrams=2')]
+        self.assertRaises(ValueError, analyze.analyze_text_features, *self.files, outfile=self.path('out.txt'),
+                          analyze_fn='chi2', features=features)
+        self.assertEqual(sorted(os.listdir(self.dir)), ['b.json', 'e.json', 's.json'])
+
+    def test_new_output_dir(self):
+        outfile = self.path('new/dir/out.txt')
+        analyze.analyze_text(*self.files, outfile=outfile, analyze_fn='chi2')
+        self.assertEqual(sorted(os.listdir(self.path('new/dir'))), ['out.txt', 'out.txt.topwords'])
+        analyze.score_text_file(self.files[0], outfile + '.topwords', self.path('other/rescored.txt'))
+        self.assertTrue(os.path.exists(self.path('other/rescored.txt')))
+
+    def test_text_model_round_trip(self):
+        """ Scoring with --text-model reproduces the scores of the run that saved the model. """
+        b, e, s = self.files
+        analyze.run_command(analyze.docopt(analyze.__doc__, [
+            'analyze', '--text', '--brand-tweets', b, '--exemplar-tweets', e, '--sample-tweets', s,
+            '--output', self.path('fit.txt'), '--save-model', self.path('model.json')]))
+        analyze.run_command(analyze.docopt(analyze.__doc__, [
+            'analyze', '--text', '--brand-tweets', b, '--text-model', self.path('model.json'),
+            '--output', self.path('rescored.txt')]))
+        expected = self.scores(self.path('fit.txt'))
+        scores = self.scores(self.path('rescored.txt'))
+        self.assertEqual(sorted(scores), sorted(expected))
+        for brand in expected:
+            self.assertAlmostEqual(scores[brand], expected[brand], places=12)
+
+    def test_unfit_config_skipped(self):
+        """ A configuration with an empty vocabulary doesn't stop the others. """
+        features = [analyze.parse_features('none:ngrams=5,min_df=100'), analyze.parse_features('uni:ngrams=1')]
+        analyze.analyze_text_features(*self.files, outfile=self.path('out.txt'), analyze_fn='chi2', features=features)
+        self.assertTrue(os.path.exists(self.path('out.uni.txt')))
+        self.assertFalse(os.path.exists(self.path('out.none.txt')))
+        self.assertRaises(ValueError, analyze.analyze_text_features, *self.files, outfile=self.path('out.txt'),
+                          analyze_fn='chi2', features=features[:1])
+
+    def test_hashtags_only(self):
+        analyze_fn = analyze.feature_analyzer((1, 1), hashtags=True)
+        self.assertEqual(analyze_fn('#hashtags hashtag hashtags #eco'), ['hashtaghashtags', 'hashtaghashtags', 'hashtageco', 'hashtageco'])
+        _, tokens = analyze.tokenize_documents([('a', 'hashtags #hashtags')], mark_hashtags=True)
+        self.assertEqual(analyze_fn(tokens[0]), ['hashtaghashtags', 'hashtaghashtags'])
+        analyze.analyze_text_features(*self.files, outfile=self.path('out.txt'), analyze_fn='chi2',
+                                      features=[analyze.parse_features('tags:ngrams=1,min_df=1,hashtags')],
+                                      model_file=self.path('model.json'))
+        with open(self.path('out.tags.txt.topwords')) as f:
+            self.assertEqual(sorted(line.split()[0] for line in f), ['hashtageco', 'hashtagwin'])
+        analyze.score_text_file(self.files[0], self.path('model.tags.json'), self.path('rescored.txt'))
+        expected = self.scores(self.path('out.tags.txt'))
+        scores = self.scores(self.path('rescored.txt'))
+        for brand in expected:
+            self.assertAlmostEqual(scores[brand], expected[brand], places=12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestImport(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_no_files_created(self):
+        """ Importing the package and its commands reads and writes no files, not even the config. """
+        env = dict(os.environ, HOME=self.dir, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='1')
+        env.pop('BRANDELION_CFG', None)
+        subprocess.check_call([sys.executable, '-c', 'import brandelion, brandelion.cli.brandelion, brandelion.cli.analyze'],
+                              cwd=self.dir, env=env)
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
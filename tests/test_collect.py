@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+try:
+    from configparser import RawConfigParser
+except ImportError:
+    from ConfigParser import RawConfigParser
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+import brandelion
+from brandelion.cli import collect
+
+
+def http_error(status, reason):
+    content = json.dumps({'error': {'errors': [{'reason': reason}], 'message': reason}}).encode('utf8')
+    return HttpError(httplib2.Response({'status': status}), content)
+
+
+class FakeService(object):
+    """ Stands in for the customsearch client. Each page of results is
+    <query>/<start>/<i>, up to total results; errors are raised, in order,
+    before any results are returned. """
+
+    def __init__(self, total=100, errors=(), repeat=False):
+        self.total = total
+        self.errors = list(errors)
+        self.repeat = repeat
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def cse(self):
+        return self
+
+    def list(self, q, cx, **kwargs):
+        return FakeRequest(self, q, kwargs)
+
+
+class FakeRequest(object):
+
+    def __init__(self, service, q, kwargs):
+        self.service = service
+        self.q = q
+        self.kwargs = kwargs
+
+    def execute(self):
+        with self.service.lock:
+            self.service.requests.append(self.kwargs)
+            if self.service.errors:
+                raise self.service.errors.pop(0)
+        start = 1 if self.service.repeat else self.kwargs['start']
+        urls = ['https://twitter.com/%s/lists/l%d' % (self.q.split()[-1], i)
+                for i in range(start, min(start + self.kwargs['num'], self.service.total + 1))]
+        return {'items': [{'formattedUrl': u} for u in urls]}
+
+
+class TestGoogleSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.settings = (collect.search_rate, collect.search_backoff)
+        collect.search_rate, collect.search_backoff = 0, 0
+        config = RawConfigParser()
+        config.add_section('GOOGLE_CSE_KEYS')
+        config.set('GOOGLE_CSE_KEYS', 'API_KEY', 'key')
+        config.set('GOOGLE_CSE_KEYS', 'CSE_ID', 'cse')
+        brandelion.set_config(config)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        collect.search_rate, collect.search_backoff = self.settings
+        brandelion.set_config(None)
+
+    def test_cached(self):
+        service = FakeService()
+        urls = collect.google_search('python', 'key', 'cse', service=service, cache_dir=self.cache_dir, num=10, start=1)
+        self.assertEqual(len(urls), 10)
+        again = collect.google_search('python', 'key', 'cse', service=service, cache_dir=self.cache_dir, num=10, start=1)
+        self.assertEqual(urls, again)
+        self.assertEqual(len(service.requests), 1)
+        collect.google_search('python', 'key', 'cse', service=service, cache_dir=self.cache_dir, num=10, start=11)
+        self.assertEqual(len(service.requests), 2)
+
+    def test_expired(self):
+        service = FakeService()
+        collect.google_search('python', 'key', 'cse', service=service, cache_dir=self.cache_dir, num=10, start=1)
+        collect.google_search('python', 'key', 'cse', service=service, cache_dir=self.cache_dir, ttl=-1, num=10, start=1)
+        self.assertEqual(len(service.requests), 2)
+
+    def test_retry_rate_limit(self):
+        service = FakeService(errors=[http_error(429, 'rateLimitExceeded'), http_error(403, 'userRateLimitExceeded')])
+        urls = collect.google_search('python', 'key', 'cse', service=service, num=10, start=1)
+        self.assertEqual(len(urls), 10)
+        self.assertEqual(len(service.requests), 3)
+
+    def test_no_retry_daily_limit(self):
+        service = FakeService(errors=[http_error(403, 'dailyLimitExceeded')])
+        urls = collect.google_search('python', 'key', 'cse', service=service, cache_dir=self.cache_dir, num=10, start=1)
+        self.assertEqual(urls, [])
+        self.assertEqual(len(service.requests), 1)
+        # failures aren't cached.
+        collect.google_search('python', 'key', 'cse', service=service, cache_dir=self.cache_dir, num=10, start=1)
+        self.assertEqual(len(service.requests), 2)
+
+    def test_give_up_after_retries(self):
+        service = FakeService(errors=[http_error(429, 'rateLimitExceeded')] * (collect.search_retries + 1))
+        self.assertEqual(collect.google_search('python', 'key', 'cse', service=service, num=10, start=1), [])
+        self.assertEqual(len(service.requests), collect.search_retries + 1)
+
+    def test_fetch_lists(self):
+        service = FakeService()
+        urls = collect.fetch_lists('python', max_results=35, cache_dir=self.cache_dir, nthreads=3, service=service)
+        self.assertEqual(len(urls), 35)
+        self.assertEqual(len(set(urls)), 35)
+        self.assertEqual(sorted(r['start'] for r in service.requests), [1, 11, 21, 31])
+
+    def test_fetch_lists_stops_on_repeats(self):
+        service = FakeService(repeat=True)
+        urls = collect.fetch_lists('python', max_results=100, nthreads=1, service=service)
+        self.assertEqual(len(urls), 10)
+        self.assertEqual(len(service.requests), 2)
+
+    def test_fetch_lists_stops_on_empty(self):
+        service = FakeService(total=15)
+        urls = collect.fetch_lists('python', max_results=100, nthreads=1, service=service)
+        self.assertEqual(len(urls), 15)
+        self.assertEqual(len(service.requests), 3)
+
+
+class FakeTwutil(object):
+    """ Stands in for twutil.collect: each list's members are its owner and
+    slug, or none for lists in failing. Fetches are counted by list. """
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.fetches = []
+        self.lock = threading.Lock()
+
+    def list_members(self, slug, screen_name):
+        with self.lock:
+            self.fetches.append((screen_name, slug))
+        return [] if slug in self.failing else [screen_name, slug]
+
+
+class TestListMembers(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.twitter = FakeTwutil(failing=['broken'])
+        twutil = types.ModuleType('twutil')
+        twutil.collect = types.ModuleType('twutil.collect')
+        twutil.collect.list_members = self.twitter.list_members
+        self.module = sys.modules.get('twutil')
+        sys.modules['twutil'] = twutil
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        if self.module is None:
+            del sys.modules['twutil']
+        else:
+            sys.modules['twutil'] = self.module
+
+    def test_cached(self):
+        url = 'https://twitter.com/lore77/lists/libri'
+        self.assertEqual(collect.fetch_list_members(url, self.cache_dir), ['lore77', 'libri'])
+        self.assertEqual(collect.fetch_list_members(url, self.cache_dir), ['lore77', 'libri'])
+        self.assertEqual(len(self.twitter.fetches), 1)
+
+    def test_expired(self):
+        url = 'https://twitter.com/lore77/lists/libri'
+        collect.fetch_list_members(url, self.cache_dir, ttl=60)
+        path = collect.list_cache_path(self.cache_dir, 'lore77', 'libri')
+        os.utime(path, (time.time() - 120, time.time() - 120))
+        collect.fetch_list_members(url, self.cache_dir, ttl=60)
+        self.assertEqual(len(self.twitter.fetches), 2)
+        collect.fetch_list_members(url, self.cache_dir, ttl=60)
+        self.assertEqual(len(self.twitter.fetches), 2)
+
+    def test_failures_not_cached(self):
+        url = 'https://twitter.com/lore77/lists/broken'
+        self.assertEqual(collect.fetch_list_members(url, self.cache_dir), [])
+        self.assertFalse(os.path.exists(collect.list_cache_path(self.cache_dir, 'lore77', 'broken')))
+        collect.fetch_list_members(url, self.cache_dir)
+        self.assertEqual(len(self.twitter.fetches), 2)
+
+    def test_dedup(self):
+        urls = ['https://twitter.com/lore77/lists/libri', 'https://twitter.com/Lore77/lists/LIBRI/members',
+                'https://twitter.com/lore77/lists/other', 'https://twitter.com/lore77/lists/libri?ref=x']
+        members = collect.fetch_all_list_members(urls, self.cache_dir, nthreads=3)
+        self.assertEqual(sorted(members), [['lore77', 'libri'], ['lore77', 'other']])
+        self.assertEqual(sorted(self.twitter.fetches), [('lore77', 'libri'), ('lore77', 'other')])
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_spacing(self):
+        limiter = collect.RateLimiter(50)
+        start = time.time()
+        threads = [threading.Thread(target=limiter.wait) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertGreaterEqual(time.time() - start, 5 / 50. - .01)
+
+    def test_unlimited(self):
+        limiter = collect.RateLimiter(0)
+        start = time.time()
+        for _ in range(100):
+            limiter.wait()
+        self.assertLess(time.time() - start, .5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from brandelion.cli import analyze, merge
+
+from .test_analyze import random_accounts, write_followers
+
+
+class TestMergeShards(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.brands = self.path('brands.txt')
+        self.exemplars = self.path('exemplars.txt')
+        write_followers(self.brands, random_accounts('b', 30, 1))
+        write_followers(self.exemplars, random_accounts('e', 5, 2))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def analyze(self, outfile, shard=None, k=None):
+        analyze.analyze_followers(self.brands, self.exemplars, outfile, 'jaccard', 0, 1e10, 100, shard=shard, k=k,
+                                  backend='index')
+        with io.open(outfile, 'rt', encoding='utf8') as f:
+            return [line.rstrip('\n') for line in f]
+
+    def shards(self, n, k=None):
+        fnames = [self.path('shard%d.txt' % i) for i in range(n)]
+        for i, fname in enumerate(fnames):
+            self.analyze(fname, (i, n), k)
+        return fnames
+
+    def test_merge(self):
+        self.assertEqual(merge.merge_shards(self.shards(3)), self.analyze(self.path('all.txt')))
+        self.assertEqual(merge.merge_shards(self.shards(3, k=5)), self.analyze(self.path('top.txt'), k=5))
+
+    def test_missing(self):
+        fnames = self.shards(3)
+        self.assertRaisesRegex(ValueError, 'missing shards 1 of 3', merge.merge_shards, fnames[:1] + fnames[2:])
+
+    def test_duplicate(self):
+        fnames = self.shards(3)
+        self.assertRaisesRegex(ValueError, 'shard 1 appears twice', merge.merge_shards, fnames + fnames[1:2])
+
+    def test_corrupt(self):
+        fnames = self.shards(2)
+        with io.open(fnames[1], 'rt', encoding='utf8') as f:
+            lines = f.readlines()
+        with io.open(fnames[1], 'wt', encoding='utf8') as f:
+            f.writelines(lines[:-1])  # truncated.
+        self.assertRaisesRegex(ValueError, 'checksum mismatch', merge.merge_shards, fnames)
+        with io.open(fnames[1], 'wt', encoding='utf8') as f:
+            f.writelines(lines[1:])  # no header.
+        self.assertRaisesRegex(ValueError, 'not the output of analyze --shard', merge.merge_shards, fnames)
+
+    def test_other_run(self):
+        fnames = self.shards(2)
+        analyze.analyze_followers(self.brands, self.exemplars, fnames[1], 'cosine', 0, 1e10, 100, shard=(1, 2),
+                                  backend='index')
+        self.assertRaisesRegex(ValueError, 'has run=', merge.merge_shards, fnames)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import types
+import unittest
+
+from brandelion.cli import metrics
+
+
+class TestRecordSleeps(unittest.TestCase):
+
+    def setUp(self):
+        self.client = types.ModuleType('fakeclient')
+        self.client.time = time
+        metrics.start(profile='none')
+
+    def tearDown(self):
+        metrics.enabled = False
+
+    def test_restored(self):
+        with metrics.record_sleeps(self.client):
+            self.assertIsNot(self.client.time, time)
+            self.client.time.sleep(0)
+            self.assertEqual(self.client.time.time.__name__, 'time')
+        self.assertIs(self.client.time, time)
+        self.assertEqual(metrics._events['rate_limit_wait']['count'], 1)
+
+    def test_restored_after_error(self):
+        try:
+            with metrics.record_sleeps(self.client):
+                raise KeyError()
+        except KeyError:
+            pass
+        self.assertIs(self.client.time, time)
+
+    def test_nested(self):
+        with metrics.record_sleeps(self.client):
+            with metrics.record_sleeps(self.client):
+                pass
+            self.assertIsNot(self.client.time, time)
+            self.client.time.sleep(0)
+        self.assertIs(self.client.time, time)
+        self.assertEqual(metrics._events['rate_limit_wait']['count'], 1)
+
+    def test_concurrent(self):
+        def sleep():
+            with metrics.record_sleeps(self.client):
+                self.client.time.sleep(.01)
+        threads = [threading.Thread(target=sleep) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertIs(self.client.time, time)
+        self.assertEqual(metrics._events['rate_limit_wait']['count'], 8)
+
+    def test_disabled(self):
+        metrics.enabled = False
+        with metrics.record_sleeps(self.client):
+            self.assertIs(self.client.time, time)
+        self.assertIs(self.client.time, time)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from brandelion.cli import partition
+
+from .test_analyze import DAYS, WORDS, random_tweets, tweet, write_tweets
+
+
+def tweet_ids(tweets):
+    return sorted(t['id_str'] for t in tweets)
+
+
+class TestPartition(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tweets = random_tweets('b', 15, DAYS, WORDS, 3)
+        self.fname = os.path.join(self.dir, 'tweets.json')
+        write_tweets(self.fname, self.tweets)
+        self.out = os.path.join(self.dir, 'parts')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_days(self):
+        self.assertEqual(partition.tweet_day('Thu Jan 01 23:00:00 -0500 2015'), '2015-01-02')
+        self.assertEqual(partition.period_keys('2015-01-01', '2015-01-13', 'week'), ['2014-12-29', '2015-01-05', '2015-01-12'])
+        self.assertRaises(ValueError, partition.parse_day, '2015-13-01')
+
+    def test_read_all(self):
+        index = partition.partition_tweets([self.fname], self.out)
+        self.assertEqual(sorted(index['partitions']), DAYS)
+        self.assertEqual(sum(p['tweets'] for p in index['partitions'].values()), len(self.tweets))
+        tweets = list(partition.read_tweets(self.out))
+        self.assertEqual(tweet_ids(tweets), tweet_ids(self.tweets))
+        names = [partition.screen_name(t) for t in tweets]
+        self.assertEqual(names, sorted(names))
+
+    def test_range(self):
+        for period, compress in [('day', False), ('week', True)]:
+            out = os.path.join(self.dir, period)
+            partition.partition_tweets([self.fname], out, period, compress)
+            expected = [t for t in self.tweets if '2015-01-03' <= partition.tweet_day(t['created_at']) <= '2015-01-06']
+            tweets = list(partition.read_tweets(out, '2015-01-03', '2015-01-06'))
+            self.assertEqual(tweet_ids(tweets), tweet_ids(expected))
+
+    def test_add(self):
+        """ Adding overlapping files drops duplicates and rewrites only the partitions they fall in. """
+        first = os.path.join(self.dir, 'first.json')
+        second = os.path.join(self.dir, 'second.json')
+        write_tweets(first, [t for t in self.tweets if partition.tweet_day(t['created_at']) <= '2015-01-05'])
+        write_tweets(second, [t for t in self.tweets if partition.tweet_day(t['created_at']) >= '2015-01-05'])
+        partition.partition_tweets([first], self.out)
+        untouched = os.path.join(self.out, '2015-01-01.json')
+        mtime = os.stat(untouched).st_mtime_ns
+        partition.partition_tweets([second], self.out)
+        self.assertEqual(os.stat(untouched).st_mtime_ns, mtime)
+        self.assertEqual(tweet_ids(partition.read_tweets(self.out)), tweet_ids(self.tweets))
+        self.assertRaises(ValueError, partition.partition_tweets, [second], self.out, 'week')
+
+    def test_many_partitions(self):
+        """ With more partitions than files may be open at once, they are merged in passes, in the same order. """
+        partition.partition_tweets([self.fname], self.out)
+        expected = list(partition.read_tweets(self.out))
+        open_lines, most = partition.open_lines, partition.MAX_OPEN
+        opened = []
+
+        def track(fname):
+            opened.append(open_lines(fname))
+            return opened[-1]
+        partition.open_lines, partition.MAX_OPEN = track, 3
+        try:
+            tweets = []
+            most_open = 0
+            for t in partition.read_tweets(self.out):
+                tweets.append(t)
+                most_open = max(most_open, sum(1 for f in opened if not f.closed))
+        finally:
+            partition.open_lines, partition.MAX_OPEN = open_lines, most
+        self.assertEqual(tweets, expected)
+        self.assertLessEqual(most_open, 3)
+        self.assertGreater(len(opened), len(DAYS))  # partitions, then merged runs.
+        self.assertEqual([f for f in os.listdir(tempfile.gettempdir()) if f.startswith('brandelion-merge')], [])
+
+    def test_compress_later(self):
+        partition.partition_tweets([self.fname], self.out)
+        write_tweets(os.path.join(self.dir, 'more.json'), [tweet('zz', '2015-01-02', 'one more tweet', 1)])
+        partition.partition_tweets([os.path.join(self.dir, 'more.json')], self.out, compress=True)
+        files = os.listdir(self.out)
+        self.assertIn('2015-01-02.json.gz', files)
+        self.assertNotIn('2015-01-02.json', files)
+        self.assertEqual(len(list(partition.read_tweets(self.out))), len(self.tweets) + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from brandelion.cli import reader
+
+
+class TestIterLines(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.settings = (reader.BLOCK_SIZE, reader.QUEUE_SIZE, reader.external_decompressors)
+        reader.BLOCK_SIZE = 7  # lines span blocks.
+
+    def tearDown(self):
+        reader.BLOCK_SIZE, reader.QUEUE_SIZE, reader.external_decompressors = self.settings
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        fname = os.path.join(self.dir, name)
+        with (gzip.open(fname, 'wb') if reader.is_compressed(fname) else open(fname, 'wb')) as f:
+            f.write(data)
+        return fname
+
+    def test_lines(self):
+        data = b'first line\nsecond\n\nlast line, longer than a block\n'
+        expected = [b'first line', b'second', b'', b'last line, longer than a block']
+        for external in [True, False]:
+            reader.external_decompressors = external
+            self.assertEqual(list(reader.iter_lines(self.write('x.txt', data))), expected)
+            self.assertEqual(list(reader.iter_lines(self.write('x.txt.gz', data))), expected)
+
+    def test_no_trailing_newline(self):
+        self.assertEqual(list(reader.iter_lines(self.write('x.txt', b'one\ntwo'))), [b'one', b'two'])
+        self.assertEqual(list(reader.iter_lines(self.write('y.txt', b''))), [])
+
+    def test_crlf(self):
+        """ Lines end at \\n; a \\r before it is kept, so each line's length plus one is its length in the file. """
+        lines = list(reader.iter_lines(self.write('x.txt', b'a 1 2\r\nb 3 4\r\n')))
+        self.assertEqual(lines, [b'a 1 2\r', b'b 3 4\r'])
+        self.assertEqual([line.split() for line in lines], [[b'a', b'1', b'2'], [b'b', b'3', b'4']])
+
+    def test_close_early(self):
+        reader.QUEUE_SIZE = 2
+        fname = self.write('x.txt.gz', b''.join(b'line %d\n' % i for i in range(10000)))
+        before = threading.active_count()
+        lines = reader.iter_lines(fname)
+        self.assertEqual(next(lines), b'line 0')
+        self.assertEqual(threading.active_count(), before + 1)
+        lines.close()  # the reader, blocked on the full queue, stops.
+        self.assertEqual(threading.active_count(), before)
+
+    def test_errors(self):
+        self.assertRaises(IOError, list, reader.iter_lines(os.path.join(self.dir, 'missing.txt')))
+        self.assertRaises(IOError, list, reader.iter_lines(os.path.join(self.dir, 'missing.txt.gz')))
+        fname = self.write('x.txt.gz', b''.join(b'line %d\n' % i for i in range(1000)))
+        with open(fname, 'rb') as f:
+            data = f.read()
+        with open(fname, 'wb') as f:
+            f.write(data[:len(data) // 2])  # truncated.
+        for external in [True, False]:
+            reader.external_decompressors = external
+            self.assertRaises((IOError, EOFError), list, reader.iter_lines(fname))
+
+
+if __name__ == '__main__':
+    unittest.main()
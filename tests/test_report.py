@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from brandelion.cli import report
+
+
+class TestReport(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, scores):
+        fname = os.path.join(self.dir, name)
+        report.mkdirs(os.path.dirname(fname))
+        with open(fname, 'wt') as f:
+            for brand, score in scores:
+                f.write('%s %g\n' % (brand, score))
+        return fname
+
+    def test_names(self):
+        self.assertEqual(report.report_names(['a/x.txt', 'b/y.txt'], ['v.txt']), ['scatter-x-v.pdf', 'scatter-y-v.pdf'])
+        self.assertEqual(report.report_names(['run1/x.txt', 'run2/x.txt'], ['v.txt']),
+                         ['scatter-run1_x-v.pdf', 'scatter-run2_x-v.pdf'])
+        self.assertRaises(ValueError, report.report_names, ['x.txt', 'x.txt'], ['v.txt'])
+
+    def test_same_basename(self):
+        brands = ['b%d' % i for i in range(20)]
+        validation = self.write('survey.txt', [(b, i) for i, b in enumerate(brands)])
+        first = self.write('run1/jaccard.txt', [(b, i * 2) for i, b in enumerate(brands)])
+        second = self.write('run2/jaccard.txt', [(b, -i) for i, b in enumerate(brands)])
+        out = os.path.join(self.dir, 'out')
+        report.mkdirs(out)
+        results = report.report_all([first, second], [validation], out, jobs=1, nlabels=2)
+        self.assertEqual([round(corr, 6) for _, _, corr in results], [1., -1.])
+        self.assertEqual(sorted(os.listdir(out)), ['scatter-run1_jaccard-survey.pdf', 'scatter-run2_jaccard-survey.pdf'])
+
+    def test_atomic_open(self):
+        fname = os.path.join(self.dir, 'x.txt')
+        with report.atomic_open(fname) as f:
+            f.write(u'first')
+        try:
+            with report.atomic_open(fname) as f:
+                f.write(u'partial')
+                raise RuntimeError('interrupted')
+        except RuntimeError:
+            pass
+        with open(fname) as f:
+            self.assertEqual(f.read(), 'first')
+        self.assertEqual(os.listdir(self.dir), ['x.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError
+
+from brandelion.cli import serve
+
+from .test_analyze import write_followers
+
+
+class TestServe(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.exemplars = os.path.join(self.dir, 'exemplars.txt')
+        write_followers(self.exemplars, [('e1', [1, 2, 3, 4]), ('e2', [3, 4])])
+        self.model = os.path.join(self.dir, 'model.json')
+        with io.open(self.model, 'wt', encoding='utf8') as f:
+            f.write(json.dumps({'ngram_range': [1, 1], 'vocabulary': ['solar', 'green'], 'coef': [2., 1.]}))
+        self.scorers = serve.Scorers(self.exemplars, 'proportion', text_model=self.model)
+        self.server = serve.make_server(self.scorers, port=0)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.dir)
+
+    def post(self, path, obj):
+        """ Return the status and JSON reply of a request. """
+        data = obj if isinstance(obj, bytes) else json.dumps(obj).encode('utf8')
+        try:
+            response = urlopen(Request(self.url + path, data, {'Content-Type': 'application/json'}))
+        except HTTPError as e:
+            response = e
+        return response.getcode(), json.loads(response.read().decode('utf8'))
+
+    def test_scores(self):
+        self.assertEqual(self.post('/network', {'followers': [1, 2]}), (200, {'score': .5}))
+        self.assertEqual(self.post('/network', {'accounts': {'a': [3], 'b': [5]}}),
+                         (200, {'scores': {'a': 1., 'b': 0.}}))
+        self.assertEqual(self.post('/text', {'tweets': ['solar panel', 'sunny day']}), (200, {'score': 2. / 3}))
+
+    def test_bad_requests(self):
+        self.assertEqual(self.post('/network', {'followers': []})[0], 400)
+        self.assertEqual(self.post('/network', {'followers': 12})[0], 400)
+        self.assertEqual(self.post('/network', {'accounts': {'a': []}})[0], 400)
+        self.assertEqual(self.post('/network', {'accounts': [1, 2]})[0], 400)
+        self.assertEqual(self.post('/network', {'tweets': ['solar']}), (400, {'error': "missing 'followers'"}))
+        self.assertEqual(self.post('/text', {'tweets': 'solar panel'})[0], 400)
+        self.assertEqual(self.post('/text', {'tweets': []})[0], 400)
+        self.assertEqual(self.post('/network', b'not json')[0], 400)
+        self.assertEqual(self.post('/other', {'followers': [1]})[0], 404)
+
+    def test_status(self):
+        status = json.loads(urlopen(self.url + '/status').read().decode('utf8'))
+        self.assertEqual(status['exemplars'], 2)
+        self.assertEqual(status['network_method'], 'proportion')
+
+    def test_reload(self):
+        self.assertFalse(self.scorers.reload())
+        write_followers(self.exemplars, [('e1', [1, 2, 3, 4]), ('e2', [3, 4]), ('e3', [9, 10])])
+        mtime = os.path.getmtime(self.exemplars) + 10  # the clock may not have ticked since setUp.
+        os.utime(self.exemplars, (mtime, mtime))
+        self.assertTrue(self.scorers.reload())
+        self.assertEqual(self.scorers.status['exemplars'], 3)
+        self.assertEqual(self.post('/network', {'followers': [9]}), (200, {'score': 1. / 3}))
+        self.assertFalse(self.scorers.reload())
+
+
+if __name__ == '__main__':
+    unittest.main()